@@ -0,0 +1,153 @@
+"""
+Import-time benchmark of the app's modules, the cost the desktop launcher pays on a cold start.
+
+Every module is imported in a fresh interpreter (run from src/), several times, and the
+median import time is reported together with the heavy libraries that import pulled in.
+With --baseline-rev the same modules of an earlier git revision are measured as well,
+so the before and after numbers are printed side by side.
+
+Usage (from the repository root):
+    python bench/import_time.py
+    python bench/import_time.py --baseline-rev HEAD~1 --repeat 7
+    python bench/import_time.py --modules app cogservice --output bench/results/import_time.json
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_ROOT, "src")
+
+DEFAULT_MODULES = ("app", "cogservice", "batch_cogservice", "model", "excel_writer", "cli")
+
+# Third-party libraries that dominate the cold start when imported eagerly.
+HEAVY_LIBRARIES = (
+    "azure.ai.documentintelligence", "openai", "instructor", "httpx", "aiohttp", "requests",
+    "pandas", "openpyxl", "pypdf", "tiktoken", "streamlit",
+)
+
+_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+error = None
+try:
+    import {module}
+except Exception as e:
+    error = f"{{type(e).__name__}}: {{e}}"
+seconds = time.perf_counter() - started
+print(json.dumps({{"seconds": seconds, "error": error, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=list(DEFAULT_MODULES), help="Modules of src/ to import.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per module; the median is reported.")
+    parser.add_argument("--baseline-rev", default=None, help="Git revision to measure as the 'before' numbers.")
+    parser.add_argument("--output", default=None, help="JSON report path; defaults to bench/results/import_time_<timestamp>.json.")
+    return parser.parse_args(argv)
+
+
+def measure(src_dir, module, repeat):
+    """
+    Imports `module` in `repeat` fresh interpreters with `src_dir` as working directory.
+
+    Returns:
+        dict: median and min seconds, the heavy libraries loaded and the import error, if any.
+    """
+    samples = []
+    probe = {}
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_LIBRARIES)],
+            cwd=src_dir, capture_output=True, text=True,
+        )
+        if completed.returncode != 0 or not completed.stdout.strip():
+            return {"median": None, "min": None, "loaded": [], "error": completed.stderr.strip()[-500:]}
+        probe = json.loads(completed.stdout.strip().splitlines()[-1])
+        samples.append(probe["seconds"])
+    return {
+        "median": round(statistics.median(samples), 4),
+        "min": round(min(samples), 4),
+        "loaded": probe["loaded"],
+        "error": probe["error"],
+    }
+
+
+def export_src(revision, target_dir):
+    """Extracts src/ of a git revision into `target_dir` and returns the path of its src/."""
+    archive = subprocess.run(
+        ["git", "archive", "--format=tar", revision, "src"], cwd=REPO_ROOT, capture_output=True, check=True
+    ).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(target_dir)
+    return os.path.join(target_dir, "src")
+
+
+def run(args):
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "repeat": args.repeat,
+        "baseline_rev": args.baseline_rev,
+        "modules": {},
+    }
+    baseline = {}
+    if args.baseline_rev:
+        with tempfile.TemporaryDirectory(prefix="import_time_") as work_dir:
+            baseline_src = export_src(args.baseline_rev, work_dir)
+            baseline = {module: measure(baseline_src, module, args.repeat) for module in args.modules}
+    for module in args.modules:
+        report["modules"][module] = {"after": measure(SRC_DIR, module, args.repeat)}
+        if module in baseline:
+            report["modules"][module]["before"] = baseline[module]
+    return report
+
+
+def print_report(report):
+    def seconds(result):
+        if result is None:
+            return "-"
+        return "error" if result["median"] is None else f"{result['median']:.3f}s"
+
+    print(f"Median import time over {report['repeat']} fresh interpreters:")
+    for module, results in report["modules"].items():
+        before, after = results.get("before"), results["after"]
+        line = f"  {module:<18} {seconds(after):>9}"
+        if before is not None:
+            line = f"  {module:<18} {seconds(before):>9} -> {seconds(after):<9}"
+            if before["median"] and after["median"]:
+                line += f" ({(after['median'] - before['median']) / before['median'] * 100:+.1f}%)"
+        print(line)
+        print(f"    loads: {', '.join(after['loaded']) or 'no heavy libraries'}")
+        if before is not None and before["loaded"] != after["loaded"]:
+            print(f"    before: {', '.join(before['loaded']) or 'no heavy libraries'}")
+        if after["error"]:
+            print(f"    import failed: {after['error'].splitlines()[-1]}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+
+    output = args.output or os.path.join(
+        REPO_ROOT, "bench", "results", f"import_time_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print(f"Report written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""
+Offline end-to-end benchmark of the batch pipeline.
+
+Starts local stub servers for Document Intelligence and Azure OpenAI (see
+`stub_servers.py`), replays the PDFs in `invoices/` scaled up to the requested
+number of invoices, runs the batch path against the stubs and writes a JSON
+report with invoices/sec, per-stage p50/p95/p99 latencies, peak RSS and the
+workbook time. No Azure credentials or network access are needed.
+
+Usage (from the repository root):
+    python bench/run_benchmark.py --invoices 2000 --di-latency 2 --llm-latency 1 --di-throttle-rate 0.02
+    python bench/run_benchmark.py --mode two-phase --output bench/results/two_phase.json
+    python bench/run_benchmark.py --compare bench/results/baseline.json
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from stub_servers import (
+    ChatCompletionsStubHandler,
+    DocumentIntelligenceStubHandler,
+    StubConfig,
+    start_stub_server,
+)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_ROOT, "src")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invoices", type=int, default=500, help="Number of invoices to replay.")
+    parser.add_argument("--source", default=os.path.join(REPO_ROOT, "invoices"), help="Directory of sample PDFs.")
+    parser.add_argument("--mode", choices=("pipeline", "two-phase"), default="pipeline",
+                        help="pipeline: process_batch_invoices_excel; two-phase: OCR all, then LLM all.")
+    parser.add_argument("--di-latency", type=float, default=2.0, help="Mean seconds per analyze operation.")
+    parser.add_argument("--di-jitter", type=float, default=0.5)
+    parser.add_argument("--di-throttle-rate", type=float, default=0.0, help="Fraction of analyze calls answered 429.")
+    parser.add_argument("--di-poll-ms", type=int, default=250, help="retry-after-ms sent while an operation runs.")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Mean seconds per chat completion.")
+    parser.add_argument("--llm-jitter", type=float, default=0.3)
+    parser.add_argument("--llm-throttle-rate", type=float, default=0.0, help="Fraction of completions answered 429.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds of injected 429s.")
+    parser.add_argument("--concurrency", type=int, default=None, help="max_concurrency setting.")
+    parser.add_argument("--di-rps", type=float, default=None, help="document_intelligence_rps setting.")
+    parser.add_argument("--llm-rpm", type=int, default=None, help="llm_requests_per_minute setting.")
+    parser.add_argument("--pack-size", type=int, default=None, help="llm_pack_max_invoices setting.")
+    parser.add_argument("--text-layer", action="store_true", help="Keep the text layer fast path enabled.")
+    parser.add_argument("--output", default=None, help="JSON report path; defaults to bench/results/<timestamp>.json.")
+    parser.add_argument("--compare", default=None, help="Earlier JSON report to print deltas against.")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, work_dir):
+    """
+    Points the app's settings at the work directory and the benchmark's knobs.
+
+    Must run before any module from src/ is imported: settings and caches are read at import time.
+    """
+    os.environ["CACHE_DIR"] = os.path.join(work_dir, "cache")
+    os.environ["JOURNAL_PATH"] = os.path.join(work_dir, "jobs.sqlite3")
+    os.environ["TEXT_LAYER_FAST_PATH"] = "true" if args.text_layer else "false"
+    os.environ["HISTORY_DIR"] = os.path.join(work_dir, "history")
+    # Replayed copies share their vendor; the vendor memory would answer most of them without the LLM stage.
+    os.environ["VENDOR_MEMORY_ENABLED"] = "false"
+    os.environ.setdefault("AZURE_API_VERSION", "2024-10-21")
+    for variable, value in (
+        ("MAX_CONCURRENCY", args.concurrency),
+        ("DOCUMENT_INTELLIGENCE_RPS", args.di_rps),
+        ("LLM_REQUESTS_PER_MINUTE", args.llm_rpm),
+        ("LLM_PACK_MAX_INVOICES", args.pack_size),
+    ):
+        if value is not None:
+            os.environ[variable] = str(value)
+    sys.path.insert(0, SRC_DIR)
+
+
+def replay_invoices(source_dir, count, target_dir):
+    """
+    Copies the sample PDFs round-robin until there are `count` of them.
+
+    Every copy gets a unique trailing PDF comment, so the content hashes (analyze cache,
+    journal) differ and every invoice is really processed.
+    """
+    samples = sorted(
+        path for path in glob.glob(os.path.join(source_dir, "*"))
+        if path.lower().endswith(".pdf")
+    )
+    if not samples:
+        raise SystemExit(f"No PDFs found in {source_dir}")
+    os.makedirs(target_dir, exist_ok=True)
+    contents = []
+    for path in samples:
+        with open(path, "rb") as f:
+            contents.append(f.read())
+    paths = []
+    for index in range(count):
+        path = os.path.join(target_dir, f"invoice_{index:06d}.pdf")
+        with open(path, "wb") as f:
+            f.write(contents[index % len(contents)])
+            f.write(f"\n%bench-replay {index}\n".encode("ascii"))
+        paths.append(path)
+    return paths
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 4)
+
+    return {"count": len(ordered), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 4)}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class StageTimer:
+    """Collects per-call latencies of the pipeline's stage functions."""
+
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, count=1):
+        with self._lock:
+            self.samples.setdefault(stage, []).extend([seconds] * count)
+
+    def wrap_async(self, stage, function, count=None):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start, count(args) if count else 1)
+        return timed
+
+
+def instrument(batch_cogservice, timer):
+    """Times the OCR, LLM and workbook stages of `batch_cogservice` without changing their behaviour."""
+    batch_cogservice.aextract_invoices = timer.wrap_async(
+        "ocr", batch_cogservice.aextract_invoices
+    )
+    # One packed call serves several invoices; its latency counts once per invoice.
+    batch_cogservice.aextract_invoice_details_packed = timer.wrap_async(
+        "llm", batch_cogservice.aextract_invoice_details_packed, count=lambda args: len(args[0])
+    )
+
+    base_writer = batch_cogservice.StreamingInvoiceWriter
+
+    class TimedWriter(base_writer):
+        def append(self, row):
+            start = time.perf_counter()
+            super().append(row)
+            timer.add("workbook_append", time.perf_counter() - start)
+
+        def close(self):
+            start = time.perf_counter()
+            try:
+                return super().close()
+            finally:
+                timer.add("workbook_save", time.perf_counter() - start)
+
+    batch_cogservice.StreamingInvoiceWriter = TimedWriter
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix="invoice-bench-")
+    configure_environment(args, work_dir)
+
+    di_server, di_url = start_stub_server(DocumentIntelligenceStubHandler, StubConfig(
+        latency=args.di_latency, jitter=args.di_jitter, throttle_rate=args.di_throttle_rate,
+        retry_after=args.retry_after, poll_interval_ms=args.di_poll_ms,
+    ))
+    llm_server, llm_url = start_stub_server(ChatCompletionsStubHandler, StubConfig(
+        latency=args.llm_latency, jitter=args.llm_jitter, throttle_rate=args.llm_throttle_rate,
+        retry_after=args.retry_after,
+    ))
+
+    try:
+        paths = replay_invoices(args.source, args.invoices, os.path.join(work_dir, "invoices"))
+        env_config = {
+            "DOCUMENT_INTELLIGENCE_ENDPOINT": di_url,
+            "DOCUMENT_INTELLIGENCE_API_KEY": "bench",
+            "AZURE_URL": f"{llm_url}/openai",
+            "AZURE_API_KEY": "bench",
+        }
+
+        import_start = time.perf_counter()
+        import batch_cogservice
+        from config.settings import get_settings
+        from metrics import metrics
+        from ratelimit import get_scheduler
+        import_seconds = time.perf_counter() - import_start
+
+        timer = StageTimer()
+        instrument(batch_cogservice, timer)
+        save_dir = os.path.join(work_dir, "output")
+        completed = []
+        failed = []
+        start = time.perf_counter()
+
+        def on_row(invoice_path, row):
+            timer.add("end_to_end", time.perf_counter() - start)
+            (failed if row.get("Error") else completed).append(invoice_path)
+
+        if args.mode == "pipeline":
+            excel_path = batch_cogservice.process_batch_invoices_excel(
+                paths, env_config, save_dir=save_dir, use_cache=False, on_row=on_row
+            )
+        else:
+            results = batch_cogservice.batch_extract_fields_from_invoices(paths, env_config, use_cache=False)
+            ocr_done = time.perf_counter()
+            timer.add("ocr_phase", ocr_done - start)
+            excel_path = batch_cogservice.generate_batch_invoices_excel(
+                results, save_dir=save_dir, config=env_config, use_cache=False
+            )
+            completed = [path for path, result in results.items() if result is not None]
+            failed = [path for path, result in results.items() if result is None]
+        elapsed = time.perf_counter() - start
+
+        settings = get_settings()
+        report = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "mode": args.mode,
+            "invoices": len(paths),
+            "completed": len(completed),
+            "failed": len(failed),
+            "elapsed_seconds": round(elapsed, 3),
+            "invoices_per_second": round(len(paths) / elapsed, 3) if elapsed else None,
+            "import_seconds": round(import_seconds, 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "workbook_seconds": round(sum(timer.samples.get("workbook_append", [])) + sum(timer.samples.get("workbook_save", [])), 3),
+            "workbook_bytes": os.path.getsize(excel_path) if os.path.exists(excel_path) else None,
+            "stages": {stage: percentiles(samples) for stage, samples in sorted(timer.samples.items())},
+            "schedulers": {
+                name: get_scheduler(name).stats() for name in ("document_intelligence", "azure_openai")
+            },
+            "metrics": metrics.run_report(),
+            "stub_servers": {"document_intelligence": dict(di_server.counters), "azure_openai": dict(llm_server.counters)},
+            "config": {
+                "di_latency": args.di_latency, "di_jitter": args.di_jitter, "di_throttle_rate": args.di_throttle_rate,
+                "llm_latency": args.llm_latency, "llm_jitter": args.llm_jitter, "llm_throttle_rate": args.llm_throttle_rate,
+                "retry_after": args.retry_after, "text_layer_fast_path": settings.text_layer_fast_path,
+                "max_concurrency": settings.max_concurrency, "document_intelligence_rps": settings.document_intelligence_rps,
+                "llm_requests_per_minute": settings.llm_requests_per_minute,
+                "llm_pack_max_invoices": settings.llm_pack_max_invoices,
+            },
+        }
+        return report
+    finally:
+        di_server.shutdown()
+        llm_server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_comparison(report, baseline):
+    def delta(name, new, old):
+        if new is None or old is None:
+            return
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"  {name:<28} {old:>10} -> {new:<10} ({change:+.1f}%)")
+
+    print(f"Compared with {baseline.get('timestamp')} ({baseline.get('mode')}, {baseline.get('invoices')} invoices):")
+    for key in ("invoices_per_second", "elapsed_seconds", "peak_rss_mb", "workbook_seconds"):
+        delta(key, report.get(key), baseline.get(key))
+    for stage, stats in report["stages"].items():
+        old = baseline.get("stages", {}).get(stage)
+        if old:
+            delta(f"{stage} p95", stats["p95"], old["p95"])
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+
+    output = args.output or os.path.join(
+        REPO_ROOT, "bench", "results", f"{report['mode']}_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print(
+        f"{report['completed']}/{report['invoices']} invoices in {report['elapsed_seconds']}s "
+        f"({report['invoices_per_second']} invoices/s), peak RSS {report['peak_rss_mb']} MB, "
+        f"workbook {report['workbook_seconds']}s"
+    )
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:<16} p50 {stats['p50']}  p95 {stats['p95']}  p99 {stats['p99']}  (n={stats['count']})")
+    print(f"Report written to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(report, json.load(f))
+    return 0 if report["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
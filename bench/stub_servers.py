@@ -0,0 +1,232 @@
+"""
+Local HTTP stand-ins for the Document Intelligence analyze/poll endpoints and the
+Azure OpenAI chat completions endpoint, for offline benchmarking.
+
+Both servers support configurable latency, jitter and 429 injection, and answer
+with canned responses shaped like the real services.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubConfig:
+    """
+    Behaviour of a stub server.
+
+    Args:
+        latency (float): Mean seconds a request (or an analyze operation) takes.
+        jitter (float): Uniform +/- seconds added to the latency.
+        throttle_rate (float): Probability of answering 429 instead.
+        retry_after (float): Seconds sent in the Retry-After header of 429 responses.
+        poll_interval_ms (int): Document Intelligence only, retry-after-ms sent while an operation runs.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.1, throttle_rate=0.0, retry_after=1.0, poll_interval_ms=200):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.poll_interval_ms = poll_interval_ms
+
+    def sample_latency(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _maybe_throttle(self):
+        config = self.server.stub_config
+        if config.throttle_rate and random.random() < config.throttle_rate:
+            self.server.count("throttled")
+            self._send_json(
+                429,
+                {"error": {"code": "429", "message": "Rate limit is exceeded (stub)."}},
+                {"Retry-After": str(int(config.retry_after)), "retry-after-ms": str(int(config.retry_after * 1000))},
+            )
+            return True
+        return False
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, stub_config):
+        super().__init__(address, handler)
+        self.stub_config = stub_config
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+
+CANNED_ANALYZE_RESULT = {
+    "apiVersion": "2024-11-30",
+    "modelId": "prebuilt-invoice",
+    "content": (
+        "ACME EQUIPMENT RENTALS\nINVOICE\nInvoice # INV-1001\nDate: 01/15/2024\n"
+        "Ship To: Armstrong Cal Builders - Job 2410 Mira Costa\n"
+        "Excavator rental 1 day 450.00 450.00\nDelivery 1 75.00 75.00\n"
+        "TOTAL $525.00\nApproved - SH\n"
+    ),
+    "pages": [],
+    "documents": [
+        {
+            "docType": "invoice",
+            "confidence": 0.98,
+            "fields": {
+                "VendorAddressRecipient": {"type": "string", "valueString": "ACME EQUIPMENT RENTALS", "content": "ACME EQUIPMENT RENTALS", "confidence": 0.93},
+                "InvoiceDate": {"type": "date", "valueDate": "2024-01-15", "content": "01/15/2024", "confidence": 0.97},
+                "InvoiceTotal": {"type": "currency", "valueCurrency": {"amount": 525.0, "currencyCode": "USD"}, "content": "$525.00", "confidence": 0.95},
+                "InvoiceId": {"type": "string", "valueString": "INV-1001", "content": "INV-1001", "confidence": 0.96},
+            },
+        }
+    ],
+}
+
+
+class DocumentIntelligenceStubHandler(_StubHandler):
+    """POST ...:analyze starts an operation; GET .../analyzeResults/<id> polls it."""
+
+    def do_POST(self):
+        self._read_body()
+        self.server.count("requests")
+        if ":analyze" not in self.path:
+            self._send_json(404, {"error": {"code": "NotFound", "message": self.path}})
+            return
+        if self._maybe_throttle():
+            return
+        operation_id = uuid.uuid4().hex
+        with self.server._lock:
+            self.server.operations[operation_id] = time.monotonic() + self.server.stub_config.sample_latency()
+        model_path = self.path.split("?")[0].split(":analyze")[0]
+        location = f"http://{self.headers.get('Host')}{model_path}/analyzeResults/{operation_id}?api-version=2024-11-30"
+        self.server.count("analyze")
+        self.send_response(202)
+        self.send_header("Operation-Location", location)
+        self.send_header("retry-after-ms", str(self.server.stub_config.poll_interval_ms))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.count("requests")
+        match = re.search(r"/analyzeResults/([0-9a-f]+)", self.path)
+        if not match:
+            self._send_json(404, {"error": {"code": "NotFound", "message": self.path}})
+            return
+        with self.server._lock:
+            ready_at = self.server.operations.get(match.group(1))
+        if ready_at is None:
+            self._send_json(404, {"error": {"code": "NotFound", "message": "Unknown operation."}})
+            return
+        self.server.count("polls")
+        if time.monotonic() < ready_at:
+            self._send_json(
+                200, {"status": "running"},
+                {"retry-after-ms": str(self.server.stub_config.poll_interval_ms)},
+            )
+            return
+        with self.server._lock:
+            self.server.operations.pop(match.group(1), None)
+        self._send_json(200, {"status": "succeeded", "analyzeResult": CANNED_ANALYZE_RESULT})
+
+
+def _canned_arguments(function_name, messages):
+    # Answers shaped like the response models in model.py.
+    details = {"expense_type": "Rental", "approval": "Approved", "job_location": "Job 2410 Mira Costa"}
+    if function_name == "PackedInvoiceDetailsList":
+        text = " ".join(str(message.get("content")) for message in messages)
+        ids = re.findall(r"## Invoice (\S+)", text)
+        return {"invoices": [dict(details, invoice_id=invoice_id) for invoice_id in ids]}
+    if function_name == "InvoiceHeader":
+        return {
+            "vendor_name": "ACME EQUIPMENT RENTALS",
+            "invoice_date": "2024-01-15",
+            "total_amount": 525.0,
+            "currency_code": "USD",
+            "invoice_number": "INV-1001",
+        }
+    return details
+
+
+class ChatCompletionsStubHandler(_StubHandler):
+    """POST .../chat/completions answers with a tool call matching the requested response model."""
+
+    def do_POST(self):
+        request = json.loads(self._read_body() or b"{}")
+        self.server.count("requests")
+        if not self.path.split("?")[0].endswith("/chat/completions"):
+            self._send_json(404, {"error": {"code": "NotFound", "message": self.path}})
+            return
+        if self._maybe_throttle():
+            return
+        time.sleep(self.server.stub_config.sample_latency())
+
+        messages = request.get("messages", [])
+        tools = request.get("tools") or []
+        function_name = tools[0]["function"]["name"] if tools else "InvoiceDetails"
+        arguments = json.dumps(_canned_arguments(function_name, messages))
+        prompt_tokens = sum(len(str(message.get("content"))) for message in messages) // 4
+        completion_tokens = len(arguments) // 4
+        self.server.count("completions")
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o-mini"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "tool_calls" if tools else "stop",
+                "message": {
+                    "role": "assistant",
+                    "content": None if tools else arguments,
+                    "tool_calls": [{
+                        "id": f"call_{uuid.uuid4().hex[:12]}",
+                        "type": "function",
+                        "function": {"name": function_name, "arguments": arguments},
+                    }] if tools else None,
+                },
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+
+def start_stub_server(handler, stub_config, host="127.0.0.1", port=0):
+    """
+    Starts a stub server on a background thread.
+
+    Returns:
+        tuple: (server, base_url); call `server.shutdown()` to stop it.
+    """
+    server = _StubServer((host, port), handler, stub_config)
+    server.operations = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
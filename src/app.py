@@ -1,12 +1,21 @@
 import streamlit as st
-import uuid
 import os
 import sys
-import subprocess
 import dotenv
 
-from cogservice import extract_fields_from_invoice, generate_invoice_excel
-from batch_cogservice import batch_extract_fields_from_invoices, generate_batch_invoices_excel
+from cogservice import extract_invoices, generate_invoice_excel, analyze_cache
+from model import details_cache, extract_invoice_details
+from journal import get_journal
+from duplicates import get_duplicate_index
+from history import record_history
+from batch_cogservice import batch_excel_path, build_invoice_row, process_batch_invoices_excel, write_invoices_excel
+from jobs import CANCELLED, DONE, FAILED, RUNNING, Job, get_job_runner, job_key
+from metrics import metrics
+from upload_store import get_upload_store
+from warmup import start_prewarm
+
+# Seconds between refreshes of the job panel (and the sidebar stats) while a background job is running.
+JOB_POLL_SECONDS = 1.0
 
 def check_and_prompt_env_vars():
     required_vars = [
@@ -29,10 +38,12 @@ def check_and_prompt_env_vars():
             for key, value in env_values.items():
                 if value:
                     f.write(f"{key}={value}\n")
+        # Drop pooled clients built with the old keys.
+        from clients import reset_clients
+        reset_clients()
         
         st.success("Environment variables saved. Please restart the app.")
         st.stop()
-    print(env_values)
     return env_values
 
 def get_temp_dir():
@@ -46,26 +57,180 @@ def get_temp_dir():
     os.makedirs(temp_path, exist_ok=True)
     return temp_path
 
-def save_uploaded_file(uploaded_file):
-    """Saves an uploaded file to a safe temp directory and returns the file path."""
+def save_uploaded_file(uploaded_file, data=None):
+    """
+    Stores an upload in the managed upload store and returns its path.
+
+    The store is content-addressed, so the same file uploaded again (or a rerun) is not written twice.
+
+    Args:
+        uploaded_file: The Streamlit upload.
+        data (bytes): The upload's bytes, when they were read already.
+    """
     try:
-        temp_dir = get_temp_dir()
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_filename = f"{uuid.uuid4()}.pdf"
-        temp_filepath = os.path.join(temp_dir, temp_filename)
-        file_data = uploaded_file.getvalue()
-        with open(temp_filepath, "wb") as f:
-            f.write(file_data)
-
-        if os.path.exists(temp_filepath):
-            return temp_filepath
-        else:
-            st.error(f"File save failed: `{temp_filepath}` does not exist!")
-            return None
+        data = uploaded_file.getvalue() if data is None else data
+        return get_upload_store().put(data)
     except Exception as e:
         st.error(f"An error occurred while saving the uploaded file: {e}")
         return None
 
+def show_cache_panel():
+    """Shows OCR and LLM cache counters in the sidebar and returns whether the caches should be used."""
+    st.sidebar.subheader("Cache")
+    use_cache = not st.sidebar.checkbox("Bypass cache", value=False)
+    for label, cache in (("OCR", analyze_cache), ("LLM", details_cache)):
+        stats = cache.stats()
+        st.sidebar.write(
+            f"{label} - Hits: {stats['hits']} | Misses: {stats['misses']} | "
+            f"Hit rate: {stats['hit_rate']:.0%}"
+        )
+        st.sidebar.write(f"Entries: {stats['entries']} ({stats['bytes'] / 1024 / 1024:.1f} MB)")
+    return use_cache
+
+def render_stats():
+    """Renders per-stage timings and counters from `metrics`."""
+    report = metrics.run_report()
+    if report["stages"]:
+        st.table([
+            {"Stage": stage, "Count": stats["count"], "p50 (s)": stats["p50"], "p95 (s)": stats["p95"], "Errors": stats["errors"]}
+            for stage, stats in report["stages"].items()
+        ])
+    for name, value in {**report["counters"], **report["gauges"]}.items():
+        st.write(f"{name}: {value}")
+
+def show_stats_panel(live=False):
+    """Shows the pipeline stats in the sidebar; while `live` (a job is running) only they refresh, as a fragment."""
+    st.sidebar.subheader("Pipeline Stats")
+    with st.sidebar:
+        st.fragment(render_stats, run_every=JOB_POLL_SECONDS if live else None)()
+    st.sidebar.download_button(
+        "Download metrics (Prometheus)", metrics.prometheus_text(), file_name="invoice_tool.prom", mime="text/plain"
+    )
+
+def run_single_job(job, config, use_cache, documents):
+    """
+    Background job target for one uploaded PDF: extract its fields and write its Excel file.
+
+    The PDF is analyzed from the upload's bytes in `documents`; the stored copy is only linked
+    from the workbook. A PDF holding several invoices is written as a workbook with one row per invoice.
+    """
+    (file_path,) = job.invoices
+    job.set_invoice_status(file_path, RUNNING)
+    parts = extract_invoices(file_path, config=config, use_cache=use_cache, document=documents.get(file_path))
+    if not parts or not parts[0][0]:
+        job.add_row(file_path, build_invoice_row(file_path, None, None))
+        raise RuntimeError("No fields could be extracted from the invoice.")
+    if len(parts) == 1:
+        extracted_data, invoice_text, _ = parts[0]
+        details = extract_invoice_details(invoice_text, extracted_data, config, use_cache=use_cache)
+        excel_path = generate_invoice_excel(
+            extracted_data, invoice_text, file_path, config=config, use_cache=use_cache, details=details
+        )
+        job.add_row(file_path, build_invoice_row(file_path, parts[0], details))
+        return excel_path
+    rows = []
+    history = []
+    for part in parts:
+        details = extract_invoice_details(part[1], part[0], config, use_cache=use_cache)
+        row = build_invoice_row(file_path, part, details)
+        rows.append(row)
+        history.append((file_path, part, details, None, None))
+        job.add_row(file_path, row)
+    excel_path = write_invoices_excel(rows, batch_excel_path(get_temp_dir()))
+    record_history(history)
+    return excel_path
+
+def run_batch_job(job, config, use_cache, documents):
+    """Background job target for a batch: stream every invoice through the pipeline into one workbook."""
+    return process_batch_invoices_excel(
+        list(job.invoices), config=config, use_cache=use_cache, on_row=job.add_row,
+        cancel_event=job.cancel_event, journal=get_journal(), duplicate_index=get_duplicate_index(),
+        documents=documents,
+    )
+
+def submit_job(kind, uploaded_files, target):
+    """
+    Returns the job for these uploads, submitting it first if it is not known yet.
+
+    Jobs are keyed by the content of the uploads, so a rerun with the same files
+    reattaches to the running job instead of saving and processing them again.
+    The job id is remembered in the session by the uploads' file ids, so the polling
+    reruns of a running job do not hash the uploads again.
+    Uploads with the same content are processed once. `target(job, documents)` gets the
+    upload bytes by stored path, so the job analyzes them without reading them back from disk;
+    the stored files are kept from eviction while the job runs.
+    """
+    runner = get_job_runner()
+    session_jobs = st.session_state.setdefault("job_ids", {})
+    session_key = (kind, tuple(uploaded_file.file_id for uploaded_file in uploaded_files))
+    job = runner.get(session_jobs[session_key]) if session_key in session_jobs else None
+    if job is not None:
+        return job
+    uploads = [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+    job_id = job_key(kind, [data for _, data in uploads])
+    session_jobs[session_key] = job_id
+    job = runner.get(job_id)
+    if job is not None:
+        return job
+    invoices = {}
+    documents = {}
+    for uploaded_file, (name, data) in zip(uploaded_files, uploads):
+        temp_filepath = save_uploaded_file(uploaded_file, data)
+        if temp_filepath:
+            invoices.setdefault(temp_filepath, name)
+            documents[temp_filepath] = data
+    if not invoices:
+        return None
+
+    def run(job):
+        with get_upload_store().hold(job.invoices):
+            return target(job, documents)
+
+    return runner.submit(Job(job_id, kind, invoices), run)
+
+def show_job(job):
+    """
+    Shows a job's progress, per-invoice status and rows.
+
+    While the job runs the panel is a fragment that refreshes itself every JOB_POLL_SECONDS,
+    so polling does not rerun (and re-render) the rest of the app.
+    """
+    polling = not job.finished
+    st.fragment(job_panel, run_every=JOB_POLL_SECONDS if polling else None)(job, polling)
+
+def job_panel(job, polling):
+    snapshot = job.snapshot()
+    total = snapshot["total"] or 1
+    progress_text = f"Processed {snapshot['completed']} of {snapshot['total']} invoices ({snapshot['elapsed_seconds']}s)"
+    st.progress(snapshot["completed"] / total, text=progress_text)
+
+    if job.finished:
+        if st.button("Run again"):
+            get_job_runner().forget(job.job_id)
+            st.rerun()
+    elif st.button("Cancel"):
+        job.cancel()
+
+    st.dataframe(
+        [{"Invoice": invoice["name"], "Status": invoice["status"]} for invoice in snapshot["invoices"]],
+        use_container_width=True,
+    )
+    if snapshot["rows"]:
+        st.dataframe(
+            [{key: value for key, value in row.items() if key != "Invoice Path"} for row in snapshot["rows"]],
+            use_container_width=True,
+        )
+
+    if snapshot["status"] == DONE:
+        st.success(f"Processing complete. Excel file saved at: `{snapshot['result']}`")
+    elif snapshot["status"] == CANCELLED:
+        st.warning(f"Job cancelled. Completed rows were saved at: `{snapshot['result']}`")
+    elif snapshot["status"] == FAILED:
+        st.error(f"Job failed: {snapshot['error']}")
+    if polling and job.finished:
+        # One full rerun once the job is over: it stops the polling and refreshes the sidebar.
+        st.rerun()
+
 def main():
     config = check_and_prompt_env_vars()
     
@@ -73,33 +238,36 @@ def main():
         st.error("All required environment variables must be set before uploading data.")
         return
     
+    start_prewarm(config)
+    # The first use cleans up the upload store, including upload copies left by earlier versions.
+    get_upload_store(legacy_dir=get_temp_dir())
+    use_cache = show_cache_panel()
+
     st.title("Invoice Extraction Internal Tool")
     st.write("Select a processing mode below:")
     
     mode = st.radio("Select Processing Mode", ["Single Invoice", "Batch Invoices"])
+    job = None
     
     if mode == "Single Invoice":
         st.subheader("Single Invoice Processing")
         uploaded_file = st.file_uploader("Upload your invoice (PDF)", type=["pdf"])
         
         if uploaded_file:
-            temp_filepath = save_uploaded_file(uploaded_file)
-            if temp_filepath:
-                extracted_data, invoice_text = extract_fields_from_invoice(temp_filepath, config=config)
-                if extracted_data:
-                    excel_path = generate_invoice_excel(extracted_data, invoice_text, temp_filepath, config=config)
-                    st.success(f"Excel file saved at: `{excel_path}`")
+            job = submit_job("single", [uploaded_file], lambda job, documents: run_single_job(job, config, use_cache, documents))
+            if job:
+                show_job(job)
     
     else:  # Batch Invoices mode
         st.subheader("Batch Invoices Processing")
         uploaded_files = st.file_uploader("Upload invoice PDFs", type=["pdf"], accept_multiple_files=True)
         
         if uploaded_files:
-            batch_file_paths = [save_uploaded_file(file) for file in uploaded_files if file]
-            if batch_file_paths:
-                batch_results = batch_extract_fields_from_invoices(batch_file_paths, config=config, parallel=True)
-                batch_excel = generate_batch_invoices_excel(batch_results, config=config)
-                st.success(f"Batch processing complete. Excel file saved at: `{batch_excel}`")
+            job = submit_job("batch", [file for file in uploaded_files if file], lambda job, documents: run_batch_job(job, config, use_cache, documents))
+            if job:
+                show_job(job)
+
+    show_stats_panel(live=job is not None and not job.finished)
 
 if __name__ == "__main__":
     main()
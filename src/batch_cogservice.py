@@ -1,152 +1,847 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from cogservice import extract_fields_from_invoice
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cogservice import FIELDS_TO_EXTRACT, aextract_invoices
+import datetime
 import os
-import pandas as pd
-from openpyxl.styles import PatternFill, Font
-from openpyxl.utils import get_column_letter
+import uuid
 from config import settings
-from model import extract_invoice_details
+from excel_writer import StreamingInvoiceWriter
+from history import record_history
+from duplicates import EXACT, LIKELY, describe_duplicate, invoice_key
+from journal import LLM_DONE, file_hash
+from metrics import metrics
+from model import InvoiceDetails, aextract_invoice_details_packed
+from ratelimit import get_scheduler
+from text_layer import describe_route, new_decision
 
 
-config = settings.get_settings()
-endpoint = config.document_intelligence.endpoint
-key = config.document_intelligence.api_key
+def run_sync(coro):
+    """
+    Runs a coroutine to completion from synchronous code.
+
+    If the calling thread already has a running event loop (e.g. a notebook), the
+    coroutine is run on a fresh loop in a worker thread instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+async def abatch_extract(invoice_file_paths, config, concurrency=None, use_cache=True, polling_interval=None, journal=None, job_id=None, file_keys=None):
+    """
+    Extracts the fields of many invoices concurrently on a single event loop.
 
+    A PDF may hold several invoices; each file maps to the list of invoices found in it.
 
-def batch_extract_fields_from_invoices(invoice_file_paths, parallel=True):
+    Args:
+        invoice_file_paths (list): List of file paths to the invoice files.
+        config (dict): Environment values with the Document Intelligence endpoint and key.
+        concurrency (int): Maximum number of invoices in flight; defaults to `max_concurrency` from settings.
+        use_cache (bool): If False, bypass the analyze cache for every file.
+        polling_interval (float): Seconds between LRO status polls; defaults to the service's Retry-After.
+        journal (JobJournal): Optional journal; invoices with a recorded OCR result are not analyzed again.
+        job_id (str): Job to resume; defaults to the id derived from the files' contents.
+        file_keys (dict): Optional dict that receives the journal item key (sha256) of each file,
+                          to pass on to `abatch_extract_invoice_details` so it does not hash the files again.
+
+    Returns:
+        dict: A dictionary mapping each invoice file path to a list of
+              (extracted_fields, invoice_text, pages) parts. If a file fails processing, its value will be None.
+    """
+    di_endpoint = config['DOCUMENT_INTELLIGENCE_ENDPOINT']
+    di_key = config['DOCUMENT_INTELLIGENCE_API_KEY']
+    if not di_endpoint or not di_key:
+        raise ValueError("DOCUMENTINTELLIGENCE_ENDPOINT and DOCUMENTINTELLIGENCE_API_KEY must be set in .env.")
+
+    concurrency = concurrency or settings.get_settings().max_concurrency
+    semaphore = asyncio.Semaphore(concurrency)
+    results = {file_path: None for file_path in invoice_file_paths}
+    item_keys = {}
+    todo = list(invoice_file_paths)
+    if journal is not None:
+        job_id, item_keys = await asyncio.to_thread(journal.start_job, invoice_file_paths, job_id)
+        if file_keys is not None:
+            file_keys.update(item_keys)
+        recorded = {item["item_key"]: item["parts"] for item in await asyncio.to_thread(journal.items, job_id)}
+        for file_path, item_key in item_keys.items():
+            results[file_path] = recorded.get(item_key)
+        todo = [file_path for file_path in invoice_file_paths if results[file_path] is None]
+        if not todo:
+            return results
+    scheduler = get_scheduler("document_intelligence")
+    from clients import async_document_client
+
+    async with async_document_client(
+        di_endpoint, di_key, pool_size=concurrency, raw_response_hook=scheduler.observe_response
+    ) as client:
+        async def extract(file_path):
+            async with semaphore:
+                error = "Processing failed"
+                try:
+                    results[file_path] = await aextract_invoices(
+                        file_path, client, use_cache=use_cache, polling_interval=polling_interval, scheduler=scheduler
+                    )
+                except Exception as e:
+                    print(f"Error processing {file_path}: {e}")
+                    error = e
+                if journal is not None:
+                    if results[file_path] is None:
+                        await asyncio.to_thread(journal.mark_failed, job_id, item_keys[file_path], "ocr", error)
+                    else:
+                        await asyncio.to_thread(journal.mark_ocr_done, job_id, item_keys[file_path], results[file_path])
+
+        await asyncio.gather(*(extract(file_path) for file_path in todo))
+
+    return results
+
+
+async def abatch_extract_invoice_details(batch_results, config, concurrency=None, use_cache=True, journal=None, job_id=None, file_keys=None):
+    """
+    Runs the LLM enrichment for every successfully extracted invoice concurrently,
+    packing several invoices into each call (see `model.aextract_invoice_details_packed`).
+
+    Args:
+        batch_results (dict): Output of `abatch_extract`.
+        config (dict): Environment values with the Azure OpenAI url and key.
+        concurrency (int): Maximum number of packs in flight; defaults to `max_concurrency` from settings.
+        use_cache (bool): If False, bypass the LLM enrichment cache.
+        journal (JobJournal): Optional journal; files with recorded details are not sent to the LLM again.
+        job_id (str): Job the invoices were registered under by `abatch_extract`; defaults to the id
+                      derived from the files' contents, as there.
+        file_keys (dict): Item keys filled in by `abatch_extract`; files without one are hashed.
+
+    Returns:
+        dict: Invoice file path to a list with the InvoiceDetails dict of each of its invoices
+              (None for an invoice whose enrichment failed).
+    """
+    concurrency = concurrency or settings.get_settings().max_concurrency
+    semaphore = asyncio.Semaphore(concurrency)
+    details = {}
+    journal_items = {}
+    if journal is not None:
+        job_id, item_keys = await asyncio.to_thread(journal.start_job, list(batch_results), job_id, file_keys)
+        recorded = {item["item_key"]: item for item in await asyncio.to_thread(journal.items, job_id)}
+        journal_items = {file_path: recorded[item_key] for file_path, item_key in item_keys.items()}
+        for file_path, item in journal_items.items():
+            if item["state"] == LLM_DONE:
+                details[file_path] = item["details"]
+    pending = {
+        file_path: parts
+        for file_path, parts in batch_results.items()
+        if parts is not None and file_path not in details
+    }
+    if not pending:
+        return details
+    for file_path, parts in pending.items():
+        details[file_path] = [None] * len(parts)
+    scheduler = get_scheduler("azure_openai")
+    errors = {}
+    from clients import async_llm_client
+
+    async with async_llm_client(
+        config['AZURE_API_KEY'], config['AZURE_URL'], settings.get_settings().azure_api_version, pool_size=concurrency
+    ) as client:
+        async def enrich(chunk):
+            async with semaphore:
+                answers = await aextract_invoice_details_packed(
+                    [(key, part[1], part[0]) for key, part in chunk],
+                    config, use_cache=use_cache, async_client=client, scheduler=scheduler,
+                )
+            for (file_path, index), _ in chunk:
+                answer = answers.get((file_path, index))
+                if isinstance(answer, Exception):
+                    print(f"Error enriching {file_path}: {answer}")
+                    errors[file_path] = answer
+                else:
+                    details[file_path][index] = answer
+
+        # Every invoice of every file is packed on its own, keyed by (file path, index in the file).
+        items = [
+            ((file_path, index), part)
+            for file_path, parts in pending.items()
+            for index, part in enumerate(parts)
+        ]
+        pack_size = settings.get_settings().llm_pack_max_invoices
+        await asyncio.gather(*(enrich(items[i:i + pack_size]) for i in range(0, len(items), pack_size)))
+
+    for file_path in pending:
+        item = journal_items.get(file_path)
+        if not item:
+            continue
+        if file_path in errors:
+            await asyncio.to_thread(journal.mark_failed, job_id, item["item_key"], "llm", errors[file_path])
+        else:
+            await asyncio.to_thread(journal.mark_llm_done, job_id, item["item_key"], details[file_path])
+
+    return details
+
+
+def batch_extract_fields_from_invoices(invoice_file_paths, config, parallel=True, use_cache=True, max_workers=None, journal=None, job_id=None, file_keys=None):
     """
     Processes a list of invoice files in batch and extracts their fields.
 
+    Thin synchronous wrapper over `abatch_extract`.
+
     Args:
         invoice_file_paths (list): List of file paths to the invoice files.
+        config (dict): Environment values with the Document Intelligence endpoint and key.
         parallel (bool): If True, process files concurrently.
+        use_cache (bool): If False, bypass the analyze cache for every file.
+        max_workers (int): Number of invoices in flight; defaults to `max_concurrency` from settings.
+        journal (JobJournal): Optional journal to record and resume progress.
+        job_id (str): Job to resume; defaults to the id derived from the files' contents.
+        file_keys (dict): Optional dict that receives each file's item key; pass it on to
+                          `generate_batch_invoices_excel` so the files are hashed only once.
+
+    Returns:
+        dict: A dictionary mapping each invoice file path to a list of
+              (extracted_fields, invoice_text, pages) parts. If a file fails processing, its value will be None.
+    """
+    concurrency = max_workers if parallel else 1
+    return run_sync(abatch_extract(
+        invoice_file_paths, config, concurrency=concurrency, use_cache=use_cache, journal=journal, job_id=job_id,
+        file_keys=file_keys,
+    ))
+
+
+def _journal_work(invoice_file_paths, journal, job_id, item_keys=None):
+    """
+    Splits a batch into finished and pending work, using the journal when one is given.
+
+    Journal items are keyed by content, so byte-identical files of the batch share one item:
+    only the first of them is processed and the others get its result.
+
+    Args:
+        item_keys (dict): File path to its item key, as returned by `JobJournal.start_job`.
 
     Returns:
-        dict: A dictionary mapping each invoice file path to a tuple:
-              (extracted_fields, invoice_text). If a file fails processing, its value will be None.
-    """
-    results = {}
-
-    if parallel:
-        # Process invoices concurrently using a ThreadPoolExecutor
-        with ThreadPoolExecutor() as executor:
-            future_to_file = {
-                executor.submit(extract_fields_from_invoice, file_path): file_path
-                for file_path in invoice_file_paths
-            }
-            for future in as_completed(future_to_file):
-                file_path = future_to_file[future]
+        tuple: (finished, pending, copies), where finished holds (invoice_path, parts, details) tuples,
+               pending holds (invoice_path, item_key, parts) with parts None if OCR is still due, and
+               copies maps the path of a processed file to the other paths with the same content.
+    """
+    if journal is None:
+        return [], [(file_path, None, None) for file_path in invoice_file_paths], {}
+    items = {item["item_key"]: item for item in journal.items(job_id)}
+    finished, pending, copies, first_paths = [], [], {}, {}
+    for file_path in invoice_file_paths:
+        item_key = item_keys[file_path]
+        if item_key in first_paths:
+            copies.setdefault(first_paths[item_key], []).append(file_path)
+            continue
+        first_paths[item_key] = file_path
+        item = items[item_key]
+        if item["state"] == LLM_DONE:
+            finished.append((file_path, item["parts"], item["details"]))
+        else:
+            pending.append((file_path, item_key, item["parts"]))
+    return finished, pending, copies
+
+
+async def apipeline(invoice_file_paths, config, ocr_concurrency=None, llm_concurrency=None, use_cache=True, queue_size=None, journal=None, job_id=None, routes=None, prompt_reports=None, duplicate_index=None, duplicates=None, documents=None, file_keys=None, errors=None):
+    """
+    Staged OCR -> LLM pipeline: each invoice moves on to enrichment as soon as its OCR finishes.
+
+    A file may hold several invoices (see `cogservice.aextract_invoices`); each of them is
+    enriched on its own and the file is yielded once all of its invoices are done.
+
+    Each stage has its own pool of worker tasks; the OCR stage feeds the LLM stage
+    through a bounded queue so a fast OCR stage cannot run arbitrarily far ahead.
+    LLM workers pack the invoices that are ready into multi-invoice calls
+    (see `model.aextract_invoice_details_packed`).
+
+    With a journal, every stage transition is recorded durably: invoices that already
+    finished are yielded from the journal without any remote call, and invoices whose
+    OCR finished earlier go straight to the LLM stage.
+
+    With a duplicate index (see `duplicates.DuplicateIndex`), a byte-identical copy of an
+    earlier file is answered from the index without any remote call, and an invoice whose
+    normalized (vendor, number, total, date) key is known reuses the earlier details
+    instead of calling the LLM. Every fully processed file is added to the index.
+
+    Args:
+        invoice_file_paths (list): List of file paths to the invoice files.
+        config (dict): Environment values with the Document Intelligence and Azure OpenAI settings.
+        ocr_concurrency (int): Number of OCR workers; defaults to `max_concurrency` from settings.
+        llm_concurrency (int): Number of LLM workers; defaults to `max_concurrency` from settings.
+        use_cache (bool): If False, bypass the analyze and LLM caches.
+        queue_size (int): Capacity of the queue between the stages; defaults to two full packs per LLM worker.
+        journal (JobJournal): Optional journal to record and resume progress.
+        job_id (str): Job to resume; defaults to the id derived from the files' contents.
+        routes (dict): Optional dict that receives each file's routing decision
+                       (text layer, OCR, cache or journal) before it is yielded.
+        prompt_reports (dict): Optional dict that receives the prompt compaction report
+                               (tokens_before/tokens_after) of each invoice, keyed by
+                               (invoice_path, index in the file), when an LLM call was made.
+        duplicate_index (DuplicateIndex): Optional index used to skip duplicates; lookups are skipped
+                                          when `use_cache` is False, but files are still added.
+        duplicates (dict): Optional dict that receives a description of each invoice found to be
+                           a duplicate, keyed by (invoice_path, index in the file).
+        documents (dict): Optional invoice path to its PDF as bytes or a file-like object (e.g. the
+                          uploads held in memory by the app); those files are analyzed without being
+                          read back from disk.
+        file_keys (dict): Optional dict that receives the sha256 of each file's bytes (see
+                          `journal.file_hash`) where the pipeline computed it for the journal
+                          or the duplicate index, so later steps need not hash the file again.
+        errors (dict): Optional dict that receives the reason each invoice's enrichment failed,
+                       keyed by (invoice_path, index in the file).
+
+    Yields:
+        tuple: (invoice_path, parts, details) in completion order, where parts is the list of
+               (extracted_fields, invoice_text, pages) found in the file or None, and details
+               holds the InvoiceDetails dict of each part (None where enrichment failed).
+    """
+    if not invoice_file_paths:
+        return
+    item_keys = None
+    if journal is not None:
+        job_id, item_keys = await asyncio.to_thread(journal.start_job, invoice_file_paths, job_id)
+        if file_keys is not None:
+            file_keys.update(item_keys)
+    finished, pending, copies = await asyncio.to_thread(_journal_work, invoice_file_paths, journal, job_id, item_keys)
+
+    def with_copies(item):
+        # Files of the batch with the same bytes as this one share its journal item and its result.
+        yield item
+        file_path, parts, details = item
+        for copy in copies.get(file_path, ()):
+            if routes is not None:
+                routes[copy] = new_decision("duplicate", f"same content as {file_path}")
+            metrics.incr("duplicates", kind=EXACT)
+            if duplicates is not None:
+                for index in range(len(parts or ())):
+                    duplicates[(copy, index)] = describe_duplicate(EXACT, file_path)
+            if errors is not None:
+                for index in range(len(parts or ())):
+                    if (file_path, index) in errors:
+                        errors[(copy, index)] = errors[(file_path, index)]
+            yield copy, parts, details
+
+    for item in finished:
+        if routes is not None:
+            routes[item[0]] = new_decision("journal", "finished in an earlier run")
+        metrics.incr("invoices", status="journal")
+        for each in with_copies(item):
+            yield each
+    if not pending:
+        return
+
+    settings_ = settings.get_settings()
+    ocr_concurrency = ocr_concurrency or settings_.max_concurrency
+    llm_concurrency = llm_concurrency or settings_.max_concurrency
+    queue_size = queue_size or 2 * llm_concurrency * settings_.llm_pack_max_invoices
+    loop = asyncio.get_running_loop()
+
+    ocr_queue = asyncio.Queue()
+    for work in pending:
+        ocr_queue.put_nowait(work)
+    llm_queue = asyncio.Queue(maxsize=queue_size)
+    done_queue = asyncio.Queue()
+    # Files whose invoices are still being enriched: their parts, details so far and open count.
+    files = {}
+    ocr_scheduler = get_scheduler("document_intelligence")
+    llm_scheduler = get_scheduler("azure_openai")
+    from clients import async_document_client, async_llm_client
+
+    async with async_document_client(
+        config['DOCUMENT_INTELLIGENCE_ENDPOINT'], config['DOCUMENT_INTELLIGENCE_API_KEY'], pool_size=ocr_concurrency,
+        raw_response_hook=ocr_scheduler.observe_response,
+    ) as doc_client, async_llm_client(
+        config['AZURE_API_KEY'], config['AZURE_URL'], settings_.azure_api_version, pool_size=llm_concurrency
+    ) as llm_client:
+
+        # Journal and duplicate index calls are SQLite commits: run them off the event loop so
+        # they do not stall the other workers.
+        async def finish_file(file_path, item_key, state):
+            if journal is not None:
+                if state["error"] is not None:
+                    await asyncio.to_thread(journal.mark_failed, job_id, item_key, "llm", state["error"])
+                else:
+                    await asyncio.to_thread(journal.mark_llm_done, job_id, item_key, state["details"])
+            if duplicate_index is not None and state["error"] is None:
+                await asyncio.to_thread(duplicate_index.add, state["key"], file_path, state["parts"], state["details"])
+            await done_queue.put((file_path, state["parts"], state["details"]))
+
+        async def finish_duplicate_file(file_path, item_key, original):
+            # A byte-identical copy of a file processed before: no OCR and no LLM call.
+            if routes is not None:
+                routes[file_path] = new_decision("duplicate", f"same content as {original['invoice_path']}")
+            metrics.incr("duplicates", kind=EXACT)
+            if duplicates is not None:
+                for index in range(len(original["parts"])):
+                    duplicates[(file_path, index)] = describe_duplicate(EXACT, original["invoice_path"])
+            if journal is not None:
+                await asyncio.to_thread(journal.mark_ocr_done, job_id, item_key, original["parts"])
+                await asyncio.to_thread(journal.mark_llm_done, job_id, item_key, original["details"])
+            await done_queue.put((file_path, original["parts"], original["details"]))
+
+        async def fail_file(file_path, item_key, error):
+            print(f"Error processing {file_path}: {error}")
+            if journal is not None:
+                await asyncio.to_thread(journal.mark_failed, job_id, item_key, "ocr", error)
+            await done_queue.put((file_path, None, None))
+
+        async def split_likely_duplicates(file_path, file_key, parts):
+            # Invoices whose key is known reuse the earlier details; returns (state, parts left to enrich).
+            state = {"parts": parts, "details": [None] * len(parts), "remaining": len(parts), "error": None, "key": file_key}
+            enrich = []
+            for index, part in enumerate(parts):
+                original = None
+                if duplicate_index is not None and use_cache:
+                    original = await asyncio.to_thread(duplicate_index.find_invoice, invoice_key(part[0]))
+                if original is None or original["content_hash"] == file_key:
+                    enrich.append((index, part))
+                    continue
+                # A re-scan of a known invoice: reuse its details instead of calling the LLM.
+                state["details"][index] = original["details"]
+                state["remaining"] -= 1
+                metrics.incr("duplicates", kind=LIKELY)
+                if duplicates is not None:
+                    duplicates[(file_path, index)] = describe_duplicate(LIKELY, original["invoice_path"], original["pages"])
+            return state, enrich
+
+        async def ocr_worker():
+            while True:
                 try:
-                    result = future.result()
-                    results[file_path] = result
+                    file_path, item_key, parts = ocr_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                file_key = item_key
+                # Everything up to the hand-over to the LLM stage is per file: a file that cannot be
+                # read, hashed, looked up or analyzed becomes an ocr_failed row, not a dead worker.
+                try:
+                    if duplicate_index is not None and file_key is None:
+                        file_key = await asyncio.to_thread(file_hash, file_path)
+                        if file_keys is not None:
+                            file_keys[file_path] = file_key
+                    if parts is None and duplicate_index is not None and use_cache:
+                        original = await asyncio.to_thread(duplicate_index.find_file, file_key)
+                        if original is not None:
+                            await finish_duplicate_file(file_path, item_key, original)
+                            continue
+                    if parts is None:
+                        parts = await aextract_invoices(
+                            file_path, doc_client, use_cache=use_cache, scheduler=ocr_scheduler,
+                            config=config, llm_client=llm_client, llm_scheduler=llm_scheduler, routes=routes,
+                            document=documents.get(file_path) if documents else None,
+                        )
+                        if parts is None:
+                            await fail_file(file_path, item_key, "Processing failed")
+                            continue
+                        if journal is not None:
+                            await asyncio.to_thread(journal.mark_ocr_done, job_id, item_key, parts)
+                    state, enrich = await split_likely_duplicates(file_path, file_key, parts)
                 except Exception as e:
-                    print(f"Error processing {file_path}: {e}")
-                    results[file_path] = None
+                    await fail_file(file_path, item_key, e)
+                    continue
+                if not enrich:
+                    await finish_file(file_path, item_key, state)
+                    continue
+                files[file_path] = state
+                for index, part in enrich:
+                    await llm_queue.put((file_path, item_key, index, part))
+
+        async def next_pack():
+            # Take one invoice, then whatever else arrives within the linger time, up to a full pack.
+            item = await llm_queue.get()
+            if item is None:
+                return [], True
+            pack = [item]
+            deadline = loop.time() + settings_.llm_pack_linger_ms / 1000
+            while len(pack) < settings_.llm_pack_max_invoices:
+                try:
+                    item = await asyncio.wait_for(llm_queue.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    return pack, True
+                pack.append(item)
+            return pack, False
+
+        async def llm_worker():
+            stop = False
+            while not stop:
+                pack, stop = await next_pack()
+                if not pack:
+                    return
+                reports = {}
+                answers = await aextract_invoice_details_packed(
+                    [((file_path, index), part[1], part[0]) for file_path, _, index, part in pack],
+                    config, use_cache=use_cache, async_client=llm_client, scheduler=llm_scheduler,
+                    prompt_reports=reports,
+                )
+                for file_path, item_key, index, _ in pack:
+                    state = files[file_path]
+                    details = answers.get((file_path, index))
+                    if isinstance(details, Exception):
+                        print(f"Error enriching {file_path}: {details}")
+                        state["error"] = details
+                        if errors is not None:
+                            errors[(file_path, index)] = str(details)
+                    else:
+                        state["details"][index] = details
+                    if prompt_reports is not None and (file_path, index) in reports:
+                        prompt_reports[(file_path, index)] = reports[(file_path, index)]
+                    state["remaining"] -= 1
+                    if state["remaining"]:
+                        continue
+                    # The last invoice of the file is done: record and hand over the whole file.
+                    del files[file_path]
+                    await finish_file(file_path, item_key, state)
+
+        ocr_tasks = [asyncio.create_task(ocr_worker()) for _ in range(min(ocr_concurrency, len(pending)))]
+        llm_tasks = [asyncio.create_task(llm_worker()) for _ in range(llm_concurrency)]
+
+        async def close_llm_stage():
+            await asyncio.gather(*ocr_tasks)
+            for _ in llm_tasks:
+                await llm_queue.put(None)
+
+        async def sample_queue_depths():
+            while True:
+                for name, stage_queue in (("ocr", ocr_queue), ("llm", llm_queue), ("done", done_queue)):
+                    metrics.set_gauge("queue_depth", stage_queue.qsize(), queue=name)
+                await asyncio.sleep(0.5)
+
+        closer = asyncio.create_task(close_llm_stage())
+        sampler = asyncio.create_task(sample_queue_depths())
+        tasks = [*ocr_tasks, *llm_tasks, closer, sampler]
+        workers = [*ocr_tasks, *llm_tasks, closer]
+
+        async def next_done():
+            # A worker that crashed (e.g. on a journal write) would never hand over its files:
+            # wait on the workers too and re-raise the first error instead of waiting forever.
+            getter = asyncio.ensure_future(done_queue.get())
+            try:
+                while not getter.done():
+                    running = [task for task in workers if not task.done()]
+                    await asyncio.wait([getter, *running], return_when=asyncio.FIRST_COMPLETED)
+                    for task in workers:
+                        if task.done() and not task.cancelled() and task.exception() is not None:
+                            raise task.exception()
+            finally:
+                if not getter.done():
+                    getter.cancel()
+            return getter.result()
+
+        try:
+            for _ in range(len(pending)):
+                invoice_path, parts, details = await next_done()
+                if parts is None:
+                    metrics.incr("invoices", status="ocr_failed")
+                elif any(answer is None for answer in details):
+                    metrics.incr("invoices", status="llm_failed")
+                else:
+                    metrics.incr("invoices", status="ok")
+                for each in with_copies((invoice_path, parts, details)):
+                    yield each
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for name in ("ocr", "llm", "done"):
+                metrics.set_gauge("queue_depth", 0, queue=name)
+
+
+def iter_batch_invoices(invoice_file_paths, config, cancel_event=None, **pipeline_kwargs):
+    """
+    Synchronous iterator over `apipeline`, which runs on an event loop in a background thread.
+
+    Closing the iterator early (break, exception, or `close()`) cancels the pipeline;
+    progress recorded in a journal is kept, so the batch can be resumed later.
+
+    Args:
+        invoice_file_paths (list): List of file paths to the invoice files.
+        config (dict): Environment values with the Document Intelligence and Azure OpenAI settings.
+        cancel_event (threading.Event): Optional event; once set, the pipeline is cancelled and iteration stops.
+        **pipeline_kwargs: Forwarded to `apipeline`.
+
+    Yields:
+        tuple: (invoice_path, parts, details) as soon as each file completes.
+    """
+    items = queue.Queue()
+    done = object()
+    running = {}
+    stopped = threading.Event()
+
+    def run():
+        async def consume():
+            running["loop"] = asyncio.get_running_loop()
+            running["task"] = asyncio.current_task()
+            if stopped.is_set():
+                return
+            async for item in apipeline(invoice_file_paths, config, **pipeline_kwargs):
+                items.put(item)
+        try:
+            asyncio.run(consume())
+        except asyncio.CancelledError:
+            pass
+        except BaseException as e:
+            items.put(e)
+        finally:
+            items.put(done)
+
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    finished = False
+    try:
+        while True:
+            try:
+                item = items.get(timeout=0.5)
+            except queue.Empty:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                continue
+            metrics.set_gauge("queue_depth", items.qsize(), queue="results")
+            if item is done:
+                finished = True
+                return
+            if isinstance(item, BaseException):
+                finished = True
+                raise item
+            yield item
+            if cancel_event is not None and cancel_event.is_set():
+                return
+    finally:
+        stopped.set()
+        if not finished and "task" in running:
+            # The consumer stopped early: cancel the pipeline and wait for it to wind down.
+            running["loop"].call_soon_threadsafe(running["task"].cancel)
+            worker.join()
+
+
+# Declared column schema of the batch workbook; keys outside it go to the "Other Fields" column.
+BATCH_COLUMNS = [*FIELDS_TO_EXTRACT.keys(), *InvoiceDetails.model_fields.keys(), "Invoice Path", "Pages", "Route", "Prompt Tokens", "Duplicate", "Error"]
+
+
+def batch_excel_path(save_dir):
+    """Returns a new, timestamped workbook path so earlier batches are not overwritten."""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(save_dir, f"batch_extracted_invoices_{timestamp}_{uuid.uuid4().hex[:6]}.xlsx")
+
+
+def build_invoice_row(invoice_path, result, details):
+    """
+    Builds one workbook row from an invoice's extraction result and LLM details.
+
+    Args:
+        invoice_path (str): Path to the invoice file.
+        result (tuple): (extracted_fields, invoice_text) or one (extracted_fields, invoice_text, pages)
+                        part of a multi-invoice file, or None if extraction failed.
+        details (dict): InvoiceDetails dict, or None if enrichment failed (the row gets an Error cell).
+
+    Returns:
+        dict: Column name to cell value.
+    """
+    # Add a hyperlink to the original invoice.
+    row = {"Invoice Path": f'=HYPERLINK("{invoice_path}", "Open Invoice")'}
+    if result is None:
+        # Mark that processing failed for this invoice.
+        row["Error"] = "Processing failed"
+        return row
+
+    extracted_fields = result[0]
+    if len(result) > 2 and result[2]:
+        # Pages of the file this invoice was found on.
+        row["Pages"] = result[2]
+    # Build a row with both the extracted and extra fields.
+    for key, field in extracted_fields.items():
+        row[key] = field["value"]
+    # Merge any extra fields.
+    if details is None:
+        row["Error"] = "Enrichment failed"
     else:
-        # Process invoices sequentially
-        for file_path in invoice_file_paths:
-            results[file_path] = extract_fields_from_invoice(file_path)
+        row.update(details)
+    return row
 
-    return results
-def generate_batch_invoices_excel(batch_results, save_dir="temp_uploads"):
+
+def write_invoices_excel(rows, excel_path):
+    """
+    Writes invoice rows to a styled Excel workbook.
+
+    Args:
+        rows (iterable): Row dicts from `build_invoice_row`; consumed lazily.
+        excel_path (str): Destination path of the workbook.
+
+    Returns:
+        str: Path to the saved Excel workbook.
+    """
+    with StreamingInvoiceWriter(excel_path, BATCH_COLUMNS) as writer:
+        for row in rows:
+            writer.append(row)
+    return excel_path
+
+
+def generate_batch_invoices_excel(batch_results, save_dir="temp_uploads", config=None, use_cache=True, journal=None, job_id=None, file_keys=None):
     """
     Generates a single Excel workbook that summarizes the extracted data for multiple invoices.
 
-    Each row in the Excel sheet corresponds to one invoice.
+    Each row in the Excel sheet corresponds to one invoice; a file holding several invoices gets several rows.
 
     Args:
         batch_results (dict): A dictionary where each key is an invoice file path and each value is
-                              a tuple (extracted_fields, invoice_text).
+                              the list of (extracted_fields, invoice_text, pages) parts found in it.
         save_dir (str): Directory where the Excel file will be saved.
+        config (dict): Environment values with the Azure OpenAI url and key.
+        use_cache (bool): If False, bypass the LLM enrichment cache.
+        journal (JobJournal): Optional journal; recorded details are reused instead of calling the LLM.
+        job_id (str): Job the invoices were registered under by `batch_extract_fields_from_invoices`.
+        file_keys (dict): Item keys filled in by `batch_extract_fields_from_invoices`; used instead of
+                          hashing the files again for the journal and the history.
 
     Returns:
         str: Path to the saved Excel workbook.
     """
     os.makedirs(save_dir, exist_ok=True)
-    rows = []
-
-    for invoice_path, result in batch_results.items():
-        if result is None:
-            # Optionally, add a row indicating that processing failed for this invoice.
-            rows.append({
-                "Invoice File": invoice_path,
-                "Error": "Processing failed"
-            })
+    batch_details = run_sync(abatch_extract_invoice_details(
+        batch_results, config, use_cache=use_cache, journal=journal, job_id=job_id, file_keys=file_keys
+    ))
+    rows = (
+        row
+        for invoice_path, parts in batch_results.items()
+        for _, row in _file_rows(invoice_path, parts, batch_details.get(invoice_path))
+    )
+    excel_path = write_invoices_excel(rows, batch_excel_path(save_dir))
+    record_history(_history_invoices(batch_results, batch_details, file_keys=file_keys))
+    return excel_path
+
+
+def _file_rows(invoice_path, parts, details):
+    """Yields (index, row) for every invoice of a file; a failed file gets a single error row."""
+    if parts is None:
+        yield None, build_invoice_row(invoice_path, None, None)
+        return
+    details = details or []
+    for index, part in enumerate(parts):
+        yield index, build_invoice_row(invoice_path, part, details[index] if index < len(details) else None)
+
+
+def _history_invoices(batch_results, batch_details, routes=None, skip=(), file_keys=None):
+    """
+    Lists the fully enriched invoices of a batch for `history.record_history`, leaving out the `skip` (path, index) pairs.
+
+    `file_keys` maps invoice paths to the sha256 of their bytes where it is known already,
+    so `history.history_record` only hashes the other files.
+    """
+    file_keys = file_keys or {}
+    invoices = []
+    for invoice_path, parts in batch_results.items():
+        details = batch_details.get(invoice_path) or []
+        if parts is None or len(details) != len(parts) or any(answer is None for answer in details):
             continue
+        route = describe_route(routes.get(invoice_path)) if routes is not None else None
+        invoices.extend(
+            (invoice_path, part, answer, route, file_keys.get(invoice_path))
+            for index, (part, answer) in enumerate(zip(parts, details))
+            if (invoice_path, index) not in skip
+        )
+    return invoices
 
-        extracted_fields, invoice_text = result
-        # Get additional details using your custom extraction method.
-        extra_fields = extract_invoice_details(invoice_text, extracted_fields)
-
-        # Build a row with both the extracted and extra fields.
-        row = {}
-        for key, details in extracted_fields.items():
-            row[key] = details["value"]
-        # Merge any extra fields.
-        row.update(extra_fields)
-        # Add a hyperlink to the original invoice.
-        row["Invoice Path"] = f'=HYPERLINK("{invoice_path}", "Open Invoice")'
-        rows.append(row)
-
-    # Create a DataFrame from the aggregated rows.
-    df = pd.DataFrame(rows)
-
-    # Define the output Excel file path.
-    excel_filename = "batch_extracted_invoices.xlsx"
-    excel_path = os.path.join(save_dir, excel_filename)
-
-    # Write the DataFrame to Excel with header and hyperlink styling.
-    with pd.ExcelWriter(excel_path, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Invoice Data")
-        workbook = writer.book
-        sheet = writer.sheets["Invoice Data"]
-
-        header_fill = PatternFill(start_color="228B22", end_color="228B22", fill_type="solid")
-        header_font = Font(color="FFFFFF", bold=True)
-        link_font = Font(color="0000FF", underline="single")
-
-        # Apply header styles and adjust column widths.
-        for col_idx, col in enumerate(df.columns, start=1):
-            cell = sheet.cell(row=1, column=col_idx)
-            cell.fill = header_fill
-            cell.font = header_font
-            sheet.column_dimensions[get_column_letter(col_idx)].width = 25
-
-            # If the column is "Invoice Path", style all cells in that column as hyperlinks.
-            if col == "Invoice Path":
-                for row_idx in range(2, len(df) + 2):
-                    sheet.cell(row=row_idx, column=col_idx).font = link_font
 
-    return excel_path
+def iter_batch_rows(invoice_file_paths, config, use_cache=True, cancel_event=None, **pipeline_kwargs):
+    """
+    Runs the overlapped OCR -> LLM pipeline over a batch and yields a finished row per invoice.
+
+    The rows of a file holding several invoices are yielded together, one per invoice.
+    Fully enriched invoices are appended to the invoice history (see `history`) once the
+    batch ends, also when it is cancelled; invoices finished in an earlier run and
+    duplicates of known invoices are not recorded again.
+
+    Besides the fields from `build_invoice_row`, each row reports how its invoice was read
+    (text layer, OCR, cache, journal or duplicate), the prompt compaction of its LLM call
+    and, with a `duplicate_index`, whether it duplicates an invoice processed before. An invoice
+    whose enrichment failed gets an Error cell with the reason.
 
+    Args:
+        invoice_file_paths (list): List of file paths to the invoice files.
+        config (dict): Environment values with the Document Intelligence and Azure OpenAI settings.
+        use_cache (bool): If False, bypass the analyze and LLM caches.
+        cancel_event (threading.Event): Optional event; once set, the pipeline is cancelled and iteration stops.
+        **pipeline_kwargs: Forwarded to `apipeline`.
+
+    Yields:
+        tuple: (invoice_path, row) as soon as each invoice completes.
+    """
+    routes = {}
+    prompt_reports = {}
+    duplicates = {}
+    file_keys = {}
+    errors = {}
+    finished = {}
+    try:
+        for invoice_path, parts, details in iter_batch_invoices(
+            invoice_file_paths, config, cancel_event=cancel_event, use_cache=use_cache, routes=routes,
+            prompt_reports=prompt_reports, duplicates=duplicates, file_keys=file_keys, errors=errors, **pipeline_kwargs
+        ):
+            if (routes.get(invoice_path) or {}).get("route") not in ("journal", "duplicate"):
+                finished[invoice_path] = (parts, details)
+            for index, row in _file_rows(invoice_path, parts, details):
+                row["Route"] = describe_route(routes.get(invoice_path))
+                prompt_report = prompt_reports.get((invoice_path, index))
+                if prompt_report:
+                    row["Prompt Tokens"] = f"{prompt_report['tokens_before']} -> {prompt_report['tokens_after']}"
+                if (invoice_path, index) in duplicates:
+                    row["Duplicate"] = duplicates[(invoice_path, index)]
+                if (invoice_path, index) in errors:
+                    row["Error"] = f"Enrichment failed: {errors[(invoice_path, index)]}"
+                yield invoice_path, row
+    finally:
+        record_history(_history_invoices(
+            {path: parts for path, (parts, _) in finished.items()},
+            {path: details for path, (_, details) in finished.items()},
+            routes, skip=duplicates, file_keys=file_keys,
+        ))
+
+
+def process_batch_invoices_excel(invoice_file_paths, config, save_dir="temp_uploads", use_cache=True, on_row=None, cancel_event=None, excel_path=None, **pipeline_kwargs):
+    """
+    Runs the overlapped OCR -> LLM pipeline over a batch and streams the results into a workbook.
+
+    Each row is appended to the workbook as soon as its invoice completes, so memory
+    stays flat and an interrupted batch still leaves the completed rows on disk.
+    A JSON run report with the batch's stage timings and counters (see `metrics`)
+    is written next to the workbook as `<workbook>.report.json`.
+
+    Args:
+        invoice_file_paths (list): List of file paths to the invoice files.
+        config (dict): Environment values with the Document Intelligence and Azure OpenAI settings.
+        save_dir (str): Directory where the Excel file will be saved.
+        use_cache (bool): If False, bypass the analyze and LLM caches.
+        on_row (callable): Optional callback `on_row(invoice_path, row)` called as each row completes.
+        cancel_event (threading.Event): Optional event; once set, the batch stops and the rows
+                                        completed so far are saved.
+        excel_path (str): Workbook path; defaults to a new timestamped file in `save_dir`.
+        **pipeline_kwargs: Forwarded to `apipeline` (ocr_concurrency, llm_concurrency, queue_size,
+                           journal, job_id, duplicate_index, documents). With a journal, re-running the same batch only
+                           processes unfinished or failed invoices.
 
-# Sample usage of the batch methods.
+    Returns:
+        str: Path to the saved Excel workbook.
+    """
+    excel_path = excel_path or batch_excel_path(save_dir)
+    os.makedirs(os.path.dirname(os.path.abspath(excel_path)), exist_ok=True)
+    since = metrics.snapshot()
+    with StreamingInvoiceWriter(excel_path, BATCH_COLUMNS) as writer:
+        for invoice_path, row in iter_batch_rows(
+            invoice_file_paths, config, use_cache=use_cache, cancel_event=cancel_event, **pipeline_kwargs
+        ):
+            writer.append(row)
+            if on_row:
+                on_row(invoice_path, row)
+    metrics.write_report(
+        os.path.splitext(writer.excel_path)[0] + ".report.json", since=since,
+        invoices=len(invoice_file_paths), rows=writer.rows_written, workbook=writer.excel_path,
+    )
+    return writer.excel_path
+
+
+# Running this module directly runs the headless command line tool (see cli.py).
 if __name__ == "__main__":
-    # Example: list of invoice file paths (update these paths as needed)
-    invoice_files = [
-        r"D:\work\upwork\armstrong\invoices\INVOICE # 43353_240826_131415.pdf",
-        r"D:\work\upwork\armstrong\invoices\20231109144311839.pdf",
-        # Add more file paths as needed.
-    ]
-
-    # Ensure that the files exist.
-    invoice_files = [path for path in invoice_files if os.path.exists(path)]
-    if not invoice_files:
-        raise FileNotFoundError("None of the specified invoice files were found.")
-
-    print("Starting batch extraction of invoice fields...")
-    batch_results = batch_extract_fields_from_invoices(invoice_files, parallel=True)
-
-    # Print a summary of extracted fields for each invoice.
-    for file_path, result in batch_results.items():
-        if result:
-            extracted_fields, _ = result
-            print(f"\nInvoice: {file_path}")
-            for field, details in extracted_fields.items():
-                print(f"  {field}: {details['value']} (Confidence: {details['confidence']:.2f})")
-        else:
-            print(f"\nInvoice: {file_path} - Extraction failed.")
+    import sys
+    from cli import main
 
-    # Generate a consolidated Excel file for all processed invoices.
-    excel_output_path = generate_batch_invoices_excel(batch_results, save_dir="temp_uploads")
-    print(f"\nBatch invoice Excel generated at: {excel_output_path}")
+    sys.exit(main())
@@ -1,29 +1,158 @@
-import threading
-import webview
+import argparse
+import atexit
+import multiprocessing
+import os
+import shutil
+import socket
 import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import webview
+
+
+# The app sits next to this file, or in the PyInstaller bundle directory when running as an .exe.
+BASE_DIR = getattr(sys, "_MEIPASS", os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.environ.get("INVOICE_APP_PATH", os.path.join(BASE_DIR, "app.py"))
+
+# Seconds to wait for the Streamlit server before showing an error in the window.
+READY_TIMEOUT = 60
+READY_POLL_SECONDS = 0.1
+
+SPLASH_HTML = """
+<html>
+  <body style="font-family: sans-serif; display: flex; align-items: center; justify-content: center; height: 100vh; margin: 0;">
+    <div style="text-align: center;">
+      <h2>Invoice Extraction App</h2>
+      <p>Starting up&hellip;</p>
+    </div>
+  </body>
+</html>
+"""
+
+
+def find_free_port(preferred=8501):
+    """Returns `preferred` if nothing listens on it, otherwise a free port picked by the OS."""
+    for port in (preferred, 0):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            try:
+                sock.bind(("127.0.0.1", port))
+            except OSError:
+                continue
+            return sock.getsockname()[1]
+    raise RuntimeError("No free port available.")
+
+
+def streamlit_command():
+    """
+    Returns the command that starts Streamlit.
 
+    `STREAMLIT_PATH` wins when set. Otherwise the current interpreter runs `-m streamlit`, and a
+    frozen launcher (which has no interpreter of its own) uses the `streamlit` found on PATH.
+    """
+    override = os.environ.get("STREAMLIT_PATH")
+    if override:
+        return [override]
+    if not getattr(sys, "frozen", False):
+        return [sys.executable, "-m", "streamlit"]
+    found = shutil.which("streamlit")
+    if found is None:
+        raise RuntimeError("Streamlit was not found; set STREAMLIT_PATH to the streamlit executable.")
+    return [found]
 
-def start_streamlit():
-    """Function to run the Streamlit app."""
-    app_path = "D:/work/upwork/armstrong/src/app.py"
-    streamlit_path = r"D:\work\upwork\armstrong\env\Scripts\streamlit.exe"  
 
-    startupinfo = subprocess.STARTUPINFO()
-    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+def is_ready(base_url):
+    """Returns True once the Streamlit server answers its health check."""
+    try:
+        with urllib.request.urlopen(f"{base_url}/_stcore/health", timeout=1) as response:
+            return response.status == 200
+    except urllib.error.HTTPError as e:
+        # 503 while the server is still starting; older Streamlit versions have no health endpoint (404).
+        return e.code == 404
+    except (urllib.error.URLError, OSError):
+        return False
 
-    subprocess.Popen(
-        [streamlit_path, "run", app_path, "--server.headless", "true"],
-        startupinfo=startupinfo, 
-        creationflags=subprocess.CREATE_NO_WINDOW
+
+def wait_until_ready(base_url, process, timeout=READY_TIMEOUT):
+    """
+    Polls the Streamlit server until it is ready.
+
+    Args:
+        base_url (str): Url of the Streamlit server.
+        process (subprocess.Popen): The server process; waiting stops early if it exits.
+        timeout (float): Seconds to wait at most.
+
+    Returns:
+        float: Seconds until the server was ready, or None if it exited or timed out.
+    """
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        if process.poll() is not None:
+            return None
+        if is_ready(base_url):
+            return time.monotonic() - started
+        time.sleep(READY_POLL_SECONDS)
+    return None
+
+
+def start_streamlit(port, prewarm=False):
+    """Function to run the Streamlit app on `port`; returns the server process."""
+    env = dict(os.environ)
+    if prewarm:
+        # Read by config.settings; the app then loads its clients in the background (see warmup.py).
+        env["PREWARM_CLIENTS"] = "true"
+
+    kwargs = {}
+    if os.name == "nt":
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        kwargs = {"startupinfo": startupinfo, "creationflags": subprocess.CREATE_NO_WINDOW}
+
+    process = subprocess.Popen(
+        [
+            *streamlit_command(), "run", APP_PATH,
+            "--server.headless", "true",
+            "--server.port", str(port),
+            "--browser.gatherUsageStats", "false",
+        ],
+        env=env,
+        **kwargs,
     )
+    # Closing the window ends the launcher; do not leave the server running behind it.
+    atexit.register(process.terminate)
+    return process
+
+
+def show_app_when_ready(window, base_url, process, started):
+    """Replaces the splash screen with the app once the server is ready."""
+    ready = wait_until_ready(base_url, process)
+    if ready is None:
+        window.load_html("<h3>The Invoice Extraction App could not be started.</h3>")
+        return
+    print(f"Streamlit ready in {ready:.2f}s ({time.monotonic() - started:.2f}s since launch)")
+    window.load_url(base_url)
+
+
+def start_webview(base_url, process, started):
+    """Function to create a webview window that shows a splash screen until the app is ready."""
+    window = webview.create_window("Invoice Extraction App", html=SPLASH_HTML)
+    webview.start(show_app_when_ready, (window, base_url, process, started))
 
 
-def start_webview():
-    """Function to create a webview window."""
-    webview.create_window("Invoice Extraction App", "http://localhost:8501")
-    webview.start()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Desktop launcher of the Invoice Extraction App.")
+    parser.add_argument("--port", type=int, default=8501, help="Preferred port; a free one is picked if it is taken.")
+    parser.add_argument("--prewarm", action="store_true", help="Load the Azure clients in the background on startup.")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    threading.Thread(target=start_streamlit, daemon=True).start()
-    start_webview()
+    # In the frozen launcher, a spawned child process re-runs this executable; let it act as the worker.
+    multiprocessing.freeze_support()
+    args = parse_args()
+    started = time.monotonic()
+    port = find_free_port(args.port)
+    process = start_streamlit(port, prewarm=args.prewarm)
+    start_webview(f"http://localhost:{port}", process, started)
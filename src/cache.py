@@ -0,0 +1,319 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+def content_hash(*parts):
+    """
+    Builds a stable sha256 hex digest over the given parts.
+
+    Args:
+        *parts: bytes or str values (anything else is JSON-encoded first).
+
+    Returns:
+        str: Hex digest identifying the combined content.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        elif not isinstance(part, (bytes, bytearray, memoryview)):
+            part = json.dumps(part, sort_keys=True, default=str).encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"__date__": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1:
+        if "__date__" in obj:
+            return datetime.date.fromisoformat(obj["__date__"])
+        if "__datetime__" in obj:
+            return datetime.datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+def dumps(value):
+    """Serializes a value to JSON, keeping dates round-trippable."""
+    return json.dumps(value, default=_json_default)
+
+
+def loads(data):
+    """Inverse of `dumps`."""
+    return json.loads(data, object_hook=_json_object_hook)
+
+
+class DiskCache:
+    """
+    A content-addressed on-disk JSON cache with size and age based LRU eviction.
+
+    Each entry is one JSON file named after its key. The file modification time is
+    used as the last-access time, so a hit simply touches the file. The number and size
+    of the entries are counted as they are written and removed; the directory is only
+    walked once to seed the counters, and again when evicting.
+
+    Args:
+        directory (str): Directory where the entries are stored.
+        max_bytes (int): Total size budget; the least recently used entries are evicted above it.
+        max_age_seconds (float): Entries not used for longer than this are treated as expired.
+        enabled (bool): If False, every lookup is a miss and nothing is written.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, max_age_seconds=30 * 24 * 3600, enabled=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._size = None
+        self._count = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """
+        Returns the cached value for `key`, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if self.max_age_seconds and time.time() - stat.st_mtime > self.max_age_seconds:
+                self._remove(path, stat.st_size)
+                raise FileNotFoundError(path)
+            with open(path, "r", encoding="utf-8") as f:
+                value = loads(f.read())
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Stores `value` under `key`, evicting old entries if the size budget is exceeded.
+        """
+        if not self.enabled:
+            return
+        path = self._path(key)
+        data = dumps(value).encode("utf-8")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial entry.
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        previous = os.path.getsize(path) if os.path.exists(path) else None
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.writes += 1
+            if self._size is None:
+                self._scan()
+            else:
+                self._size += len(data) - (previous or 0)
+                self._count += previous is None
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path, size):
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self.evictions += 1
+            if self._size is not None:
+                self._size -= size
+                self._count -= 1
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan(self):
+        # Called with the lock held: seeds the size and entry counters from the directory.
+        entries = self._entries()
+        self._size = sum(size for _, size, _ in entries)
+        self._count = len(entries)
+
+    def _evict(self):
+        # Called with the lock held: drop expired entries, then the least recently
+        # used ones until we are back under 90% of the budget.
+        now = time.time()
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        target = self.max_bytes * 0.9
+        for mtime, size, path in entries:
+            expired = self.max_age_seconds and now - mtime > self.max_age_seconds
+            if not expired and total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            count -= 1
+            self.evictions += 1
+        self._size = total
+        self._count = count
+
+    def stats(self):
+        """
+        Returns hit/miss counters and the current size of the cache.
+
+        Returns:
+            dict: hits, misses, writes, evictions, hit_rate, entries and bytes.
+        """
+        with self._lock:
+            if self._size is None:
+                self._scan()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": self._count,
+                "bytes": self._size,
+            }
+
+    def clear(self):
+        """Removes every entry from the cache."""
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = None
+            self._count = None
+
+
+class MemoryLRU:
+    """
+    A bounded, thread-safe in-memory LRU map.
+
+    Args:
+        max_entries (int): Maximum number of entries kept before the least recently used is dropped.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache:
+    """
+    A MemoryLRU in front of a DiskCache.
+
+    Lookups try memory first, then disk (promoting disk hits into memory). Writes go
+    to both tiers so that entries survive a restart.
+
+    Args:
+        memory (MemoryLRU): The in-memory tier.
+        disk (DiskCache): The persistent tier.
+    """
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+        self.memory_hits = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.disk.enabled
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        value = self.memory.get(key)
+        if value is not None:
+            with self._lock:
+                self.memory_hits += 1
+            return value
+        value = self.disk.get(key)
+        if value is not None:
+            self.memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        self.memory.set(key, value)
+        self.disk.set(key, value)
+
+    def stats(self):
+        """
+        Returns the disk tier stats with memory hits folded in.
+        """
+        stats = self.disk.stats()
+        with self._lock:
+            stats["memory_hits"] = self.memory_hits
+        stats["hits"] += stats["memory_hits"]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["memory_entries"] = len(self.memory)
+        return stats
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
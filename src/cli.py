@@ -0,0 +1,283 @@
+"""
+Headless batch extraction over a folder or glob of invoice PDFs.
+
+Examples:
+    python cli.py D:/invoices --output results.xlsx
+    python cli.py "invoices/**/*.pdf" --format jsonl --output results.jsonl --concurrency 16
+    python cli.py D:/invoices --dry-run
+    python cli.py D:/invoices --job-id nightly-0612 --output results.xlsx   # resumes job nightly-0612
+
+Progress goes to stderr. Exit codes: 0 when every invoice succeeded, 1 when some
+failed (OCR or LLM), 2 on usage errors, 130 when interrupted. The first Ctrl+C stops
+the batch and keeps the rows completed so far; a second one aborts at once.
+
+Heavy dependencies (Azure SDKs, openai, openpyxl, pandas) are only imported once a
+batch actually runs, so --help and --dry-run start instantly.
+"""
+import argparse
+import glob
+import hashlib
+import os
+import signal
+import sys
+import threading
+import time
+
+
+FORMATS = ("xlsx", "csv", "jsonl")
+
+# Settings (see config/settings.py) that can be overridden from the command line.
+SETTING_OPTIONS = {
+    "concurrency": "MAX_CONCURRENCY",
+    "di_rps": "DOCUMENT_INTELLIGENCE_RPS",
+    "llm_rpm": "LLM_REQUESTS_PER_MINUTE",
+    "llm_tpm": "LLM_TOKENS_PER_MINUTE",
+    "journal": "JOURNAL_PATH",
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="cli.py", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("inputs", nargs="+", help="Directories (searched recursively) or glob patterns of PDFs.")
+    parser.add_argument("-o", "--output", help="Output file; defaults to a timestamped file in temp_uploads.")
+    parser.add_argument("-f", "--format", choices=FORMATS, help="Output format; defaults to the --output extension, else xlsx.")
+    parser.add_argument("--concurrency", type=int, help="Requests in flight per service (max_concurrency).")
+    parser.add_argument("--ocr-concurrency", type=int, help="OCR workers; defaults to --concurrency.")
+    parser.add_argument("--llm-concurrency", type=int, help="LLM workers; defaults to --concurrency.")
+    parser.add_argument("--di-rps", type=float, help="Document Intelligence requests per second.")
+    parser.add_argument("--llm-rpm", type=int, help="Azure OpenAI requests per minute.")
+    parser.add_argument("--llm-tpm", type=int, help="Azure OpenAI tokens per minute.")
+    parser.add_argument("--journal", help="Job journal (SQLite) path; defaults to journal_path from settings.")
+    parser.add_argument(
+        "--job-id",
+        help="Job to create or resume; defaults to one derived from the inputs, so adding files to a folder resumes the same job.",
+    )
+    parser.add_argument("--no-resume", action="store_true", help="Ignore progress recorded by earlier runs.")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the analyze and LLM caches and duplicate lookups.")
+    parser.add_argument("--no-dedup", action="store_true", help="Do not skip or flag invoices processed before.")
+    parser.add_argument("--env-file", default=".env", help="File with the Azure endpoints and keys (default: .env).")
+    parser.add_argument("--dry-run", action="store_true", help="List what would be processed and exit.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print the final summary.")
+    return parser.parse_args(argv)
+
+
+def find_invoices(inputs):
+    """
+    Expands directories (recursively) and glob patterns into a sorted, de-duplicated list of PDFs.
+    """
+    found = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*")
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.isfile(path) and path.lower().endswith(".pdf"):
+                found.add(os.path.abspath(path))
+    return sorted(found)
+
+
+def default_job_id(inputs):
+    """
+    Job id derived from the inputs as given (folders and patterns, made absolute).
+
+    Keying by content instead (`journal.default_job_id`) would start a brand-new job whenever
+    a file is added to the folder; with this id the new files are added to the existing job.
+    """
+    inputs = sorted(os.path.abspath(pattern) for pattern in inputs)
+    return "cli-" + hashlib.sha256("\n".join(inputs).encode("utf-8")).hexdigest()[:16]
+
+
+def output_path(args, output_format):
+    if args.output:
+        return args.output
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    return os.path.join("temp_uploads", f"batch_extracted_invoices_{timestamp}.{output_format}")
+
+
+def load_config(env_file):
+    """Reads the Azure endpoints and keys from the environment (and `env_file`, if present)."""
+    import dotenv
+
+    dotenv.load_dotenv(env_file)
+    config = {
+        name: os.environ.get(name, "")
+        for name in ("DOCUMENT_INTELLIGENCE_ENDPOINT", "DOCUMENT_INTELLIGENCE_API_KEY", "AZURE_URL", "AZURE_API_KEY")
+    }
+    missing = [name for name, value in config.items() if not value]
+    return config, missing
+
+
+def log(message, quiet=False):
+    if not quiet:
+        print(message, file=sys.stderr, flush=True)
+
+
+def dry_run(paths, args):
+    from config.settings import get_settings
+    from journal import LLM_DONE, JobJournal, file_hash
+
+    keys = {path: file_hash(path) for path in paths}
+    job_id = args.job_id or default_job_id(args.inputs)
+    finished = set()
+    # A dry run never creates or writes the journal; it only reads progress that is already there.
+    journal_path = get_settings().journal_path
+    if not args.no_resume and os.path.exists(journal_path):
+        journal = JobJournal(journal_path, read_only=True)
+        try:
+            finished = {item["item_key"] for item in journal.items(job_id) if item["state"] == LLM_DONE}
+        finally:
+            journal.close()
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    for path in paths:
+        log(f"{'done   ' if keys[path] in finished else 'pending'} {path}", args.quiet)
+    pending = sum(1 for path in paths if keys[path] not in finished)
+    print(
+        f"{len(paths)} invoices ({total_bytes / 1024 / 1024:.1f} MB), job {job_id}: "
+        f"{len(paths) - pending} already done, {pending} to process",
+        file=sys.stderr,
+    )
+    return 0
+
+
+def interrupt(cancel_event):
+    """SIGINT handler: the first Ctrl+C asks the batch to stop, a second one raises KeyboardInterrupt."""
+    if cancel_event.is_set():
+        raise KeyboardInterrupt
+    cancel_event.set()
+    print("Stopping after the invoices in flight; press Ctrl+C again to abort.", file=sys.stderr, flush=True)
+
+
+def write_rows(rows, path, output_format):
+    """Writes (invoice_path, row) pairs as CSV or JSON lines, one line per invoice as it completes."""
+    import csv
+    import json
+
+    from batch_cogservice import BATCH_COLUMNS
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = None
+        if output_format == "csv":
+            writer = csv.DictWriter(f, fieldnames=BATCH_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+        for invoice_path, row in rows:
+            # Plain paths instead of the workbook's HYPERLINK formula.
+            row = dict(row, **{"Invoice Path": invoice_path})
+            if writer:
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(row, default=str) + "\n")
+            f.flush()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    paths = find_invoices(args.inputs)
+    if not paths:
+        print(f"No PDF files found in: {', '.join(args.inputs)}", file=sys.stderr)
+        return 2
+
+    # Settings are read once at import time, so overrides must be in the environment before any import.
+    for option, variable in SETTING_OPTIONS.items():
+        value = getattr(args, option)
+        if value is not None:
+            os.environ[variable] = str(value)
+
+    if args.dry_run:
+        return dry_run(paths, args)
+
+    config, missing = load_config(args.env_file)
+    if missing:
+        print(f"Missing settings: {', '.join(missing)} (set them in the environment or {args.env_file})", file=sys.stderr)
+        return 2
+
+    output_format = args.format or os.path.splitext(args.output or "")[1].lstrip(".").lower() or "xlsx"
+    if output_format not in FORMATS:
+        print(f"Unsupported output format: {output_format}", file=sys.stderr)
+        return 2
+    path = output_path(args, output_format)
+
+    from batch_cogservice import iter_batch_rows, process_batch_invoices_excel
+    from duplicates import get_duplicate_index
+    from journal import get_journal
+    from metrics import metrics
+
+    job_id = args.job_id
+    if args.no_resume and not job_id:
+        job_id = f"run-{time.strftime('%Y%m%d_%H%M%S')}"
+    job_id = job_id or default_job_id(args.inputs)
+    pipeline_kwargs = {
+        "use_cache": not args.no_cache,
+        "ocr_concurrency": args.ocr_concurrency,
+        "llm_concurrency": args.llm_concurrency,
+        "journal": get_journal(),
+        "job_id": job_id,
+        "duplicate_index": None if args.no_dedup else get_duplicate_index(),
+    }
+
+    log(f"Processing {len(paths)} invoices -> {path}", args.quiet)
+    started = time.monotonic()
+    # Files, not rows: a PDF holding several invoices produces one row per invoice.
+    failed = set()
+    completed = set()
+    rows_written = []
+
+    def on_row(invoice_path, row):
+        completed.add(invoice_path)
+        rows_written.append(invoice_path)
+        # Failed OCR and failed enrichment both leave an Error cell (see `build_invoice_row`).
+        if row.get("Error"):
+            failed.add(invoice_path)
+        elapsed = time.monotonic() - started
+        status = "FAILED" if row.get("Error") else "ok"
+        pages = f" p.{row['Pages']}" if row.get("Pages") else ""
+        log(
+            f"[{len(completed)}/{len(paths)}] {status} {invoice_path}{pages} "
+            f"({row.get('Route') or '-'}, {len(completed) / elapsed:.2f} files/s)",
+            args.quiet,
+        )
+
+    cancel_event = threading.Event()
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: interrupt(cancel_event))
+    try:
+        if output_format == "xlsx":
+            process_batch_invoices_excel(
+                paths, config, on_row=on_row, cancel_event=cancel_event, excel_path=path, **pipeline_kwargs
+            )
+        else:
+            since = metrics.snapshot()
+
+            def rows():
+                for invoice_path, row in iter_batch_rows(paths, config, cancel_event=cancel_event, **pipeline_kwargs):
+                    on_row(invoice_path, row)
+                    yield invoice_path, row
+
+            write_rows(rows(), path, output_format)
+            metrics.write_report(
+                os.path.splitext(path)[0] + ".report.json", since=since,
+                invoices=len(paths), rows=len(rows_written), output=path,
+            )
+    except KeyboardInterrupt:
+        cancel_event.set()
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
+    if cancel_event.is_set():
+        resume = f"run again with --job-id {job_id}" if args.job_id or args.no_resume else "run the same command again"
+        print(f"Interrupted after {len(completed)} of {len(paths)} invoices; {resume} to resume.", file=sys.stderr)
+        return 130
+
+    elapsed = time.monotonic() - started
+    print(
+        f"{len(completed) - len(failed)} succeeded, {len(failed)} failed, "
+        f"{len(paths) - len(completed)} not processed ({len(rows_written)} rows) in {elapsed:.1f}s -> {path}",
+        file=sys.stderr,
+    )
+    return 1 if failed or len(completed) < len(paths) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import hashlib
+import threading
+from contextlib import asynccontextmanager
+
+import aiohttp
+import httpx
+import instructor
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport, RequestsTransport
+from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncDocumentIntelligenceClient
+from openai import AsyncAzureOpenAI, AzureOpenAI
+from config.settings import get_settings
+from metrics import metrics
+from ratelimit import THROTTLE_STATUS_CODES
+
+
+_lock = threading.Lock()
+_document_clients = {}
+_llm_clients = {}
+_http_resources = []
+
+
+def _credential_id(secret):
+    # Never keep raw keys in registry keys, only a digest of them.
+    return hashlib.sha256((secret or "").encode("utf-8")).hexdigest()
+
+
+def _count_throttled_response(pipeline_response):
+    # raw_response_hook of the sync client; azure-core retries 429s itself, so count them as they pass.
+    if pipeline_response.http_response.status_code in THROTTLE_STATUS_CODES:
+        metrics.incr("throttles", service="document_intelligence")
+
+
+def _instrument_llm_client(client):
+    # instructor re-asks the model when its answer fails validation; count each re-ask as a retry.
+    if hasattr(client, "on"):
+        client.on("parse:error", lambda error: metrics.incr("retries", service="azure_openai", reason="validation"))
+    return client
+
+
+def _pool_size():
+    return max(1, get_settings().max_concurrency)
+
+
+def _requests_transport(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    _http_resources.append(session)
+    return RequestsTransport(session=session, session_owner=False)
+
+
+def get_document_client(endpoint, key):
+    """
+    Returns a shared DocumentIntelligenceClient for the given endpoint and key.
+
+    The client keeps one HTTP connection pool, sized to the batch concurrency, so
+    concurrent analyze calls reuse warm TLS connections instead of opening new ones.
+
+    Args:
+        endpoint (str): Document Intelligence endpoint.
+        key (str): Document Intelligence API key.
+
+    Returns:
+        DocumentIntelligenceClient: The pooled client.
+    """
+    registry_key = (endpoint, _credential_id(key))
+    with _lock:
+        client = _document_clients.get(registry_key)
+        if client is None:
+            client = DocumentIntelligenceClient(
+                endpoint=endpoint,
+                credential=AzureKeyCredential(key),
+                transport=_requests_transport(_pool_size()),
+                raw_response_hook=_count_throttled_response,
+            )
+            _document_clients[registry_key] = client
+        return client
+
+
+def get_llm_client(api_key, url, api_version):
+    """
+    Returns a shared instructor-wrapped AzureOpenAI client for the given url and key.
+
+    Args:
+        api_key (str): Azure OpenAI API key.
+        url (str): Azure OpenAI base url.
+        api_version (str): Azure OpenAI API version.
+
+    Returns:
+        instructor.Instructor: The pooled client.
+    """
+    registry_key = (url, api_version, _credential_id(api_key))
+    with _lock:
+        client = _llm_clients.get(registry_key)
+        if client is None:
+            pool_size = _pool_size()
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            )
+            _http_resources.append(http_client)
+            client = _instrument_llm_client(instructor.from_openai(
+                AzureOpenAI(api_key=api_key, base_url=url, api_version=api_version, http_client=http_client)
+            ))
+            _llm_clients[registry_key] = client
+        return client
+
+
+def reset_clients():
+    """
+    Closes and forgets every pooled client so the next call rebuilds them,
+    e.g. after the API keys were changed.
+    """
+    with _lock:
+        for client in _document_clients.values():
+            client.close()
+        for resource in _http_resources:
+            resource.close()
+        _document_clients.clear()
+        _llm_clients.clear()
+        _http_resources.clear()
+    get_settings.cache_clear()
+
+
+@asynccontextmanager
+async def async_document_client(endpoint, key, pool_size=None, raw_response_hook=None):
+    """
+    Opens an aio DocumentIntelligenceClient for the duration of a batch.
+
+    Async clients are bound to the event loop that created them, so unlike the
+    sync registry they are scoped to one batch and closed when it finishes.
+
+    Args:
+        endpoint (str): Document Intelligence endpoint.
+        key (str): Document Intelligence API key.
+        pool_size (int): Maximum number of open connections; defaults to `max_concurrency`.
+        raw_response_hook (callable): Called with every pipeline response, e.g. `ServiceScheduler.observe_response`.
+
+    Yields:
+        azure.ai.documentintelligence.aio.DocumentIntelligenceClient: The client.
+    """
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size or _pool_size()))
+    client = AsyncDocumentIntelligenceClient(
+        endpoint=endpoint,
+        credential=AzureKeyCredential(key),
+        transport=AioHttpTransport(session=session, session_owner=False),
+        raw_response_hook=raw_response_hook,
+    )
+    try:
+        yield client
+    finally:
+        await client.close()
+        await session.close()
+
+
+@asynccontextmanager
+async def async_llm_client(api_key, url, api_version, pool_size=None):
+    """
+    Opens an instructor-wrapped AsyncAzureOpenAI client for the duration of a batch.
+
+    Args:
+        api_key (str): Azure OpenAI API key.
+        url (str): Azure OpenAI base url.
+        api_version (str): Azure OpenAI API version.
+        pool_size (int): Maximum number of open connections; defaults to `max_concurrency`.
+
+    Yields:
+        instructor.AsyncInstructor: The client.
+    """
+    pool_size = pool_size or _pool_size()
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    )
+    # Retries are left to ratelimit.ServiceScheduler, which also adapts concurrency to throttling.
+    openai_client = AsyncAzureOpenAI(
+        api_key=api_key, base_url=url, api_version=api_version, http_client=http_client, max_retries=0
+    )
+    try:
+        yield _instrument_llm_client(instructor.from_openai(openai_client))
+    finally:
+        await openai_client.close()
+        await http_client.aclose()
@@ -1,30 +1,428 @@
+import asyncio
 import os
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.ai.documentintelligence.models import DocumentAnalysisFeature
-from azure.core.exceptions import HttpResponseError
-from dotenv import load_dotenv
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 import io
-import os
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill
-from openpyxl.utils import get_column_letter
-from openpyxl.worksheet.hyperlink import Hyperlink
+import time
 from config import settings
-from model import extract_invoice_details
+from cache import DiskCache, content_hash
+from history import record_history
+from metrics import metrics
+from model import aextract_invoice_header, extract_invoice_details, extract_invoice_header
+from preprocess import apreprocess_document, mean_confidence, preprocess_document, remap_pages
+from text_layer import OCR, TEXT_LAYER, count_pages, new_decision, route_document
+
+
+FIELDS_TO_EXTRACT = {
+    "Vendor Name": "VendorAddressRecipient",
+    # "Customer Name": "CustomerAddressRecipient",
+    "Date": "InvoiceDate",
+    # "Project Name": "ProjectName", 
+    # "Job Name": "ShipToAddressRecipient",
+    "Total Value": "InvoiceTotal",
+    "Invoice Number": "InvoiceId"
+}
+ANALYZE_MODEL_ID = "prebuilt-invoice"
 
+_settings = settings.get_settings()
+analyze_cache = DiskCache(
+    os.path.join(_settings.cache_dir, "analyze"),
+    max_bytes=_settings.analyze_cache_max_bytes,
+    max_age_seconds=_settings.analyze_cache_max_age_days * 24 * 3600,
+    enabled=_settings.analyze_cache_enabled,
+)
 
-def extract_fields_from_invoice(file_path, config):
+
+def analyze_cache_key(document_bytes):
     """
-    Extract specified fields from an invoice using Azure Document Intelligence.
+    Cache key for an analyze call: the PDF bytes plus the model id and query fields.
+    """
+    return content_hash(document_bytes, ANALYZE_MODEL_ID, sorted(FIELDS_TO_EXTRACT.values()))
+
+
+def parse_document_fields(document):
+    """
+    Maps one analyzed document (invoice) to the extracted fields dict used across the app.
 
     Args:
-        file_path (str): Path to the invoice file.
+        document (AnalyzedDocument): A document of a `prebuilt-invoice` analysis.
 
     Returns:
         dict: Extracted fields with their values and confidence levels.
     """
+    extracted_data = {}
+    for field_name, model_field in FIELDS_TO_EXTRACT.items():
+        field = document.fields.get(model_field)
+        if field:
+            if model_field == "InvoiceTotal":
+                if field.value_currency:
+                    extracted_data[field_name] = {
+                        "value": str(field.value_currency.amount) + " " + field.value_currency.currency_code,
+                        "confidence": field.confidence
+                    }
+                else:
+                    extracted_data[field_name] = {
+                        "value": field.value_string,
+                        "confidence": field.confidence
+                    }
+            elif model_field == "InvoiceDate":
+                extracted_data[field_name] = {
+                    "value": field.value_date,
+                    "confidence": field.confidence
+                }
+            else:
+                extracted_data[field_name] = {
+                    "value": field.content,
+                    "confidence": field.confidence
+                }
+    return extracted_data
+
+
+def parse_analyze_result(result):
+    """
+    Maps an AnalyzeResult to the extracted fields dict of its first invoice.
+
+    Use `parse_analyze_documents` to get every invoice of a multi-invoice PDF.
+
+    Args:
+        result (AnalyzeResult): Result of a `prebuilt-invoice` analysis.
+
+    Returns:
+        dict: Extracted fields with their values and confidence levels.
+    """
+    return parse_document_fields(result.documents[0]) if result.documents else {}
+
+
+def _document_pages(document):
+    pages = [region.page_number for region in (document.bounding_regions or [])]
+    return (min(pages), max(pages)) if pages else (None, None)
+
+
+def _document_text(document, content):
+    return "\n".join(content[span.offset:span.offset + span.length] for span in (document.spans or []))
+
+
+def parse_analyze_documents(result):
+    """
+    Splits an AnalyzeResult into one entry per invoice found in the PDF.
+
+    Args:
+        result (AnalyzeResult): Result of a `prebuilt-invoice` analysis (of the whole file or a page range).
+
+    Returns:
+        list: (extracted_fields, invoice_text, first_page, last_page) per document, in page order. A result
+              without documents gives a single entry with no fields and the full text.
+    """
+    content = result.content or ""
+    documents = list(result.documents or [])
+    if len(documents) <= 1:
+        first, last = _document_pages(documents[0]) if documents else (None, None)
+        fields = parse_document_fields(documents[0]) if documents else {}
+        return [(fields, content, first, last)]
+    return [
+        (parse_document_fields(document), _document_text(document, content), *_document_pages(document))
+        for document in documents
+    ]
+
+
+def shard_ranges(page_count, shard_pages=None):
+    """
+    Splits `page_count` pages into consecutive (first, last) ranges of `analyze_shard_pages` pages.
+
+    Returns a single range (or none if the page count is unknown) when sharding does not apply.
+    """
+    shard_pages = settings.get_settings().analyze_shard_pages if shard_pages is None else shard_pages
+    if not page_count:
+        return []
+    if not shard_pages or page_count <= shard_pages:
+        return [(1, page_count)]
+    return [(first, min(first + shard_pages - 1, page_count)) for first in range(1, page_count + 1, shard_pages)]
+
+
+def _continues(previous, following, boundary):
+    # A document cut by a shard boundary ends on the last page of one shard and starts on the
+    # first page of the next; the second half usually has no invoice number of its own.
+    if previous[3] != boundary or following[2] != boundary + 1:
+        return False
+    previous_id = previous[0].get("Invoice Number", {}).get("value")
+    following_id = following[0].get("Invoice Number", {}).get("value")
+    return following_id in (None, "", previous_id)
+
+
+def merge_shards(shards):
+    """
+    Merges the documents of page-range shards, in page order, into invoice parts.
+
+    A document split by a shard boundary is joined back together: the first half's fields win,
+    except the total, which is printed on the last page. Pages without an invoice of their
+    own are appended to the invoice before them.
+
+    Args:
+        shards (list): ((first, last), parsed documents) per shard, see `parse_analyze_documents`.
+
+    Returns:
+        tuple: (parts, content), where parts are (extracted_fields, invoice_text, pages) and
+               content is the text of the whole file.
+    """
+    merged = []
+    for (first, last), documents in sorted(shards, key=lambda shard: shard[0]):
+        for document in documents:
+            fields, text, doc_first, doc_last = document
+            document = (fields, text, doc_first or first, doc_last or last)
+            if merged and not fields:
+                # Pages without an invoice of their own (terms, attachments) belong to the one before.
+                previous = merged.pop()
+                document = (previous[0], previous[1] + "\n" + text, previous[2], document[3])
+            elif merged and _continues(merged[-1], document, first - 1):
+                previous = merged.pop()
+                fields = {**document[0], **previous[0]}
+                if "Total Value" in document[0]:
+                    fields["Total Value"] = document[0]["Total Value"]
+                document = (fields, previous[1] + "\n" + document[1], previous[2], document[3])
+            merged.append(document)
+    content = "\n".join(document[1] for document in merged)
+    return to_parts(merged), content
+
+
+def to_parts(documents):
+    """Turns parsed documents into invoice parts; page ranges are only kept when a file holds several invoices."""
+    if len(documents) == 1:
+        fields, text, _, _ = documents[0]
+        return [(fields, text, None)]
+    return [(fields, text, _format_pages(first, last)) for fields, text, first, last in documents]
+
+
+def _format_pages(first, last):
+    if first is None:
+        return None
+    return str(first) if first == last else f"{first}-{last}"
+
+
+CACHE_HIT_ROUTE = new_decision("cache", "analyze cache hit")
+
+
+def _record_route(routes, file_path, decision):
+    if routes is not None:
+        routes[file_path] = {key: value for key, value in decision.items() if key != "text"}
+
+
+def read_document(file_path, document=None):
+    """
+    Returns the bytes of a PDF, from memory when they are at hand.
+
+    Args:
+        file_path (str): Path to the invoice file; only read when `document` is None.
+        document: The PDF as bytes, or a file-like object such as an uploaded file or io.BytesIO.
+                  `getvalue()` of an unmodified BytesIO returns its buffer without copying it.
+
+    Returns:
+        bytes: The PDF.
+    """
+    if document is None:
+        with open(file_path, "rb") as f:
+            return f.read()
+    if isinstance(document, bytes):
+        return document
+    if isinstance(document, (bytearray, memoryview)):
+        return bytes(document)
+    if hasattr(document, "getvalue"):
+        return document.getvalue()
+    document.seek(0)
+    return document.read()
+
+
+def _load_document(file_path, use_cache, document=None):
+    """Reads the PDF and looks it up in the analyze cache; returns (bytes, cache_key, cached parts)."""
+    document_bytes = read_document(file_path, document)
+
+    cache_key = analyze_cache_key(document_bytes)
+    cached = None
+    if use_cache:
+        cached = analyze_cache.get(cache_key)
+        metrics.incr("cache_hits" if cached is not None else "cache_misses", cache="analyze")
+        if cached is not None:
+            # Entries written before multi-invoice support hold a single invoice.
+            cached = [tuple(part) for part in cached.get("invoices") or [(cached["fields"], cached["content"], None)]]
+    return document_bytes, cache_key, cached
+
+
+def _store_parts(cache_key, parts, use_cache):
+    if use_cache:
+        analyze_cache.set(cache_key, {"invoices": [list(part) for part in parts]})
+
+
+def _analyze_kwargs(pages=None):
+    from azure.ai.documentintelligence.models import DocumentAnalysisFeature
+
+    kwargs = {
+        "model_id": ANALYZE_MODEL_ID,
+        "features": [DocumentAnalysisFeature.QUERY_FIELDS],
+        "query_fields": [*list(FIELDS_TO_EXTRACT.values())],
+    }
+    if pages:
+        kwargs["pages"] = pages
+    return kwargs
+
+
+def analyze_invoices(client, document_bytes):
+    """
+    Analyzes a PDF with the sync client, in concurrent page-range shards when it is long.
+
+    Latency then grows with the shard size (`analyze_shard_pages`) rather than the file size;
+    billing is per page either way.
+
+    Returns:
+        tuple: (parts, content), see `merge_shards`.
+    """
+    ranges = shard_ranges(count_pages(document_bytes))
+
+    def analyze(page_range):
+        pages = f"{page_range[0]}-{page_range[1]}" if len(ranges) > 1 else None
+        with metrics.span("ocr_upload"):
+            poller = client.begin_analyze_document(body=io.BytesIO(document_bytes), **_analyze_kwargs(pages))
+        with metrics.span("ocr_poll"):
+            result = poller.result()
+        return page_range, parse_analyze_documents(result)
+
+    if len(ranges) <= 1:
+        _, documents = analyze(ranges[0] if ranges else (1, 1))
+        return to_parts(documents), "\n".join(document[1] for document in documents)
+    metrics.incr("analyze_shards", len(ranges))
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        return merge_shards(list(executor.map(analyze, ranges)))
+
+
+async def aanalyze_invoices(client, document_bytes, polling_interval=None, scheduler=None):
+    """
+    Async counterpart of `analyze_invoices`; each shard is admitted by `scheduler` separately.
+
+    The scheduler admits and times only the `begin_analyze_document` request: waiting for the
+    long-running operation reflects the service's processing time, not congestion, and holds no slot.
+    """
+    ranges = shard_ranges(await asyncio.to_thread(count_pages, document_bytes))
+    poll_kwargs = {"polling_interval": polling_interval} if polling_interval is not None else {}
+
+    async def analyze(page_range):
+        pages = f"{page_range[0]}-{page_range[1]}" if len(ranges) > 1 else None
+
+        async def begin():
+            with metrics.span("ocr_upload"):
+                return await client.begin_analyze_document(
+                    body=io.BytesIO(document_bytes), **_analyze_kwargs(pages), **poll_kwargs
+                )
+
+        poller = await (scheduler.run(begin) if scheduler else begin())
+        with metrics.span("ocr_poll"):
+            result = await poller.result()
+        return page_range, parse_analyze_documents(result)
+
+    if len(ranges) <= 1:
+        _, documents = await analyze(ranges[0] if ranges else (1, 1))
+        return to_parts(documents), "\n".join(document[1] for document in documents)
+    metrics.incr("analyze_shards", len(ranges))
+    return merge_shards(await asyncio.gather(*(analyze(page_range) for page_range in ranges)))
+
+
+def _shrunk(report):
+    return report is not None and report["bytes"] is not None
+
+
+def _needs_original(report, parts):
+    """Checks the fields read from a preprocessed PDF against `preprocess_min_confidence`."""
+    report["confidence"] = mean_confidence(parts, FIELDS_TO_EXTRACT.keys())
+    report["min_confidence"] = settings.get_settings().preprocess_min_confidence
+    return report["confidence"] < report["min_confidence"]
+
+
+def _more_confident(report, parts, original_parts):
+    # The original wins ties: preprocessing is only worth it when it does not cost accuracy.
+    if mean_confidence(original_parts, FIELDS_TO_EXTRACT.keys()) >= report["confidence"]:
+        report["fallback"] = True
+        metrics.incr("preprocess_fallbacks")
+        return original_parts
+    return parts
+
+
+def _record_preprocess(routes, file_path, report):
+    if routes is not None and report is not None:
+        decision = routes.setdefault(file_path, new_decision(OCR, "text layer not checked"))
+        decision["preprocess"] = {key: value for key, value in report.items() if key != "bytes"}
+
+
+def analyze_preprocessed(client, document_bytes, file_path=None, routes=None):
+    """
+    Analyzes a PDF like `analyze_invoices`, uploading a shrunk copy of its scanned pages
+    when preprocessing is enabled (see `preprocess.preprocess_pdf`).
+
+    If the mean field confidence of the shrunk copy falls below `preprocess_min_confidence`,
+    the original is analyzed as well and the more confident result is kept. The preprocessing
+    report (bytes saved, OCR latency, fallback) is added to the routing decision of `file_path`.
+
+    Returns:
+        list: (extracted_fields, invoice_text, pages) parts, with the page numbers of the original.
+    """
+    report = preprocess_document(document_bytes)
+    started = time.perf_counter()
+    parts, _ = analyze_invoices(client, report["bytes"] if _shrunk(report) else document_bytes)
+    if _shrunk(report):
+        parts = remap_pages(parts, report["kept_pages"])
+        if _needs_original(report, parts):
+            original_parts, _ = analyze_invoices(client, document_bytes)
+            parts = _more_confident(report, parts, original_parts)
+    if report is not None:
+        report["ocr_seconds"] = time.perf_counter() - started
+    _record_preprocess(routes, file_path, report)
+    return parts
+
+
+async def aanalyze_preprocessed(client, document_bytes, polling_interval=None, scheduler=None, file_path=None, routes=None):
+    """
+    Async counterpart of `analyze_preprocessed`; the preprocessing runs in the process pool
+    without blocking the event loop.
+    """
+    report = await apreprocess_document(document_bytes)
+    started = time.perf_counter()
+    parts, _ = await aanalyze_invoices(
+        client, report["bytes"] if _shrunk(report) else document_bytes,
+        polling_interval=polling_interval, scheduler=scheduler,
+    )
+    if _shrunk(report):
+        parts = remap_pages(parts, report["kept_pages"])
+        if _needs_original(report, parts):
+            original_parts, _ = await aanalyze_invoices(
+                client, document_bytes, polling_interval=polling_interval, scheduler=scheduler
+            )
+            parts = _more_confident(report, parts, original_parts)
+    if report is not None:
+        report["ocr_seconds"] = time.perf_counter() - started
+    _record_preprocess(routes, file_path, report)
+    return parts
+
+
+def extract_invoices(file_path, config, use_cache=True, routes=None, document=None):
+    """
+    Extract specified fields from every invoice in a PDF using Azure Document Intelligence.
+
+    Results are cached on disk by the hash of the PDF bytes, so re-analyzing the
+    same upload (even under a different file name) does not hit the network;
+    this includes the results of the text layer fast path below.
+    Born-digital PDFs with a good text layer skip OCR: their text is read locally
+    and the header fields are extracted by the LLM (see `text_layer.route_document`).
+    Long PDFs are analyzed in concurrent page-range shards (see `analyze_invoices`), and
+    scanned pages can be shrunk before the upload (see `analyze_preprocessed`).
+
+    Args:
+        file_path (str): Path to the invoice file.
+        config (dict): Environment values with the Document Intelligence and Azure OpenAI settings.
+        use_cache (bool): If False, bypass the analyze cache and always call the service.
+        routes (dict): Optional dict that receives the routing decision under `file_path`.
+        document: The PDF as bytes or a file-like object, analyzed instead of reading `file_path`
+                  (which then only names the invoice); see `read_document`.
+
+    Returns:
+        list: One (extracted_fields, invoice_text, pages) part per invoice found, where pages is the
+              page range (e.g. "3-4") when the PDF holds several invoices and None otherwise.
+              None if the service returned an error.
+    """
 
     endpoint = config['DOCUMENT_INTELLIGENCE_ENDPOINT']
     key = config['DOCUMENT_INTELLIGENCE_API_KEY']
@@ -32,64 +430,138 @@ def extract_fields_from_invoice(file_path, config):
     if not endpoint or not key:
         raise ValueError("DOCUMENTINTELLIGENCE_ENDPOINT and DOCUMENTINTELLIGENCE_API_KEY must be set in .env.")
 
-    client = DocumentIntelligenceClient(endpoint=endpoint, credential=AzureKeyCredential(key))
+    document_bytes, cache_key, cached = _load_document(file_path, use_cache, document)
+    if cached is not None:
+        _record_route(routes, file_path, CACHE_HIT_ROUTE)
+        return cached
+
+    with metrics.span("text_layer"):
+        decision = route_document(document_bytes)
+    _record_route(routes, file_path, decision)
+    metrics.incr("routes", route=decision["route"])
+    if decision["route"] == TEXT_LAYER:
+        try:
+            parts = [(extract_invoice_header(decision["text"], config, use_cache=use_cache), decision["text"], None)]
+            _store_parts(cache_key, parts, use_cache)
+            return parts
+        except Exception as e:
+            print(f"Text layer extraction failed for {file_path}, falling back to OCR: {e}")
+
+    # The Azure SDK (and the other heavy client libraries) are only imported once a document needs OCR.
+    from azure.core.exceptions import HttpResponseError
+    from clients import get_document_client
+
+    client = get_document_client(endpoint, key)
     try:
-        fields_to_extract = {
-            "Vendor Name": "VendorAddressRecipient",
-            # "Customer Name": "CustomerAddressRecipient",
-            "Date": "InvoiceDate",
-            # "Project Name": "ProjectName", 
-            # "Job Name": "ShipToAddressRecipient",
-            "Total Value": "InvoiceTotal",
-            "Invoice Number": "InvoiceId"
-        }
-        with open(file_path, "rb") as document:
-            poller = client.begin_analyze_document(
-                model_id="prebuilt-invoice",
-                body=document,
-                features=[DocumentAnalysisFeature.QUERY_FIELDS],
-                query_fields=[*list(fields_to_extract.values())],
-            )
-            result = poller.result()
-        
-        
-        extracted_data = {}
-
-        if result.documents:
-            for document in result.documents:
-                for field_name, model_field in fields_to_extract.items():
-                    field = document.fields.get(model_field)
-                    if field:
-                        if model_field == "InvoiceTotal":
-                            if field.value_currency:
-                                extracted_data[field_name] = {
-                                    "value": str(field.value_currency.amount) + " " + field.value_currency.currency_code,
-                                    "confidence": field.confidence
-                                }
-                            else:
-                                extracted_data[field_name] = {
-                                    "value": field.value_string,
-                                    "confidence": field.confidence
-                                }
-                        elif model_field == "InvoiceDate":
-                            extracted_data[field_name] = {
-                                "value": field.value_date,
-                                "confidence": field.confidence
-                            }
-                        else:
-                            extracted_data[field_name] = {
-                                "value": field.content,
-                                "confidence": field.confidence
-                            }
-        invoice_text=result.content
-
-        return extracted_data,invoice_text
+        parts = analyze_preprocessed(client, document_bytes, file_path=file_path, routes=routes)
+        _store_parts(cache_key, parts, use_cache)
+        return parts
 
     except HttpResponseError as e:
         print(f"An error occurred: {e.message}")
         return None
-    
-def generate_invoice_excel(extracted_fields, invoice_text, invoice_path, save_dir="temp_uploads", config=None):
+
+
+def extract_fields_from_invoice(file_path, config, use_cache=True, routes=None, document=None):
+    """
+    Extract specified fields from an invoice using Azure Document Intelligence.
+
+    See `extract_invoices`; if the PDF holds several invoices, the fields of the first
+    one are returned together with the text of the whole file.
+
+    Args:
+        file_path (str): Path to the invoice file.
+        config (dict): Environment values with the Document Intelligence and Azure OpenAI settings.
+        use_cache (bool): If False, bypass the analyze cache and always call the service.
+        routes (dict): Optional dict that receives the routing decision under `file_path`.
+        document: The PDF as bytes or a file-like object, analyzed instead of reading `file_path`
+                  (which then only names the invoice); see `read_document`.
+
+    Returns:
+        tuple: (extracted_fields, invoice_text), where extracted_fields maps each field
+               to its value and confidence level. None if the service returned an error.
+    """
+    parts = extract_invoices(file_path, config, use_cache=use_cache, routes=routes, document=document)
+    if parts is None:
+        return None
+    return parts[0][0], "\n".join(part[1] for part in parts)
+
+
+async def aextract_invoices(file_path, client, use_cache=True, polling_interval=None, scheduler=None, config=None, llm_client=None, llm_scheduler=None, routes=None, document=None):
+    """
+    Async counterpart of `extract_invoices`.
+
+    The long-running analyze operations are polled with `asyncio.sleep`, so many
+    invoices (and the shards of long ones) can be in flight on one event loop.
+
+    Args:
+        file_path (str): Path to the invoice file.
+        client: aio DocumentIntelligenceClient, see `clients.async_document_client`.
+        use_cache (bool): If False, bypass the analyze cache and always call the service.
+        polling_interval (float): Seconds between LRO status polls; defaults to the service's Retry-After.
+        scheduler (ServiceScheduler): Optional rate limiter/retry policy for the analyze operations.
+        config (dict): Environment values with the Azure OpenAI settings, for the text layer fast path.
+        llm_client: instructor AsyncAzureOpenAI client; the text layer fast path is only used when given.
+        llm_scheduler (ServiceScheduler): Optional rate limiter/retry policy for the fast path's LLM call.
+        routes (dict): Optional dict that receives the routing decision under `file_path`.
+        document: The PDF as bytes or a file-like object, analyzed instead of reading `file_path`
+                  (which then only names the invoice); see `read_document`.
+
+    Returns:
+        list: (extracted_fields, invoice_text, pages) parts, or None if the service returned an error.
+    """
+    document_bytes, cache_key, cached = await asyncio.to_thread(_load_document, file_path, use_cache, document)
+    if cached is not None:
+        _record_route(routes, file_path, CACHE_HIT_ROUTE)
+        return cached
+
+    if llm_client is not None:
+        with metrics.span("text_layer"):
+            decision = await asyncio.to_thread(route_document, document_bytes)
+        _record_route(routes, file_path, decision)
+        metrics.incr("routes", route=decision["route"])
+        if decision["route"] == TEXT_LAYER:
+            try:
+                extracted_data = await aextract_invoice_header(
+                    decision["text"], config, use_cache=use_cache, async_client=llm_client, scheduler=llm_scheduler
+                )
+                parts = [(extracted_data, decision["text"], None)]
+                await asyncio.to_thread(_store_parts, cache_key, parts, use_cache)
+                return parts
+            except Exception as e:
+                print(f"Text layer extraction failed for {file_path}, falling back to OCR: {e}")
+
+    from azure.core.exceptions import HttpResponseError
+
+    try:
+        parts = await aanalyze_preprocessed(
+            client, document_bytes, polling_interval=polling_interval, scheduler=scheduler, file_path=file_path, routes=routes
+        )
+        await asyncio.to_thread(_store_parts, cache_key, parts, use_cache)
+        return parts
+
+    except HttpResponseError as e:
+        print(f"An error occurred: {e.message}")
+        return None
+
+
+async def aextract_fields_from_invoice(file_path, client, use_cache=True, polling_interval=None, scheduler=None, config=None, llm_client=None, llm_scheduler=None, routes=None, document=None):
+    """
+    Async counterpart of `extract_fields_from_invoice` (the first invoice of the PDF), see `aextract_invoices`.
+
+    Returns:
+        tuple: (extracted_fields, invoice_text), or None if the service returned an error.
+    """
+    parts = await aextract_invoices(
+        file_path, client, use_cache=use_cache, polling_interval=polling_interval, scheduler=scheduler,
+        config=config, llm_client=llm_client, llm_scheduler=llm_scheduler, routes=routes, document=document,
+    )
+    if parts is None:
+        return None
+    return parts[0][0], "\n".join(part[1] for part in parts)
+
+
+def generate_invoice_excel(extracted_fields, invoice_text, invoice_path, save_dir="temp_uploads", config=None, use_cache=True, details=None):
     """
     Generates an Excel file from extracted invoice data and saves it to disk.
 
@@ -97,18 +569,24 @@ def generate_invoice_excel(extracted_fields, invoice_text, invoice_path, save_di
         extracted_fields (dict): Extracted invoice fields with values.
         invoice_path (str): Path to the original invoice file.
         save_dir (str): Directory where the Excel file will be saved.
+        use_cache (bool): If False, bypass the LLM enrichment cache.
+        details (dict): InvoiceDetails already extracted for this invoice; extracted here if not given.
 
     Returns:
         str: Path to the saved Excel file.
     """
     
-    extra_fields=extract_invoice_details(invoice_text, extracted_fields, config)
+    import pandas as pd
+    from openpyxl.styles import Font, PatternFill
+    from openpyxl.utils import get_column_letter
+
+    extra_fields = details if details is not None else extract_invoice_details(invoice_text, extracted_fields, config, use_cache=use_cache)
 
     # Ensure the save directory exists
     os.makedirs(save_dir, exist_ok=True)
 
     # Prepare data for the DataFrame
-    data = {key: [details["value"]] for key, details in extracted_fields.items()}
+    data = {key: [field["value"]] for key, field in extracted_fields.items()}
     for key, value in extra_fields.items():
         data[key] = [value]
     data["Invoice Path"] = [f'=HYPERLINK("{invoice_path}", "Open Invoice")']
@@ -121,29 +599,31 @@ def generate_invoice_excel(extracted_fields, invoice_text, invoice_path, save_di
     excel_path = os.path.join(save_dir, excel_filename)
 
     # Save to an Excel file
-    with pd.ExcelWriter(excel_path, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Invoice Data")
+    with metrics.span("excel"):
+        with pd.ExcelWriter(excel_path, engine="openpyxl") as writer:
+            df.to_excel(writer, index=False, sheet_name="Invoice Data")
 
-        # Access the workbook and sheet
-        workbook = writer.book
-        sheet = writer.sheets["Invoice Data"]
+            # Access the workbook and sheet
+            workbook = writer.book
+            sheet = writer.sheets["Invoice Data"]
 
-        # Define header style (green background, white text)
-        header_fill = PatternFill(start_color="228B22", end_color="228B22", fill_type="solid")  # Green background
-        header_font = Font(color="FFFFFF", bold=True)  # White text
-        link_font = Font(color="0000FF", underline="single")  # Blue, underlined hyperlink text
+            # Define header style (green background, white text)
+            header_fill = PatternFill(start_color="228B22", end_color="228B22", fill_type="solid")  # Green background
+            header_font = Font(color="FFFFFF", bold=True)  # White text
+            link_font = Font(color="0000FF", underline="single")  # Blue, underlined hyperlink text
 
-        # Apply header styles and adjust column widths
-        for col_idx, col in enumerate(df.columns, start=1):
-            cell = sheet.cell(row=1, column=col_idx)
-            cell.fill = header_fill
-            cell.font = header_font
-            sheet.column_dimensions[get_column_letter(col_idx)].width = 25  # Adjust column width
+            # Apply header styles and adjust column widths
+            for col_idx, col in enumerate(df.columns, start=1):
+                cell = sheet.cell(row=1, column=col_idx)
+                cell.fill = header_fill
+                cell.font = header_font
+                sheet.column_dimensions[get_column_letter(col_idx)].width = 25  # Adjust column width
 
-        # Apply hyperlink style to "Invoice Path" column
-        invoice_path_col = list(df.columns).index("Invoice Path") + 1  # Get column index (1-based)
-        sheet.cell(row=2, column=invoice_path_col).font = link_font  # Apply hyperlink style
+            # Apply hyperlink style to "Invoice Path" column
+            invoice_path_col = list(df.columns).index("Invoice Path") + 1  # Get column index (1-based)
+            sheet.cell(row=2, column=invoice_path_col).font = link_font  # Apply hyperlink style
 
+    record_history([(invoice_path, (extracted_fields, invoice_text), extra_fields, None, None)])
     return excel_path  # Return the path of the saved file
 
 
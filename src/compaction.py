@@ -0,0 +1,198 @@
+import re
+
+
+# Lines mentioning these are the ones the model needs for expense_type, approval and job_location.
+RELEVANT_KEYWORDS = {
+    "expense_type": (
+        "rental", "rent", "lease", "equipment", "material", "supply", "supplies", "lumber", "concrete",
+        "reimburse", "reimbursement", "expense", "mileage", "overhead", "service", "labor", "delivery",
+    ),
+    "approval": (
+        "approved", "approve", "approval", "denied", "deny", "rejected", "ok to pay", "pay", "hold",
+        "signature", "signed", "stamp", "authorized", "received", "verified",
+    ),
+    "job_location": (
+        "job", "site", "project", "ship to", "deliver to", "delivery address", "location", "jobsite",
+        "po", "p.o.", "purchase order", "address", "street", "ave", "blvd", "rd",
+    ),
+    "notes": ("note", "notes", "memo", "comment", "remarks", "description", "attn", "attention"),
+}
+
+# Lines mentioning these carry the header fields (vendor, number, date, total) read from a text layer.
+HEADER_KEYWORDS = (
+    "invoice", "inv", "number", "no", "date", "dated", "total", "amount due", "balance due", "due",
+    "remit to", "bill from", "from", "vendor", "sold by", "usd", "cad", "eur",
+)
+
+
+def _keyword_pattern(keywords):
+    return re.compile(r"\b(" + "|".join(re.escape(keyword) for keyword in keywords) + r")\b", re.IGNORECASE)
+
+
+_KEYWORD_PATTERN = _keyword_pattern(keyword for keywords in RELEVANT_KEYWORDS.values() for keyword in keywords)
+_HEADER_PATTERN = _keyword_pattern(HEADER_KEYWORDS)
+_NUMBER = re.compile(r"\d+")
+_NUMERIC_TOKEN = re.compile(r"(?<![\w.])\$?\d[\d,]*(\.\d+)?(?![\w.])")
+_MONEY = re.compile(r"\d\.\d{2}\b")
+
+_encodings = {}
+
+
+def _encoding(model):
+    # tiktoken is optional and slow to import, so it is loaded on the first count (or by the
+    # pre-warm). Without it, or without its encoding files (offline), None is cached and
+    # tokens are estimated.
+    if model not in _encodings:
+        try:
+            import tiktoken
+        except ImportError:
+            _encodings[model] = None
+            return None
+        try:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"Could not load the tokenizer, estimating tokens: {e}")
+            _encodings[model] = None
+    return _encodings[model]
+
+
+def count_tokens(text, model="gpt-4o-mini"):
+    """
+    Counts tokens with the model's tokenizer (tiktoken), or estimates ~4 characters per token.
+    """
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _dedupe_lines(lines):
+    # Repeated boilerplate (page headers/footers, terms) is kept once. Numbers are masked so
+    # "Page 1 of 3" and "Page 2 of 3" count as the same line.
+    seen = set()
+    kept = []
+    for line in lines:
+        signature = _NUMBER.sub("#", line.strip().lower())
+        if signature and signature in seen:
+            continue
+        seen.add(signature)
+        kept.append(line)
+    return kept
+
+
+def _is_line_item(line):
+    # A line-item row has several numbers (qty, unit price, amount) and at least one amount.
+    return len(_NUMERIC_TOKEN.findall(line)) >= 2 and _MONEY.search(line) is not None
+
+
+def _collapse_line_items(lines, keep_rows, pattern=_KEYWORD_PATTERN):
+    # Long line-item tables carry little signal for classification: keep the first rows of
+    # each run and summarize the rest.
+    compacted = []
+    run = []
+
+    def flush():
+        compacted.extend(run[:keep_rows])
+        if len(run) > keep_rows:
+            compacted.append(f"[... {len(run) - keep_rows} more line items omitted ...]")
+        run.clear()
+
+    for line in lines:
+        if _is_line_item(line) and not pattern.search(line):
+            run.append(line)
+        else:
+            flush()
+            compacted.append(line)
+    flush()
+    return compacted
+
+
+def _select_relevant(lines, budget, model, header_lines, context, pattern=_KEYWORD_PATTERN):
+    # Always keep the document header, then add keyword lines with their neighbours in
+    # order of relevance until the budget is used, and emit them in document order.
+    scores = []
+    for index, line in enumerate(lines):
+        score = len(pattern.findall(line))
+        if index < header_lines:
+            score += 100
+        scores.append(score)
+
+    selected = set()
+    used = 0
+    for index in sorted(range(len(lines)), key=lambda i: (-scores[i], i)):
+        if scores[index] <= 0:
+            break
+        window = [
+            i for i in range(max(0, index - context), min(len(lines), index + context + 1))
+            if i not in selected
+        ]
+        cost = sum(count_tokens(lines[i], model) + 1 for i in window)
+        if used + cost > budget:
+            continue
+        selected.update(window)
+        used += cost
+
+    kept = []
+    previous = -1
+    for index in sorted(selected):
+        if index != previous + 1:
+            kept.append("[...]")
+        kept.append(lines[index])
+        previous = index
+    return kept
+
+
+def compact_invoice_text(invoice_text, token_budget, model="gpt-4o-mini", keep_line_items=5, header_lines=15, context=1, for_header=False):
+    """
+    Shrinks OCR text to fit a token budget while keeping what the classifier needs.
+
+    Steps: drop repeated boilerplate lines, collapse long line-item tables and, only if
+    the text is still over budget, keep the header plus the lines (with neighbours)
+    mentioning expense type, approval, job site and notes keywords.
+
+    Args:
+        invoice_text (str): Raw invoice text.
+        token_budget (int): Maximum tokens for the text; 0 or None disables compaction.
+        model (str): Model whose tokenizer is used to count tokens.
+        keep_line_items (int): Rows kept from each run of line items.
+        header_lines (int): Leading lines always kept.
+        context (int): Neighbouring lines kept around each relevant line.
+        for_header (bool): Keep the lines with the header fields (`HEADER_KEYWORDS`) instead, for
+                           the header prompt of the text layer fast path.
+
+    Returns:
+        tuple: (compacted_text, report) where report has tokens_before and tokens_after.
+    """
+    invoice_text = invoice_text or ""
+    tokens_before = count_tokens(invoice_text, model)
+    report = {"tokens_before": tokens_before, "tokens_after": tokens_before, "compacted": False}
+    if not token_budget or tokens_before <= token_budget:
+        return invoice_text, report
+
+    pattern = _HEADER_PATTERN if for_header else _KEYWORD_PATTERN
+    lines = [line for line in invoice_text.splitlines() if line.strip()]
+    lines = _dedupe_lines(lines)
+    lines = _collapse_line_items(lines, keep_line_items, pattern)
+    compacted = "\n".join(lines)
+    if count_tokens(compacted, model) > token_budget:
+        compacted = "\n".join(_select_relevant(lines, token_budget, model, header_lines, context, pattern))
+
+    report["tokens_after"] = count_tokens(compacted, model)
+    report["compacted"] = True
+    return compacted, report
+
+
+def format_extracted_fields(extracted_fields):
+    """
+    Renders extracted fields as compact "name: value" lines, without confidences.
+    """
+    return "\n".join(
+        f"{name}: {field['value']}"
+        for name, field in (extracted_fields or {}).items()
+        if field.get("value") not in (None, "")
+    )
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Optional
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
@@ -14,11 +15,55 @@ class Settings(BaseSettings):
     temperature: float = 0.0
     max_tokens: Optional[int] = None
     max_retries: int = 3
+    prompt_token_budget: int = 1500
+    header_token_budget: int = 3000
+    llm_pack_max_invoices: int = 8
+    llm_pack_token_budget: int = 8000
+    llm_pack_linger_ms: int = 50
+    max_concurrency: int = 8
+    document_intelligence_rps: float = 15.0
+    llm_requests_per_minute: int = 300
+    llm_tokens_per_minute: int = 200000
+    scheduler_max_attempts: int = 6
     document_intelligence: DocumentIntelligenceSettings = DocumentIntelligenceSettings()
     azure_api_key: Optional[str] = os.environ.get("AZURE_API_KEY", "")
     azure_url: Optional[str] = os.environ.get("AZURE_URL", "")
     azure_api_version: Optional[str] = os.environ.get("AZURE_API_VERSION", "")
+    cache_dir: str = os.environ.get("INVOICE_CACHE_DIR", os.path.join("temp_uploads", ".cache"))
+    text_layer_fast_path: bool = True
+    text_layer_min_chars_per_page: int = 200
+    text_layer_max_garbage_ratio: float = 0.05
+    journal_path: str = os.path.join("temp_uploads", "jobs.sqlite3")
+    analyze_shard_pages: int = 8
+    analyze_cache_enabled: bool = True
+    analyze_cache_max_bytes: int = 512 * 1024 * 1024
+    analyze_cache_max_age_days: float = 30
+    llm_cache_enabled: bool = True
+    llm_cache_memory_entries: int = 1024
+    llm_cache_max_bytes: int = 64 * 1024 * 1024
+    llm_cache_max_age_days: float = 90
+    prewarm_clients: bool = False
+    history_enabled: bool = True
+    history_dir: str = os.path.join("temp_uploads", "history")
+    history_compact_min_files: int = 16
+    duplicate_index_enabled: bool = True
+    duplicate_index_path: str = os.path.join("temp_uploads", "duplicates.sqlite3")
+    vendor_memory_enabled: bool = True
+    vendor_memory_path: str = os.path.join("temp_uploads", "vendor_memory.sqlite3")
+    vendor_memory_threshold: float = 0.9
+    vendor_memory_min_examples: int = 3
+    preprocess_enabled: bool = False
+    preprocess_target_dpi: int = 200
+    preprocess_mode: str = "grayscale"  # "grayscale" or "bilevel"
+    preprocess_jpeg_quality: int = 75
+    preprocess_blank_ink_ratio: float = 0.002
+    preprocess_min_confidence: float = 0.8
+    preprocess_workers: int = 0  # 0 uses one worker per CPU
+    upload_store_dir: str = os.path.join("temp_uploads", "uploads")
+    upload_store_max_bytes: int = 1024 * 1024 * 1024
+    upload_store_max_age_days: float = 7
 
+@lru_cache
 def get_settings() -> Settings:
-    """Function to get settings."""
+    """Function to get settings (cached; call `get_settings.cache_clear()` to reload)."""
     return Settings()
@@ -0,0 +1,213 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from cache import content_hash, dumps, loads
+from config.settings import get_settings
+from history import parse_amount, parse_date
+from metrics import metrics
+
+
+EXACT = "exact"
+LIKELY = "likely"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    content_hash TEXT PRIMARY KEY,
+    invoice_path TEXT NOT NULL,
+    parts TEXT NOT NULL,
+    details TEXT NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invoices (
+    invoice_key TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    invoice_path TEXT NOT NULL,
+    pages TEXT,
+    details TEXT NOT NULL,
+    recorded_at REAL NOT NULL
+);
+"""
+
+# Legal-form suffixes dropped from vendor names, so "ACME Rentals, Inc." and "Acme Rentals" match.
+_VENDOR_SUFFIXES = {"inc", "incorporated", "llc", "ltd", "limited", "co", "corp", "corporation", "company", "lp", "llp", "plc"}
+
+
+def normalize_vendor(value):
+    words = re.sub(r"[^a-z0-9]+", " ", str(value or "").lower()).split()
+    while words and words[-1] in _VENDOR_SUFFIXES:
+        words.pop()
+    return " ".join(words)
+
+
+def normalize_invoice_number(value):
+    # "INV-00123", "inv 123" and "INV123" are the same number. Leading zeros are dropped per
+    # digit run before the separators go, so "2024-001" matches "2024-1" as well.
+    without_zeros = re.sub(r"(?<![0-9])0+(?=[0-9])", "", str(value or "").upper())
+    return re.sub(r"[^A-Z0-9]", "", without_zeros)
+
+
+def invoice_key(extracted_fields):
+    """
+    Builds the normalized (vendor, invoice number, total, date) key of an invoice.
+
+    Vendor names lose case, punctuation and legal-form suffixes, invoice numbers keep only
+    letters and digits, totals are compared in cents and dates as dates, so a re-scan of the
+    same invoice gives the same key even when OCR formats the values differently.
+
+    Args:
+        extracted_fields (dict): Extracted fields with their values, see `cogservice.extract_fields_from_invoice`.
+
+    Returns:
+        str: The key, or None if the vendor, the invoice number or both the total and the date are missing.
+    """
+    def value(name):
+        return (extracted_fields.get(name) or {}).get("value")
+
+    vendor = normalize_vendor(value("Vendor Name"))
+    number = normalize_invoice_number(value("Invoice Number"))
+    total, _ = parse_amount(value("Total Value"))
+    invoice_date = parse_date(value("Date"))
+    if not vendor or not number or (total is None and invoice_date is None):
+        return None
+    return content_hash("invoice-key", vendor, number, str(total), str(invoice_date))
+
+
+class DuplicateIndex:
+    """
+    Persistent index of processed invoices, stored in SQLite, used to skip duplicates.
+
+    Two layers, both primary-key lookups that stay fast with hundreds of thousands of invoices:
+
+    - files: the hash of the file bytes -> its parts and details. A byte-identical file
+      is answered from here without any remote call.
+    - invoices: the normalized key of each invoice (see `invoice_key`) -> its details.
+      A re-scan of a known invoice still needs OCR, but reuses the details instead of
+      calling the LLM and is flagged as a likely duplicate.
+
+    The first invoice seen under a key stays the original; later copies never replace it.
+
+    Args:
+        path (str): Path to the SQLite database file.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+
+    def find_file(self, file_content_hash):
+        """
+        Looks up an exact duplicate.
+
+        Returns:
+            dict: invoice_path, parts and details of the earlier file, or None if the content is new.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT invoice_path, parts, details FROM files WHERE content_hash = ?", (file_content_hash,)
+            ).fetchone()
+        metrics.incr("duplicate_lookups", layer="file", hit=row is not None)
+        if row is None:
+            return None
+        return {
+            "invoice_path": row["invoice_path"],
+            "parts": [tuple(part) for part in loads(row["parts"])],
+            "details": loads(row["details"]),
+        }
+
+    def find_invoice(self, key):
+        """
+        Looks up a likely duplicate by its `invoice_key`.
+
+        Returns:
+            dict: content_hash, invoice_path, pages and details of the original invoice, or None.
+        """
+        if key is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content_hash, invoice_path, pages, details FROM invoices WHERE invoice_key = ?", (key,)
+            ).fetchone()
+        metrics.incr("duplicate_lookups", layer="invoice", hit=row is not None)
+        if row is None:
+            return None
+        return {
+            "content_hash": row["content_hash"],
+            "invoice_path": row["invoice_path"],
+            "pages": row["pages"],
+            "details": loads(row["details"]),
+        }
+
+    def add(self, file_content_hash, invoice_path, parts, details):
+        """
+        Records a fully processed file and each of its invoices.
+
+        Args:
+            file_content_hash (str): Hash of the file bytes, see `journal.file_hash`.
+            invoice_path (str): Path to the invoice file.
+            parts (list): (extracted_fields, invoice_text, pages) parts of the file.
+            details (list): InvoiceDetails dict of each part; files with a missing answer are not recorded.
+        """
+        if not parts or len(details) != len(parts) or any(answer is None for answer in details):
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO files (content_hash, invoice_path, parts, details, recorded_at) VALUES (?, ?, ?, ?, ?)",
+                (file_content_hash, invoice_path, dumps([list(part) for part in parts]), dumps(details), now),
+            )
+            for part, answer in zip(parts, details):
+                key = invoice_key(part[0])
+                if key is None:
+                    continue
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO invoices (invoice_key, content_hash, invoice_path, pages, details, recorded_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, file_content_hash, invoice_path, part[2] if len(part) > 2 else None, dumps(answer), now),
+                )
+
+    def summary(self):
+        """Returns the number of files and invoices in the index."""
+        with self._lock:
+            files = self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            invoices = self._conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+        return {"files": files, "invoices": invoices}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def describe_duplicate(kind, original_path, pages=None):
+    """Text of the batch output's Duplicate column."""
+    name = os.path.basename(original_path)
+    if pages:
+        name = f"{name} p.{pages}"
+    if kind == EXACT:
+        return f"Exact duplicate of {name}"
+    return f"Likely duplicate of {name} (LLM skipped)"
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_duplicate_index():
+    """Returns the process-wide duplicate index at `duplicate_index_path`, or None if it is disabled."""
+    global _index
+    settings = get_settings()
+    if not settings.duplicate_index_enabled:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = DuplicateIndex(settings.duplicate_index_path)
+        return _index
@@ -0,0 +1,145 @@
+import csv
+import datetime
+import os
+
+from metrics import metrics
+
+
+OTHER_COLUMN = "Other Fields"
+
+
+def _named_styles():
+    from openpyxl.styles import Font, NamedStyle, PatternFill
+
+    header = NamedStyle(name="invoice_header")
+    header.fill = PatternFill(start_color="228B22", end_color="228B22", fill_type="solid")
+    header.font = Font(color="FFFFFF", bold=True)
+
+    link = NamedStyle(name="invoice_link")
+    link.font = Font(color="0000FF", underline="single")
+
+    date = NamedStyle(name="invoice_date")
+    date.number_format = "yyyy-mm-dd"
+    return header, link, date
+
+
+class StreamingInvoiceWriter:
+    """
+    Appends invoice rows to an .xlsx workbook in openpyxl write-only mode.
+
+    Memory stays flat regardless of the number of rows: openpyxl streams rows to a
+    temporary file and styles are shared named styles rather than per-cell objects.
+    Every row is also appended to a `<name>.partial.csv` checkpoint that is flushed
+    immediately, so an interrupted run still leaves every completed row on disk.
+    The checkpoint is removed once the workbook has been saved.
+
+    Columns are fixed up front by `columns`; keys outside the schema are collected
+    into a trailing "Other Fields" column instead of being dropped.
+
+    Args:
+        excel_path (str): Destination path of the workbook.
+        columns (list): Declared column names, in order.
+        link_columns (tuple): Columns whose cells are styled as hyperlinks.
+        column_width (int): Width applied to every column.
+        checkpoint (bool): If True, keep the CSV checkpoint while writing.
+    """
+
+    def __init__(self, excel_path, columns, link_columns=("Invoice Path",), column_width=25, checkpoint=True):
+        self.excel_path = excel_path
+        self.columns = list(columns) + [OTHER_COLUMN]
+        self.link_columns = set(link_columns)
+        self.rows_written = 0
+
+        # openpyxl is imported on first use so importing this module (and the app) stays fast.
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.utils import get_column_letter
+
+        self._write_only_cell = WriteOnlyCell
+        self._workbook = Workbook(write_only=True)
+        for style in _named_styles():
+            self._workbook.add_named_style(style)
+        self._sheet = self._workbook.create_sheet("Invoice Data")
+        for col_idx in range(1, len(self.columns) + 1):
+            self._sheet.column_dimensions[get_column_letter(col_idx)].width = column_width
+        self._sheet.append([self._cell(name, "invoice_header") for name in self.columns])
+
+        self._checkpoint_path = None
+        self._checkpoint_file = None
+        self._checkpoint = None
+        if checkpoint:
+            self._checkpoint_path = os.path.splitext(excel_path)[0] + ".partial.csv"
+            self._checkpoint_file = open(self._checkpoint_path, "w", newline="", encoding="utf-8")
+            self._checkpoint = csv.writer(self._checkpoint_file)
+            self._checkpoint.writerow(self.columns)
+            self._checkpoint_file.flush()
+
+    def _cell(self, value, style=None):
+        cell = self._write_only_cell(self._sheet, value=value)
+        if style:
+            cell.style = style
+        return cell
+
+    def append(self, row):
+        """
+        Appends one invoice row.
+
+        Args:
+            row (dict): Column name to cell value.
+        """
+        with metrics.span("excel"):
+            self._append(row)
+
+    def _append(self, row):
+        other = {key: value for key, value in row.items() if key not in self.columns}
+        values = [row.get(name) for name in self.columns[:-1]]
+        values.append("; ".join(f"{key}: {value}" for key, value in other.items()) or None)
+
+        cells = []
+        for name, value in zip(self.columns, values):
+            if name in self.link_columns:
+                cells.append(self._cell(value, "invoice_link"))
+            elif isinstance(value, (datetime.date, datetime.datetime)):
+                cells.append(self._cell(value, "invoice_date"))
+            else:
+                cells.append(self._cell(value))
+        self._sheet.append(cells)
+
+        if self._checkpoint:
+            self._checkpoint.writerow(["" if value is None else value for value in values])
+            self._checkpoint_file.flush()
+        self.rows_written += 1
+
+    def close(self):
+        """
+        Saves the workbook and removes the CSV checkpoint.
+
+        Returns:
+            str: Path to the saved Excel workbook.
+        """
+        with metrics.span("excel"):
+            self._workbook.save(self.excel_path)
+        if self._checkpoint_file:
+            self._checkpoint_file.close()
+            os.remove(self._checkpoint_path)
+            self._checkpoint_file = None
+        return self.excel_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return False
+        # Save whatever was written so far, even if the batch was interrupted by an error,
+        # without letting a failed save hide that error.
+        try:
+            self.close()
+        except Exception as e:
+            if self._checkpoint_file:
+                self._checkpoint_file.close()
+                self._checkpoint_file = None
+            kept = f"; completed rows are kept in {self._checkpoint_path}" if self._checkpoint_path else ""
+            print(f"Error saving {self.excel_path}: {e}{kept}")
+        return False
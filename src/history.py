@@ -0,0 +1,346 @@
+import datetime
+import decimal
+import os
+import re
+import time
+import uuid
+
+from config.settings import get_settings
+from journal import file_hash
+from metrics import metrics
+
+
+# Partition column: the invoice month as "YYYY-MM", or UNKNOWN_MONTH for invoices without a date.
+PARTITION_COLUMN = "invoice_month"
+UNKNOWN_MONTH = "unknown"
+
+# Total Value is stored as a decimal with this precision and scale.
+TOTAL_PRECISION = 18
+TOTAL_SCALE = 2
+
+# Lock file that keeps two processes from compacting the same partition; the leading
+# underscore hides it (like the temporary compacted file) from dataset discovery.
+_COMPACT_LOCK = "_compacting"
+_COMPACT_LOCK_STALE_SECONDS = 3600
+
+_AMOUNT = re.compile(r"-?\d[\d.,' ]*")
+_CURRENCY_CODE = re.compile(r"\b[A-Z]{3}\b")
+_DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%m-%d-%Y", "%B %d, %Y", "%b %d, %Y")
+
+
+def _pyarrow():
+    # pyarrow is optional and slow to import, so it is only loaded when the history is written or read.
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def history_schema(pa):
+    """Returns the pyarrow schema of the history dataset (without the partition column)."""
+    return pa.schema([
+        ("source_hash", pa.string()),
+        ("invoice_path", pa.string()),
+        ("pages", pa.string()),
+        ("vendor_name", pa.string()),
+        ("vendor_name_confidence", pa.float64()),
+        ("invoice_number", pa.string()),
+        ("invoice_number_confidence", pa.float64()),
+        ("invoice_date", pa.date32()),
+        ("invoice_date_confidence", pa.float64()),
+        ("total_value", pa.decimal128(TOTAL_PRECISION, TOTAL_SCALE)),
+        ("currency", pa.string()),
+        ("total_value_confidence", pa.float64()),
+        ("expense_type", pa.string()),
+        ("approval", pa.string()),
+        ("job_location", pa.string()),
+        ("route", pa.string()),
+        ("batch_id", pa.string()),
+        ("recorded_at", pa.timestamp("s")),
+    ])
+
+
+def parse_amount(value):
+    """
+    Parses an extracted Total Value such as "1234.5 USD" or "$1,234.50" into an amount and currency.
+
+    Returns:
+        tuple: (decimal.Decimal rounded to cents, currency code) with None for whatever could not be read.
+    """
+    if value is None:
+        return None, None
+    if isinstance(value, (int, float, decimal.Decimal)):
+        text, currency = str(value), None
+    else:
+        text = str(value)
+        match = _CURRENCY_CODE.search(text)
+        currency = match.group(0) if match else None
+    match = _AMOUNT.search(text)
+    if not match:
+        return None, currency
+    number = match.group(0).replace("'", "").replace(" ", "").rstrip(".,")
+    if "," in number and "." in number:
+        # The separator that comes last is the decimal one: "1,234.50" or "1.234,50".
+        thousands = "," if number.rfind(",") < number.rfind(".") else "."
+        number = number.replace(thousands, "").replace(",", ".")
+    elif "," in number:
+        whole, _, cents = number.rpartition(",")
+        number = f"{whole.replace(',', '')}.{cents}" if len(cents) == 2 else number.replace(",", "")
+    try:
+        amount = decimal.Decimal(number).quantize(decimal.Decimal(1).scaleb(-TOTAL_SCALE))
+    except decimal.InvalidOperation:
+        return None, currency
+    if len(amount.as_tuple().digits) > TOTAL_PRECISION:
+        return None, currency
+    return amount, currency
+
+
+def parse_date(value):
+    """Parses an extracted Date (a date, datetime or string) into a datetime.date, or None."""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if not value:
+        return None
+    text = str(value).strip()
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def invoice_month(invoice_date):
+    return invoice_date.strftime("%Y-%m") if invoice_date else UNKNOWN_MONTH
+
+
+def history_record(invoice_path, result, details, route=None, source_hash=None):
+    """
+    Builds one history record from an invoice's extraction result and LLM details.
+
+    Args:
+        invoice_path (str): Path to the invoice file.
+        result (tuple): (extracted_fields, invoice_text) or an (extracted_fields, invoice_text, pages) part.
+        details (dict): InvoiceDetails dict.
+        route (str): How the invoice was read, see `text_layer.describe_route`.
+        source_hash (str): sha256 of the file; computed from `invoice_path` when not given.
+
+    Returns:
+        dict: Column name to typed value, including the `invoice_month` partition.
+    """
+    extracted_fields = result[0]
+    details = details or {}
+
+    def field(name):
+        entry = extracted_fields.get(name) or {}
+        return entry.get("value"), entry.get("confidence")
+
+    vendor_name, vendor_confidence = field("Vendor Name")
+    invoice_number, number_confidence = field("Invoice Number")
+    date_value, date_confidence = field("Date")
+    total_value, total_confidence = field("Total Value")
+    invoice_date = parse_date(date_value)
+    amount, currency = parse_amount(total_value)
+    if source_hash is None and os.path.exists(invoice_path):
+        source_hash = file_hash(invoice_path)
+    return {
+        "source_hash": source_hash,
+        "invoice_path": invoice_path,
+        "pages": result[2] if len(result) > 2 else None,
+        "vendor_name": vendor_name,
+        "vendor_name_confidence": vendor_confidence,
+        "invoice_number": None if invoice_number is None else str(invoice_number),
+        "invoice_number_confidence": number_confidence,
+        "invoice_date": invoice_date,
+        "invoice_date_confidence": date_confidence,
+        "total_value": amount,
+        "currency": currency,
+        "total_value_confidence": total_confidence,
+        "expense_type": details.get("expense_type"),
+        "approval": details.get("approval"),
+        "job_location": details.get("job_location"),
+        "route": route,
+        PARTITION_COLUMN: invoice_month(invoice_date),
+    }
+
+
+def append_history(records, history_dir=None, batch_id=None):
+    """
+    Appends records to the Parquet history dataset, partitioned by invoice month.
+
+    Every call writes new files (`invoice_month=YYYY-MM/part-<batch>-<n>.parquet`) and never
+    rewrites existing ones, so concurrent batches cannot clobber each other. Re-running the same
+    invoices appends them again; `source_hash` identifies the copies. Single-invoice exports add
+    one small file each, so the partitions written to are then compacted (see `compact_history`).
+
+    Args:
+        records (list): Dicts from `history_record`.
+        history_dir (str): Dataset directory; defaults to `history_dir` from settings.
+        batch_id (str): Id stored with every record; defaults to a new unique id.
+
+    Returns:
+        int: Number of records written (0 if the history is disabled or pyarrow is not installed).
+    """
+    settings = get_settings()
+    if not records or not settings.history_enabled:
+        return 0
+    pa = _pyarrow()
+    if pa is None:
+        print("pyarrow is not installed; invoice history is not recorded.")
+        return 0
+    history_dir = history_dir or settings.history_dir
+    batch_id = batch_id or f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    recorded_at = datetime.datetime.now().replace(microsecond=0)
+
+    schema = history_schema(pa).append(pa.field(PARTITION_COLUMN, pa.string()))
+    rows = [{**record, "batch_id": batch_id, "recorded_at": recorded_at} for record in records]
+    table = pa.Table.from_pylist(rows, schema=schema)
+    with metrics.span("history"):
+        pa.dataset.write_dataset(
+            table, history_dir, format="parquet",
+            partitioning=pa.dataset.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor="hive"),
+            basename_template=f"part-{batch_id}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+    metrics.incr("history_records", len(rows))
+    try:
+        compact_history(history_dir, months={record[PARTITION_COLUMN] for record in records})
+    except Exception as e:
+        # The records are written; the partition is compacted on a later append.
+        print(f"Error compacting invoice history: {e}")
+    return len(rows)
+
+
+def compact_history(history_dir=None, months=None, min_files=None):
+    """
+    Merges the Parquet files of each month partition into one once it holds `min_files` or more,
+    so `query_history` opens one file per month instead of one per export.
+
+    The merged file is written under a hidden name and renamed into place before the files it
+    replaces are removed, so readers never miss records; files appended meanwhile are kept as is.
+
+    Args:
+        history_dir (str): Dataset directory; defaults to `history_dir` from settings.
+        months (set): Partitions ("YYYY-MM" or UNKNOWN_MONTH) to check; defaults to all of them.
+        min_files (int): Files a partition needs before it is compacted; defaults to
+            `history_compact_min_files` from settings.
+
+    Returns:
+        int: Number of files removed.
+    """
+    settings = get_settings()
+    pa = _pyarrow()
+    history_dir = history_dir or settings.history_dir
+    min_files = max(min_files or settings.history_compact_min_files, 2)
+    if pa is None or not os.path.isdir(history_dir):
+        return 0
+    import pyarrow.parquet
+
+    removed = 0
+    for entry in os.scandir(history_dir):
+        name, _, month = entry.name.partition("=")
+        if not entry.is_dir() or name != PARTITION_COLUMN or (months is not None and month not in months):
+            continue
+        files = sorted(
+            part.path for part in os.scandir(entry.path)
+            if part.is_file() and part.name.endswith(".parquet") and not part.name.startswith(("_", "."))
+        )
+        if len(files) < min_files:
+            continue
+        lock_path = os.path.join(entry.path, _COMPACT_LOCK)
+        try:
+            if time.time() - os.path.getmtime(lock_path) > _COMPACT_LOCK_STALE_SECONDS:
+                os.remove(lock_path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
+        try:
+            with metrics.span("history_compact"):
+                table = pa.dataset.dataset(files, format="parquet", schema=history_schema(pa)).to_table()
+                basename = f"part-compacted-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}-0.parquet"
+                temp_path = os.path.join(entry.path, "_" + basename)
+                pyarrow.parquet.write_table(table, temp_path)
+                os.replace(temp_path, os.path.join(entry.path, basename))
+                for path in files:
+                    os.remove(path)
+            removed += len(files)
+        finally:
+            os.remove(lock_path)
+    if removed:
+        metrics.incr("history_files_compacted", removed)
+    return removed
+
+
+def record_history(invoices, history_dir=None, batch_id=None):
+    """
+    Records finished invoices in the history; errors are printed, never raised, so exporting cannot fail a batch.
+
+    Args:
+        invoices (list): (invoice_path, result, details, route, source_hash) tuples; see `history_record`.
+
+    Returns:
+        int: Number of records written.
+    """
+    try:
+        records = [history_record(*invoice) for invoice in invoices]
+        return append_history(records, history_dir=history_dir, batch_id=batch_id)
+    except Exception as e:
+        print(f"Error recording invoice history: {e}")
+        return 0
+
+
+def query_history(columns=None, start=None, end=None, history_dir=None, **equals):
+    """
+    Reads invoices from the history, e.g. all Rental expenses of a job in a quarter:
+
+        query_history(start=datetime.date(2024, 7, 1), end=datetime.date(2024, 9, 30),
+                      expense_type="Rental", job_location="Job 1042")
+
+    Only the month partitions overlapping [start, end] are opened and the filters are
+    pushed down to the Parquet row groups; only the requested columns are read.
+
+    Args:
+        columns (list): Columns to return; defaults to all of them.
+        start (datetime.date): First invoice date to include.
+        end (datetime.date): Last invoice date to include.
+        history_dir (str): Dataset directory; defaults to `history_dir` from settings.
+        **equals: Column name to the value it must equal (a list or tuple matches any of its values).
+
+    Returns:
+        pyarrow.Table: The matching invoices (call `.to_pandas()` for a DataFrame).
+    """
+    pa = _pyarrow()
+    if pa is None:
+        raise ImportError("pyarrow is required to query the invoice history.")
+    history_dir = history_dir or get_settings().history_dir
+    schema = history_schema(pa)
+    partitioning = pa.dataset.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor="hive")
+    if not os.path.isdir(history_dir):
+        return schema.empty_table().select(columns) if columns else schema.empty_table()
+    dataset = pa.dataset.dataset(history_dir, format="parquet", partitioning=partitioning, schema=schema.append(
+        pa.field(PARTITION_COLUMN, pa.string())
+    ))
+
+    field = pa.dataset.field
+    conditions = []
+    if start is not None:
+        conditions += [field(PARTITION_COLUMN) >= invoice_month(start), field("invoice_date") >= start]
+    if end is not None:
+        conditions += [field(PARTITION_COLUMN) <= invoice_month(end), field("invoice_date") <= end]
+    for name, value in equals.items():
+        if isinstance(value, (list, tuple, set)):
+            conditions.append(field(name).isin(list(value)))
+        else:
+            conditions.append(field(name) == value)
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    with metrics.span("history_query"):
+        return dataset.to_table(columns=columns, filter=expression)
@@ -0,0 +1,196 @@
+import threading
+import time
+import traceback
+
+from cache import content_hash
+
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+def job_key(kind, uploads):
+    """
+    Identifies a job by its kind and the content of its uploads, independent of file names and order.
+
+    Args:
+        kind (str): "single" or "batch".
+        uploads (list): Bytes of every uploaded file.
+
+    Returns:
+        str: A short hex key.
+    """
+    return content_hash(kind, *sorted(content_hash(data) for data in uploads))[:16]
+
+
+class Job:
+    """
+    State of one background job, shared between its worker thread and the UI.
+
+    The worker reports through `set_invoice_status` and `add_row`; the UI reads a
+    consistent copy with `snapshot()` and requests cancellation with `cancel()`.
+
+    Args:
+        job_id (str): Key of the job, see `job_key`.
+        kind (str): "single" or "batch".
+        invoices (dict): Invoice file path to its display name (e.g. the uploaded file name).
+    """
+
+    def __init__(self, job_id, kind, invoices):
+        self.job_id = job_id
+        self.kind = kind
+        self.invoices = dict(invoices)
+        self.status = QUEUED
+        self.invoice_status = {file_path: QUEUED for file_path in self.invoices}
+        self.rows = []
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def set_invoice_status(self, file_path, status):
+        with self._lock:
+            self.invoice_status[file_path] = status
+
+    def add_row(self, file_path, row):
+        """
+        Records a finished invoice's output row and marks its file done (or failed if the row has an Error).
+
+        A file holding several invoices gets one row per invoice; it stays failed once any of them failed.
+        """
+        with self._lock:
+            self.rows.append({"Invoice": self.invoices.get(file_path, file_path), **row})
+            if row.get("Error") or self.invoice_status.get(file_path) == FAILED:
+                self.invoice_status[file_path] = FAILED
+            else:
+                self.invoice_status[file_path] = DONE
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def snapshot(self):
+        """
+        Returns a copy of the job state that is safe to read while the job runs.
+
+        Returns:
+            dict: job_id, kind, status, total, completed, invoices (name, path and status),
+                  rows, result, error and elapsed_seconds.
+        """
+        with self._lock:
+            end = self.finished_at or time.time()
+            return {
+                "job_id": self.job_id,
+                "kind": self.kind,
+                "status": self.status,
+                "total": len(self.invoices),
+                "completed": sum(1 for status in self.invoice_status.values() if status in (DONE, FAILED)),
+                "invoices": [
+                    {"name": name, "path": file_path, "status": self.invoice_status[file_path]}
+                    for file_path, name in self.invoices.items()
+                ],
+                "rows": list(self.rows),
+                "result": self.result,
+                "error": self.error,
+                "elapsed_seconds": round(end - self.submitted_at, 1),
+            }
+
+
+class JobRunner:
+    """
+    Runs jobs on background threads and keeps them by key, so a Streamlit rerun can
+    reattach to a running (or finished) job instead of starting it again.
+
+    Jobs are kept until `forget` is called or more than `max_finished` jobs have finished.
+
+    Args:
+        max_finished (int): Number of finished jobs to keep around for display.
+    """
+
+    def __init__(self, max_finished=20):
+        self.max_finished = max_finished
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def submit(self, job, target):
+        """
+        Starts `target(job)` on a background thread, unless a job with the same id is already known.
+
+        The target reports progress through the job, honours `job.cancel_event` and returns the job
+        result (e.g. the workbook path). Exceptions mark the job as failed.
+
+        Returns:
+            Job: The job now registered under `job.job_id` (an existing one if it was already submitted).
+        """
+        with self._lock:
+            existing = self._jobs.get(job.job_id)
+            if existing is not None:
+                return existing
+            self._jobs[job.job_id] = job
+            self._prune()
+
+        def run():
+            job.status = RUNNING
+            try:
+                job.result = target(job)
+                status = CANCELLED if job.cancel_event.is_set() else DONE
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                status = FAILED
+            job.finished_at = time.time()
+            job.status = status
+
+        threading.Thread(target=run, name=f"job-{job.job_id}", daemon=True).start()
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+
+    def forget(self, job_id):
+        """Drops a job so the same uploads can be submitted again; a running job is cancelled first."""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is not None and not job.finished:
+            job.cancel()
+
+    def _prune(self):
+        finished = sorted(
+            (job for job in self._jobs.values() if job.finished), key=lambda job: job.finished_at
+        )
+        for job in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job.job_id]
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """
+    Returns the process-wide job runner.
+
+    Streamlit re-executes the script on every interaction but keeps imported modules,
+    so jobs held here survive reruns.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner()
+        return _runner
@@ -0,0 +1,234 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from cache import content_hash, dumps, loads
+from config.settings import get_settings
+
+
+QUEUED = "queued"
+OCR_DONE = "ocr_done"
+LLM_DONE = "llm_done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    invoice_path TEXT NOT NULL,
+    state TEXT NOT NULL,
+    ocr_payload TEXT,
+    llm_payload TEXT,
+    failed_stage TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, item_key)
+);
+CREATE INDEX IF NOT EXISTS items_by_state ON items (job_id, state);
+"""
+
+
+def file_hash(file_path, chunk_size=1024 * 1024):
+    """Returns the sha256 hex digest of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def default_job_id(item_keys):
+    """
+    Job id derived from the item keys (file hashes) of a batch, independent of paths and order.
+
+    Adding, removing or changing a single file gives a new job id, so such a batch starts over
+    instead of resuming; pass an explicit job id (the CLI derives one from its inputs) to resume it.
+    """
+    return content_hash(*sorted(item_keys))[:16]
+
+
+def _load_parts(payload):
+    if not payload:
+        return None
+    parts = loads(payload)
+    # Journals written before multi-invoice support hold a single (extracted_fields, invoice_text) pair.
+    if len(parts) == 2 and isinstance(parts[0], dict):
+        return [(parts[0], parts[1], None)]
+    return [tuple(part) for part in parts]
+
+
+def _load_details(payload):
+    if not payload:
+        return None
+    details = loads(payload)
+    return [details] if isinstance(details, dict) else details
+
+
+class JobJournal:
+    """
+    Durable per-invoice progress of batch jobs, stored in SQLite.
+
+    Each invoice file of a job moves through queued -> ocr_done -> llm_done, or to failed
+    with the failing stage and error. The OCR and LLM payloads (one entry per invoice
+    found in the file) are stored alongside, so a re-run only processes unfinished items
+    and a failed LLM step is retried without paying for OCR again.
+
+    Items are keyed by the hash of the file bytes, not by path, so the same uploads
+    saved again under new temp names still resume the same job. Byte-identical files of
+    one batch share an item; `start_job` returns the item key of every path so callers
+    can give each of them the item's result.
+
+    Args:
+        path (str): Path to the SQLite database file.
+        read_only (bool): Open an existing journal for reading only; nothing is created or written
+                          (used by the CLI's --dry-run). Progress a running batch has not
+                          checkpointed yet may not be visible.
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self._lock = threading.Lock()
+        if read_only:
+            # immutable: no locking and no -wal/-shm files, so a dry run leaves the directory untouched.
+            uri = f"file:{os.path.abspath(path)}?mode=ro&immutable=1"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+
+    def start_job(self, invoice_file_paths, job_id=None, known_keys=None):
+        """
+        Registers a job and its invoices; already known invoices keep their progress.
+
+        Args:
+            invoice_file_paths (list): List of file paths to the invoice files.
+            job_id (str): Job id to resume; defaults to a hash of the files' contents.
+            known_keys (dict): Item keys already computed for some of the paths (e.g. by the OCR
+                               phase of a two-phase batch); only the other files are hashed.
+
+        Returns:
+            tuple: (job_id, item_keys), where item_keys maps each file path to its item key.
+        """
+        known_keys = known_keys or {}
+        keys = {file_path: known_keys.get(file_path) or file_hash(file_path) for file_path in invoice_file_paths}
+        job_id = job_id or default_job_id(keys.values())
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, created_at, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET updated_at = excluded.updated_at",
+                (job_id, now, now),
+            )
+            for file_path, item_key in keys.items():
+                self._conn.execute(
+                    "INSERT INTO items (job_id, item_key, invoice_path, state, updated_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(job_id, item_key) DO UPDATE SET invoice_path = excluded.invoice_path",
+                    (job_id, item_key, file_path, QUEUED, now),
+                )
+        return job_id, keys
+
+    def items(self, job_id, states=None):
+        """
+        Returns the job's items with their decoded payloads.
+
+        Args:
+            job_id (str): The job id.
+            states (iterable): Optional states to filter on.
+
+        Returns:
+            list: Dicts with item_key, invoice_path, state, parts (list of (extracted_fields, invoice_text, pages)),
+                  details (list of InvoiceDetails dicts, aligned with parts), failed_stage, error and attempts.
+        """
+        query = "SELECT * FROM items WHERE job_id = ?"
+        params = [job_id]
+        if states:
+            states = list(states)
+            query += f" AND state IN ({', '.join('?' for _ in states)})"
+            params.extend(states)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY rowid", params).fetchall()
+        return [
+            {
+                "item_key": row["item_key"],
+                "invoice_path": row["invoice_path"],
+                "state": row["state"],
+                "parts": _load_parts(row["ocr_payload"]),
+                "details": _load_details(row["llm_payload"]),
+                "failed_stage": row["failed_stage"],
+                "error": row["error"],
+                "attempts": row["attempts"],
+            }
+            for row in rows
+        ]
+
+    def _update(self, job_id, item_key, assignments, params):
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE items SET {assignments}, updated_at = ? WHERE job_id = ? AND item_key = ?",
+                (*params, time.time(), job_id, item_key),
+            )
+
+    def mark_ocr_done(self, job_id, item_key, parts):
+        """Stores the (extracted_fields, invoice_text, pages) parts of an invoice file."""
+        self._update(
+            job_id, item_key,
+            "state = ?, ocr_payload = ?, failed_stage = NULL, error = NULL",
+            (OCR_DONE, dumps([list(part) for part in parts])),
+        )
+
+    def mark_llm_done(self, job_id, item_key, details):
+        """Stores the InvoiceDetails dicts of an invoice file, one per part."""
+        self._update(
+            job_id, item_key,
+            "state = ?, llm_payload = ?, failed_stage = NULL, error = NULL",
+            (LLM_DONE, dumps(details)),
+        )
+
+    def mark_failed(self, job_id, item_key, stage, error):
+        """Marks an invoice as failed at `stage` ("ocr" or "llm"), keeping any earlier payload."""
+        self._update(
+            job_id, item_key,
+            "state = ?, failed_stage = ?, error = ?, attempts = attempts + 1",
+            (FAILED, stage, str(error)),
+        )
+
+    def summary(self, job_id):
+        """
+        Returns the number of items per state for a job.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) AS count FROM items WHERE job_id = ? GROUP BY state", (job_id,)
+            ).fetchall()
+        return {row["state"]: row["count"] for row in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """Returns the process-wide journal stored at `journal_path` from settings."""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = JobJournal(get_settings().journal_path)
+        return _journal
@@ -0,0 +1,248 @@
+import datetime
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+# Stages timed across the app, in pipeline order (used to order reports and the stats panel).
+STAGES = ("save", "text_layer", "ocr_upload", "ocr_poll", "llm", "excel")
+
+_QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None))
+
+
+def _series_name(name, label_key):
+    if not label_key:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in label_key) + "}"
+
+
+def _quantile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class _Timings:
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.samples = deque(maxlen=max_samples)
+
+    def summary(self, since=None):
+        count, total, errors = self.count, self.total, self.errors
+        if since:
+            count -= since[0]
+            total -= since[1]
+            errors -= since[2]
+        # The newest `count` samples are the ones recorded since the snapshot (as far as the window reaches).
+        recent = list(self.samples)[-count:] if count else []
+        ordered = sorted(recent)
+        return {
+            "count": count,
+            "errors": errors,
+            "total_seconds": round(total, 4),
+            "mean": round(total / count, 4) if count else None,
+            "p50": _round(_quantile(ordered, 0.5)),
+            "p95": _round(_quantile(ordered, 0.95)),
+            "p99": _round(_quantile(ordered, 0.99)),
+            "max": _round(ordered[-1] if ordered else None),
+        }
+
+
+def _round(value):
+    return None if value is None else round(value, 4)
+
+
+class Metrics:
+    """
+    In-process metrics registry: timed spans per stage, counters and gauges.
+
+    Spans keep their count and total time plus a window of the most recent samples
+    for percentiles. Everything is thread-safe, so the sync app, the batch event
+    loop and worker threads can all record into the same registry.
+
+    Args:
+        max_samples (int): Most recent span durations kept per stage for percentiles.
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.started_at = time.time()
+        self._timings = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage):
+        """
+        Times the enclosed block as one `stage` sample; works around `await` too.
+
+        An exception raised in the block is counted as an error of the stage and re-raised.
+        """
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started, failed)
+
+    def observe(self, stage, seconds, failed=False):
+        """Records one `stage` duration measured elsewhere."""
+        with self._lock:
+            timings = self._timings.get(stage)
+            if timings is None:
+                timings = self._timings[stage] = _Timings(self.max_samples)
+            timings.count += 1
+            timings.total += seconds
+            timings.errors += int(failed)
+            timings.samples.append(seconds)
+
+    def incr(self, name, value=1, **labels):
+        """Adds `value` to counter `name` with the given labels, e.g. `incr("cache_hits", cache="llm")`."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """Sets gauge `name` with the given labels to `value`, e.g. a queue depth."""
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def counter(self, name, **labels):
+        """Returns the current value of a counter (0 if never incremented)."""
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+    def record_llm_usage(self, completion, response_model=None):
+        """
+        Counts an LLM call and its token usage.
+
+        instructor attaches the raw chat completion to the parsed model as `_raw_response`;
+        its `usage` holds the prompt and completion tokens (summed over instructor's retries).
+        """
+        name = response_model.__name__ if response_model is not None else None
+        self.incr("llm_calls", response_model=name)
+        raw = getattr(completion, "_raw_response", None)
+        usage = getattr(raw, "usage", None)
+        if usage is None:
+            return
+        self.incr("llm_prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0, response_model=name)
+        self.incr("llm_completion_tokens", getattr(usage, "completion_tokens", 0) or 0, response_model=name)
+
+    def snapshot(self):
+        """
+        Returns a marker of the current totals; pass it to `run_report` to report only what happened since.
+        """
+        with self._lock:
+            return {
+                "at": time.time(),
+                "counters": dict(self._counters),
+                "timings": {stage: (t.count, t.total, t.errors) for stage, t in self._timings.items()},
+            }
+
+    def run_report(self, since=None, **extra):
+        """
+        Builds a JSON-serializable report of stage timings, counters and gauges.
+
+        Args:
+            since (dict): Optional `snapshot()`; counters and stages are then reported as deltas.
+            **extra: Additional top-level fields, e.g. the number of invoices or the output path.
+
+        Returns:
+            dict: started_at, elapsed_seconds, stages, counters, gauges and the extra fields.
+        """
+        since = since or {}
+        base_counters = since.get("counters", {})
+        base_timings = since.get("timings", {})
+        started = since.get("at", self.started_at)
+        with self._lock:
+            stage_names = sorted(self._timings, key=lambda stage: (STAGES.index(stage) if stage in STAGES else len(STAGES), stage))
+            stages = {
+                stage: self._timings[stage].summary(base_timings.get(stage))
+                for stage in stage_names
+            }
+            counters = {
+                _series_name(name, labels): value - base_counters.get((name, labels), 0)
+                for (name, labels), value in sorted(self._counters.items())
+                if value - base_counters.get((name, labels), 0)
+            }
+            gauges = {_series_name(name, labels): value for (name, labels), value in sorted(self._gauges.items())}
+        return {
+            "started_at": datetime.datetime.fromtimestamp(started).isoformat(timespec="seconds"),
+            "elapsed_seconds": round(time.time() - started, 3),
+            **extra,
+            "stages": {stage: summary for stage, summary in stages.items() if summary["count"]},
+            "counters": counters,
+            "gauges": gauges,
+        }
+
+    def write_report(self, path, since=None, **extra):
+        """Writes `run_report(since, **extra)` as JSON to `path` and returns the path."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.run_report(since, **extra), f, indent=2, default=str)
+        return path
+
+    def prometheus_text(self, prefix="invoice_tool"):
+        """
+        Renders all metrics in the Prometheus text exposition format.
+
+        Stages become a summary `<prefix>_stage_seconds` with p50/p95/p99 quantiles,
+        counters get a `_total` suffix, gauges are exported as they are.
+        """
+        lines = []
+        with self._lock:
+            if self._timings:
+                metric = f"{prefix}_stage_seconds"
+                lines.append(f"# HELP {metric} Time spent per pipeline stage.")
+                lines.append(f"# TYPE {metric} summary")
+                for stage, timings in sorted(self._timings.items()):
+                    ordered = sorted(timings.samples)
+                    for fraction in _QUANTILES:
+                        value = _quantile(ordered, fraction)
+                        if value is not None:
+                            lines.append(f'{metric}{{stage="{stage}",quantile="{fraction}"}} {value:.6f}')
+                    lines.append(f'{metric}_sum{{stage="{stage}"}} {timings.total:.6f}')
+                    lines.append(f'{metric}_count{{stage="{stage}"}} {timings.count}')
+                metric = f"{prefix}_stage_errors_total"
+                lines.append(f"# TYPE {metric} counter")
+                for stage, timings in sorted(self._timings.items()):
+                    lines.append(f'{metric}{{stage="{stage}"}} {timings.errors}')
+
+            declared = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f"{prefix}_{name}_total"
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} counter")
+                    declared.add(metric)
+                lines.append(f"{_series_name(metric, labels)} {value}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                metric = f"{prefix}_{name}"
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} gauge")
+                    declared.add(metric)
+                lines.append(f"{_series_name(metric, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self._timings.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+
+# Process-wide registry shared by the app, the batch pipeline and the clients.
+metrics = Metrics()
@@ -1,6 +1,21 @@
+import asyncio
+import datetime
+import json
+import os
+import re
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Optional
+from cache import DiskCache, MemoryLRU, TieredCache, content_hash
+from compaction import compact_invoice_text, count_tokens, format_extracted_fields
+from config.settings import get_settings
+from metrics import metrics
 from model_hub.llm_factory import LLMFactory
+from model_hub.utils import model_dict
+from ratelimit import estimate_prompt_tokens
+from vendor_memory import predicted_answer, remember_answer
+
+# Bump whenever the prompt below changes so cached answers from the old prompt are not reused.
+PROMPT_VERSION = "2"
 
 class InvoiceDetails(BaseModel):
     expense_type: str = Field(description="Type of expense: Rental, Material, Site Expenses, Reimbursement, Other")
@@ -8,25 +23,412 @@ class InvoiceDetails(BaseModel):
     job_location: Optional[str]= Field(default='', description="Job site name or job number if available, job site is not a company")
 
 
+class PackedInvoiceDetails(InvoiceDetails):
+    invoice_id: str = Field(description="Id of the invoice these details belong to, exactly as given in its heading")
+
+
+class PackedInvoiceDetailsList(BaseModel):
+    invoices: List[PackedInvoiceDetails] = Field(description="One entry per invoice provided, in any order")
+
+
+class InvoiceHeader(BaseModel):
+    vendor_name: Optional[str] = Field(default=None, description="Name of the company that issued the invoice")
+    invoice_date: Optional[datetime.date] = Field(default=None, description="Date the invoice was issued")
+    total_amount: Optional[float] = Field(default=None, description="Invoice total amount due, as a number")
+    currency_code: Optional[str] = Field(default=None, description="ISO currency code of the total, e.g. USD")
+    invoice_number: Optional[str] = Field(default=None, description="Invoice number or id as printed")
+
+
+_settings = get_settings()
+details_cache = TieredCache(
+    MemoryLRU(_settings.llm_cache_memory_entries),
+    DiskCache(
+        os.path.join(_settings.cache_dir, "llm"),
+        max_bytes=_settings.llm_cache_max_bytes,
+        max_age_seconds=_settings.llm_cache_max_age_days * 24 * 3600,
+        enabled=_settings.llm_cache_enabled,
+    ),
+)
+
+
+def cached_answer(cache_key, use_cache=True, fallback_key=None):
+    """
+    Looks up an LLM answer in `details_cache`, counting the hit or miss; None if absent or bypassed.
+
+    `fallback_key` is tried when `cache_key` misses; the two lookups count as one.
+    """
+    if not use_cache:
+        return None
+    cached = details_cache.get(cache_key)
+    if cached is None and fallback_key is not None:
+        cached = details_cache.get(fallback_key)
+    metrics.incr("cache_hits" if cached is not None else "cache_misses", cache="llm")
+    return cached
 
-def extract_invoice_details(invoice_text: str, extracted_fields, config=None):
-    messages = [
+
+def details_cache_key(invoice_text, extracted_fields, provider="azure", temperature=None, packed=False):
+    """
+    Cache key for an LLM enrichment: normalized text, extracted fields, model, temperature,
+    prompt token budget and prompt/schema version.
+
+    Answers from a packed prompt (see `build_packed_messages`) are keyed apart with `packed=True`,
+    since that prompt differs from the single-invoice one.
+    """
+    normalized_text = re.sub(r"\s+", " ", invoice_text or "").strip()
+    schema = json.dumps(InvoiceDetails.model_json_schema(), sort_keys=True)
+    if temperature is None:
+        temperature = _settings.temperature
+    return content_hash(
+        normalized_text,
+        extracted_fields,
+        model_dict[provider],
+        str(temperature),
+        str(_settings.prompt_token_budget),
+        PROMPT_VERSION,
+        schema,
+        *(["packed"] if packed else []),
+    )
+
+
+def build_messages(invoice_text, extracted_fields, report=None):
+    """
+    Builds the enrichment prompt, compacting the invoice text to `prompt_token_budget` tokens.
+
+    Args:
+        report (dict): Optional dict that receives tokens_before/tokens_after of the compaction.
+    """
+    invoice_text, compaction = compact_invoice_text(invoice_text, _settings.prompt_token_budget, model_dict["azure"])
+    if report is not None:
+        report.update(compaction)
+    return [
         {"role": "system", "content": "You are an expert in extracting structured information from a contructions company's invoices with high accuracy."},
         {
             "role": "user",
             "content": (
                 "You are provided with raw invoice text extracted through OCR.\n"
                 f"### Raw Invoice Text:\n{invoice_text}\n"
-                f"### Some of the fields I already extracted:\n{extracted_fields}\n"
+                f"### Some of the fields I already extracted:\n{format_extracted_fields(extracted_fields)}\n"
                 "### Important Instructions:\n"
                 "1. **Only extract information if you are certain about its accuracy.** If a field cannot be determined with confidence, return an empty value.\n"
                 "2. **Do not confuse job site/address with vendor or customer name.** The job location refers to the worksite or project location, not billing/shipping details.\n"
             )
         }
     ]
+
+
+def extract_invoice_details(invoice_text: str, extracted_fields, config=None, use_cache=True, prompt_report=None):
+    cache_key = details_cache_key(invoice_text, extracted_fields)
+    cached = cached_answer(cache_key, use_cache)
+    if cached is not None:
+        return InvoiceDetails.model_validate(cached).model_dump()
+    # Repeat vendors with a predictable answer are answered by the vendor memory instead of the LLM.
+    predicted = predicted_answer(invoice_text, extracted_fields, use_cache)
+    if predicted is not None:
+        return InvoiceDetails.model_validate(predicted).model_dump()
+
     llm = LLMFactory("azure", config)
     completion = llm.create_completion(
         response_model=InvoiceDetails,
-        messages=messages,
+        messages=build_messages(invoice_text, extracted_fields, prompt_report),
+    )
+    details = completion.model_dump()
+    if use_cache:
+        details_cache.set(cache_key, details)
+    remember_answer(invoice_text, extracted_fields, details)
+    return details
+
+
+async def aextract_invoice_details(invoice_text: str, extracted_fields, config=None, use_cache=True, async_client=None, scheduler=None, prompt_report=None):
+    """
+    Async counterpart of `extract_invoice_details`, sharing its cache and vendor memory.
+
+    Args:
+        async_client: instructor AsyncAzureOpenAI client, see `clients.async_llm_client`.
+        scheduler (ServiceScheduler): Optional rate limiter/retry policy; the request is budgeted
+                                      by its estimated prompt tokens.
+        prompt_report (dict): Optional dict that receives the prompt compaction report.
+    """
+    cache_key = details_cache_key(invoice_text, extracted_fields)
+    cached = cached_answer(cache_key, use_cache)
+    if cached is not None:
+        return InvoiceDetails.model_validate(cached).model_dump()
+    predicted = predicted_answer(invoice_text, extracted_fields, use_cache)
+    if predicted is not None:
+        return InvoiceDetails.model_validate(predicted).model_dump()
+
+    llm = LLMFactory("azure", config, async_client=async_client)
+    messages = build_messages(invoice_text, extracted_fields, prompt_report)
+
+    def complete():
+        return llm.acreate_completion(response_model=InvoiceDetails, messages=messages)
+
+    if scheduler:
+        completion = await scheduler.run(complete, tokens=estimate_prompt_tokens(messages))
+    else:
+        completion = await complete()
+    details = completion.model_dump()
+    if use_cache:
+        details_cache.set(cache_key, details)
+    remember_answer(invoice_text, extracted_fields, details)
+    return details
+
+
+def build_packed_messages(invoices, reports=None):
+    """
+    Builds one prompt covering several invoices, each under an `## Invoice <id>` heading.
+
+    Args:
+        invoices (list): (invoice_id, invoice_text, extracted_fields) tuples.
+        reports (dict): Optional dict that receives each invoice's compaction report by id.
+    """
+    blocks = []
+    for invoice_id, invoice_text, extracted_fields in invoices:
+        invoice_text, compaction = compact_invoice_text(invoice_text, _settings.prompt_token_budget, model_dict["azure"])
+        if reports is not None:
+            reports[invoice_id] = compaction
+        blocks.append(
+            f"## Invoice {invoice_id}\n"
+            f"### Raw Invoice Text:\n{invoice_text}\n"
+            f"### Some of the fields I already extracted:\n{format_extracted_fields(extracted_fields)}\n"
+        )
+    return [
+        {"role": "system", "content": "You are an expert in extracting structured information from a contructions company's invoices with high accuracy."},
+        {
+            "role": "user",
+            "content": (
+                f"You are provided with the raw text of {len(invoices)} invoices extracted through OCR.\n"
+                + "\n".join(blocks) +
+                "### Important Instructions:\n"
+                "1. Return exactly one entry per invoice, with `invoice_id` set to the id in its heading. Never mix information between invoices.\n"
+                "2. **Only extract information if you are certain about its accuracy.** If a field cannot be determined with confidence, return an empty value.\n"
+                "3. **Do not confuse job site/address with vendor or customer name.** The job location refers to the worksite or project location, not billing/shipping details.\n"
+            )
+        }
+    ]
+
+
+def pack_invoices(invoices, max_invoices=None, token_budget=None):
+    """
+    Groups invoices into packs bounded by count and estimated prompt tokens.
+
+    Args:
+        invoices (list): (key, invoice_text, extracted_fields) tuples.
+        max_invoices (int): Maximum invoices per pack; defaults to `llm_pack_max_invoices`.
+        token_budget (int): Maximum estimated prompt tokens per pack; defaults to `llm_pack_token_budget`.
+
+    Returns:
+        list: Lists of invoices, in input order.
+    """
+    max_invoices = max_invoices or _settings.llm_pack_max_invoices
+    token_budget = token_budget or _settings.llm_pack_token_budget
+    packs, current, used = [], [], 0
+    for invoice in invoices:
+        _, invoice_text, extracted_fields = invoice
+        # Compacted text never exceeds the prompt budget, so that bounds each invoice's share.
+        tokens = min(count_tokens(invoice_text, model_dict["azure"]), _settings.prompt_token_budget or float("inf"))
+        tokens += count_tokens(format_extracted_fields(extracted_fields), model_dict["azure"]) + 20
+        if current and (len(current) >= max_invoices or used + tokens > token_budget):
+            packs.append(current)
+            current, used = [], 0
+        current.append(invoice)
+        used += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+
+async def aextract_invoice_details_packed(invoices, config=None, use_cache=True, async_client=None, scheduler=None, prompt_reports=None):
+    """
+    Enriches several invoices with as few LLM calls as possible.
+
+    Cached invoices are answered from the cache (single-invoice answers first, then packed
+    ones), predictable ones from the vendor memory
+    (see `vendor_memory`). The rest are packed (see `pack_invoices`)
+    into single structured calls returning a list of InvoiceDetails keyed by invoice id.
+    Invoices missing from a packed answer, or whose pack failed, fall back to
+    single-invoice calls.
+
+    Args:
+        invoices (list): (key, invoice_text, extracted_fields) tuples; keys must be unique.
+        config (dict): Environment values with the Azure OpenAI url and key.
+        use_cache (bool): If False, bypass the LLM enrichment cache.
+        async_client: instructor AsyncAzureOpenAI client, see `clients.async_llm_client`.
+        scheduler (ServiceScheduler): Optional rate limiter/retry policy.
+        prompt_reports (dict): Optional dict that receives each invoice's compaction report by key.
+
+    Returns:
+        dict: key -> InvoiceDetails dict, or the exception raised for that invoice.
+    """
+    results = {}
+    pending = []
+    for key, invoice_text, extracted_fields in invoices:
+        cached = cached_answer(
+            details_cache_key(invoice_text, extracted_fields), use_cache,
+            fallback_key=details_cache_key(invoice_text, extracted_fields, packed=True),
+        )
+        if cached is None:
+            cached = predicted_answer(invoice_text, extracted_fields, use_cache)
+        if cached is not None:
+            results[key] = InvoiceDetails.model_validate(cached).model_dump()
+        else:
+            pending.append((key, invoice_text, extracted_fields))
+    if not pending:
+        return results
+
+    llm = LLMFactory("azure", config, async_client=async_client)
+    fallback = []
+
+    async def run_pack(pack):
+        ids = {f"INV{index}": invoice for index, invoice in enumerate(pack, start=1)}
+        reports = {}
+        messages = build_packed_messages(
+            [(invoice_id, invoice_text, fields) for invoice_id, (_, invoice_text, fields) in ids.items()], reports
+        )
+
+        def complete():
+            return llm.acreate_completion(response_model=PackedInvoiceDetailsList, messages=messages)
+
+        try:
+            if scheduler:
+                completion = await scheduler.run(
+                    complete, tokens=estimate_prompt_tokens(messages, completion_tokens=64 * len(pack))
+                )
+            else:
+                completion = await complete()
+        except Exception as e:
+            print(f"Packed enrichment of {len(pack)} invoices failed, retrying one by one: {e}")
+            fallback.extend(pack)
+            return
+
+        answered = {}
+        for entry in completion.invoices:
+            if entry.invoice_id in ids and entry.invoice_id not in answered:
+                answered[entry.invoice_id] = InvoiceDetails.model_validate(entry.model_dump(exclude={"invoice_id"})).model_dump()
+        for invoice_id, (key, invoice_text, extracted_fields) in ids.items():
+            if invoice_id not in answered:
+                fallback.append((key, invoice_text, extracted_fields))
+                continue
+            results[key] = answered[invoice_id]
+            if prompt_reports is not None:
+                prompt_reports[key] = reports[invoice_id]
+            if use_cache:
+                details_cache.set(details_cache_key(invoice_text, extracted_fields, packed=True), answered[invoice_id])
+            remember_answer(invoice_text, extracted_fields, answered[invoice_id])
+
+    packs = pack_invoices(pending)
+    await asyncio.gather(*(run_pack(pack) for pack in packs if len(pack) > 1))
+    fallback.extend(invoice for pack in packs if len(pack) == 1 for invoice in pack)
+
+    async def run_single(key, invoice_text, extracted_fields):
+        report = {}
+        try:
+            results[key] = await aextract_invoice_details(
+                invoice_text, extracted_fields, config, use_cache=use_cache, async_client=async_client,
+                scheduler=scheduler, prompt_report=report,
+            )
+        except Exception as e:
+            results[key] = e
+        if prompt_reports is not None and report:
+            prompt_reports[key] = report
+
+    await asyncio.gather(*(run_single(*invoice) for invoice in fallback))
+    return results
+
+
+def build_header_messages(invoice_text, report=None):
+    """
+    Builds the header prompt of the text layer fast path, compacting the text to `header_token_budget` tokens.
+
+    Args:
+        report (dict): Optional dict that receives tokens_before/tokens_after of the compaction.
+    """
+    invoice_text, compaction = compact_invoice_text(
+        invoice_text, _settings.header_token_budget, model_dict["azure"], for_header=True
+    )
+    if report is not None:
+        report.update(compaction)
+    return [
+        {"role": "system", "content": "You are an expert in extracting structured information from a contructions company's invoices with high accuracy."},
+        {
+            "role": "user",
+            "content": (
+                "You are provided with the embedded text of a digital invoice.\n"
+                f"### Invoice Text:\n{invoice_text}\n"
+                "### Important Instructions:\n"
+                "1. **Only extract information if you are certain about its accuracy.** If a field cannot be determined with confidence, return an empty value.\n"
+                "2. The vendor is the company issuing the invoice, not the customer it is billed or shipped to.\n"
+            )
+        }
+    ]
+
+
+def header_to_fields(header):
+    """
+    Maps an InvoiceHeader to the extracted fields format produced by Document Intelligence.
+
+    The LLM gives no per-field confidence, so confidence is None.
+    """
+    fields = {}
+    total = None
+    if header.total_amount is not None:
+        total = f"{header.total_amount} {header.currency_code or ''}".strip()
+    for name, value in (
+        ("Vendor Name", header.vendor_name),
+        ("Date", header.invoice_date),
+        ("Total Value", total),
+        ("Invoice Number", header.invoice_number),
+    ):
+        if value not in (None, ""):
+            fields[name] = {"value": value, "confidence": None}
+    return fields
+
+
+def header_cache_key(invoice_text, provider="azure"):
+    normalized_text = re.sub(r"\s+", " ", invoice_text or "").strip()
+    schema = json.dumps(InvoiceHeader.model_json_schema(), sort_keys=True)
+    return content_hash(
+        "header", normalized_text, model_dict[provider], str(_settings.temperature),
+        str(_settings.header_token_budget), PROMPT_VERSION, schema,
     )
-    return completion.model_dump()
\ No newline at end of file
+
+
+def extract_invoice_header(invoice_text: str, config=None, use_cache=True):
+    """
+    Extracts the vendor, date, total and invoice number from a born-digital invoice's text,
+    in place of the `prebuilt-invoice` fields.
+
+    Returns:
+        dict: Extracted fields with their values (confidence is None).
+    """
+    cache_key = header_cache_key(invoice_text)
+    cached = cached_answer(cache_key, use_cache)
+    if cached is None:
+        llm = LLMFactory("azure", config)
+        completion = llm.create_completion(response_model=InvoiceHeader, messages=build_header_messages(invoice_text))
+        cached = completion.model_dump()
+        if use_cache:
+            details_cache.set(cache_key, cached)
+    return header_to_fields(InvoiceHeader.model_validate(cached))
+
+
+async def aextract_invoice_header(invoice_text: str, config=None, use_cache=True, async_client=None, scheduler=None):
+    """
+    Async counterpart of `extract_invoice_header`.
+    """
+    cache_key = header_cache_key(invoice_text)
+    cached = cached_answer(cache_key, use_cache)
+    if cached is None:
+        llm = LLMFactory("azure", config, async_client=async_client)
+        messages = build_header_messages(invoice_text)
+
+        def complete():
+            return llm.acreate_completion(response_model=InvoiceHeader, messages=messages)
+
+        if scheduler:
+            completion = await scheduler.run(complete, tokens=estimate_prompt_tokens(messages))
+        else:
+            completion = await complete()
+        cached = completion.model_dump()
+        if use_cache:
+            details_cache.set(cache_key, cached)
+    return header_to_fields(InvoiceHeader.model_validate(cached))
@@ -1,24 +1,26 @@
 from typing import Any, Dict, List, Type
 
-import instructor
 from config.settings import get_settings
-from openai import OpenAI
-from openai import AzureOpenAI
+from metrics import metrics
 from pydantic import BaseModel, Field
 from .utils import model_dict
 
 
 class LLMFactory:
-    def __init__(self, provider: str, config: Dict[str, str]):
+    def __init__(self, provider: str, config: Dict[str, str], async_client: Any = None):
         self.provider = provider
+        self.async_client = async_client
         self.settings = get_settings()
         self.api_key = config['AZURE_API_KEY']
         self.url = config['AZURE_URL']
         self.client = self._initialize_client()
 
     def _initialize_client(self) -> Any:
+        # clients pulls in openai, instructor and httpx; import it only once a client is needed.
+        from clients import get_llm_client
+
         client_initializers = {
-            'azure': lambda: instructor.from_openai(AzureOpenAI(api_key=self.api_key, base_url=self.url, api_version=self.settings.azure_api_version)),
+            'azure': lambda: get_llm_client(self.api_key, self.url, self.settings.azure_api_version),
         }
 
         initializer = client_initializers.get(self.provider)
@@ -26,10 +28,10 @@ class LLMFactory:
             return initializer()
         raise ValueError(f"Unsupported LLM provider: {self.provider}")
 
-    def create_completion(
+    def _completion_params(
         self, response_model: Type[BaseModel], messages: List[Dict[str, str]], **kwargs
-    ) -> Any:
-        completion_params = {
+    ) -> Dict[str, Any]:
+        return {
             "model": model_dict[self.provider],
             "temperature": kwargs.get("temperature", self.settings.temperature),
             "max_retries": kwargs.get("max_retries", self.settings.max_retries),
@@ -37,4 +39,23 @@ class LLMFactory:
             "response_model": response_model,
             "messages": messages,
         }
-        return self.client.chat.completions.create(**completion_params)
\ No newline at end of file
+
+    def create_completion(
+        self, response_model: Type[BaseModel], messages: List[Dict[str, str]], **kwargs
+    ) -> Any:
+        completion_params = self._completion_params(response_model, messages, **kwargs)
+        with metrics.span("llm"):
+            completion = self.client.chat.completions.create(**completion_params)
+        metrics.record_llm_usage(completion, response_model)
+        return completion
+
+    async def acreate_completion(
+        self, response_model: Type[BaseModel], messages: List[Dict[str, str]], **kwargs
+    ) -> Any:
+        if self.async_client is None:
+            raise ValueError("LLMFactory was created without an async client.")
+        completion_params = self._completion_params(response_model, messages, **kwargs)
+        with metrics.span("llm"):
+            completion = await self.async_client.chat.completions.create(**completion_params)
+        metrics.record_llm_usage(completion, response_model)
+        return completion
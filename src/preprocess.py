@@ -0,0 +1,298 @@
+import asyncio
+import importlib.util
+import io
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config.settings import get_settings
+from metrics import metrics
+
+
+GRAYSCALE = "grayscale"
+BILEVEL = "bilevel"
+
+# Blank detection looks at a thumbnail of this size; pixels darker than INK_LEVEL count as ink.
+_THUMBNAIL_SIZE = (256, 256)
+_INK_LEVEL = 128
+
+
+def _imaging():
+    # pypdf and Pillow are optional; without them documents are uploaded unchanged.
+    try:
+        from PIL import Image
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        return None
+    return Image, PdfReader, PdfWriter
+
+
+def imaging_available():
+    """Whether pypdf and Pillow are installed, checked without importing them in this process."""
+    return all(importlib.util.find_spec(name) is not None for name in ("PIL", "pypdf"))
+
+
+def preprocess_options():
+    """Returns the preprocessing settings passed to the worker processes."""
+    settings = get_settings()
+    return {
+        "target_dpi": settings.preprocess_target_dpi,
+        "mode": settings.preprocess_mode,
+        "jpeg_quality": settings.preprocess_jpeg_quality,
+        "blank_ink_ratio": settings.preprocess_blank_ink_ratio,
+        # Pages with less text than this are treated as scans, as in `text_layer.route_document`.
+        "min_text_chars": settings.text_layer_min_chars_per_page // 4,
+    }
+
+
+def ink_ratio(image):
+    """Fraction of dark pixels of an image, measured on a grayscale thumbnail."""
+    gray = image.convert("L")
+    gray.thumbnail(_THUMBNAIL_SIZE)
+    histogram = gray.histogram()
+    return sum(histogram[:_INK_LEVEL]) / max(1, sum(histogram))
+
+
+def image_dpi(image, page):
+    """Resolution at which `image` is drawn when it covers the whole page (an upper bound for smaller images)."""
+    width_inches = float(page.mediabox.width) / 72
+    height_inches = float(page.mediabox.height) / 72
+    if width_inches <= 0 or height_inches <= 0:
+        return None
+    return max(image.width / width_inches, image.height / height_inches)
+
+
+def shrink_image(image, dpi, options, Image):
+    """
+    Downsamples a scanned page image to the target DPI and converts it to grayscale or bilevel.
+
+    Returns:
+        PIL.Image.Image: The new image, or None if there is nothing to gain.
+    """
+    scale = options["target_dpi"] / dpi if dpi else 1.0
+    target_mode = "1" if options["mode"] == BILEVEL else "L"
+    if scale >= 0.95 and image.mode in ("1", target_mode):
+        return None
+    if image.mode in ("RGBA", "LA", "PA"):
+        # Transparent images keep their soft mask; replacing them could change the page.
+        return None
+    shrunk = image.convert("L")
+    if scale < 0.95:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        shrunk = shrunk.resize(size, Image.LANCZOS)
+    if target_mode == "1":
+        shrunk = shrunk.convert("1", dither=Image.Dither.NONE)
+    return shrunk
+
+
+def preprocess_pdf(document_bytes, options):
+    """
+    Shrinks the scanned pages of a PDF before it is uploaded for OCR. Runs in a worker process.
+
+    Only image-only pages are touched: their images are downsampled to the target DPI,
+    converted to grayscale (recompressed as JPEG) or bilevel, and pages with almost no ink
+    are dropped. Pages with a text layer are copied as they are.
+
+    Args:
+        document_bytes (bytes): The PDF.
+        options (dict): See `preprocess_options`.
+
+    Returns:
+        dict: bytes (the smaller PDF, or None to upload the original), bytes_before, bytes_after,
+              pages, image_pages, images, blank_pages and kept_pages (1-based page numbers of the
+              original) and seconds.
+    """
+    started = time.perf_counter()
+    report = {
+        "bytes": None,
+        "bytes_before": len(document_bytes),
+        "bytes_after": len(document_bytes),
+        "pages": 0,
+        "image_pages": 0,
+        "images": 0,
+        "blank_pages": [],
+        "kept_pages": [],
+        "seconds": 0.0,
+    }
+    imaging = _imaging()
+    if imaging is None:
+        return report
+    Image, PdfReader, PdfWriter = imaging
+
+    reader = PdfReader(io.BytesIO(document_bytes))
+    report["pages"] = len(reader.pages)
+    scans = {}
+    for number, page in enumerate(reader.pages, start=1):
+        images = [image.image for image in page.images]
+        if images and len((page.extract_text() or "").strip()) < options["min_text_chars"]:
+            report["image_pages"] += 1
+            if all(ink_ratio(image) < options["blank_ink_ratio"] for image in images):
+                report["blank_pages"].append(number)
+                continue
+            scans[number] = images
+        report["kept_pages"].append(number)
+
+    if not report["kept_pages"]:
+        # Nothing but blank pages: let the service see the original.
+        report["blank_pages"] = []
+        report["kept_pages"] = list(range(1, report["pages"] + 1))
+        report["seconds"] = time.perf_counter() - started
+        return report
+    if not scans and not report["blank_pages"]:
+        report["seconds"] = time.perf_counter() - started
+        return report
+
+    writer = PdfWriter()
+    for number in report["kept_pages"]:
+        writer.add_page(reader.pages[number - 1])
+    for page, number in zip(writer.pages, report["kept_pages"]):
+        if number not in scans:
+            continue
+        for image_file, image in zip(page.images, scans[number]):
+            shrunk = shrink_image(image, image_dpi(image, page), options, Image)
+            if shrunk is not None:
+                # Bilevel images are stored losslessly; pypdf only takes a quality for JPEG.
+                quality = {} if shrunk.mode == "1" else {"quality": options["jpeg_quality"]}
+                image_file.replace(shrunk, **quality)
+                report["images"] += 1
+    if not report["images"] and not report["blank_pages"]:
+        # Every scan is already small enough; a rewritten copy would only differ in its layout.
+        report["seconds"] = time.perf_counter() - started
+        return report
+
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    report["seconds"] = time.perf_counter() - started
+    if buffer.tell() < len(document_bytes):
+        report["bytes"] = buffer.getvalue()
+        report["bytes_after"] = len(report["bytes"])
+    else:
+        report["blank_pages"] = []
+        report["kept_pages"] = list(range(1, report["pages"] + 1))
+    return report
+
+
+def remap_pages(parts, kept_pages):
+    """Maps the page ranges of parts analyzed from a preprocessed PDF back to the original page numbers."""
+    if not kept_pages or kept_pages == list(range(1, len(kept_pages) + 1)):
+        return parts
+
+    def original(page):
+        page = int(page)
+        return kept_pages[page - 1] if 0 < page <= len(kept_pages) else page
+
+    remapped = []
+    for fields, text, pages in parts:
+        if pages:
+            first, _, last = str(pages).partition("-")
+            first, last = original(first), original(last or first)
+            pages = str(first) if first == last else f"{first}-{last}"
+        remapped.append((fields, text, pages))
+    return remapped
+
+
+def mean_confidence(parts, field_names):
+    """
+    Mean confidence of the `field_names` found over all parts.
+
+    Fields the service did not find are left out: many invoices simply lack one, and counting
+    it as 0 would send every such file to OCR a second time.
+    """
+    confidences = [
+        fields[name]["confidence"]
+        for fields, *_ in parts
+        for name in field_names
+        if (fields.get(name) or {}).get("confidence") is not None
+    ]
+    return sum(confidences) / len(confidences) if confidences else 0.0
+
+
+def describe_preprocess(report):
+    """One-line summary of a preprocessing report for the Route column."""
+    if not report:
+        return None
+    if report["bytes_after"] >= report["bytes_before"]:
+        summary = "not preprocessed"
+    else:
+        saved = report["bytes_before"] - report["bytes_after"]
+        summary = (
+            f"preprocessed {report['bytes_before'] / 1e6:.2f} MB -> {report['bytes_after'] / 1e6:.2f} MB"
+            f" (-{saved / report['bytes_before'] * 100:.0f}%)"
+        )
+        if report.get("blank_pages"):
+            summary += f", {len(report['blank_pages'])} blank page(s) dropped"
+    if report.get("ocr_seconds") is not None:
+        summary += f", OCR {report['ocr_seconds']:.1f}s"
+    if report.get("fallback"):
+        summary += f", original used (confidence {report['confidence']:.2f} < {report['min_confidence']:.2f})"
+    return summary
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_preprocess_pool():
+    """
+    Returns the process-wide pool preprocessing runs in, so image work is not serialized by the GIL.
+
+    A frozen (PyInstaller) executable gets a thread pool instead: spawned worker processes would
+    start the executable itself again rather than a worker.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            executor = ThreadPoolExecutor if getattr(sys, "frozen", False) else ProcessPoolExecutor
+            _pool = executor(max_workers=get_settings().preprocess_workers or None)
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _finish(report, error):
+    if error is not None:
+        print(f"Preprocessing failed, uploading the original: {error}")
+        if isinstance(error, BrokenProcessPool):
+            _reset_pool()
+        metrics.incr("preprocess", outcome="error")
+        return None
+    metrics.observe("preprocess", report["seconds"])
+    metrics.incr("preprocess", outcome="shrunk" if report["bytes"] is not None else "unchanged")
+    metrics.incr("preprocess_bytes_saved", report["bytes_before"] - report["bytes_after"])
+    return report
+
+
+def preprocess_document(document_bytes):
+    """
+    Preprocesses a PDF in the process pool; see `preprocess_pdf`.
+
+    Returns:
+        dict: The preprocessing report, or None if preprocessing is disabled or failed.
+    """
+    if not get_settings().preprocess_enabled or not imaging_available():
+        return None
+    try:
+        report = get_preprocess_pool().submit(preprocess_pdf, document_bytes, preprocess_options()).result()
+    except Exception as e:
+        return _finish(None, e)
+    return _finish(report, None)
+
+
+async def apreprocess_document(document_bytes):
+    """Async counterpart of `preprocess_document`."""
+    if not get_settings().preprocess_enabled or not imaging_available():
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        report = await loop.run_in_executor(get_preprocess_pool(), preprocess_pdf, document_bytes, preprocess_options())
+    except Exception as e:
+        return _finish(None, e)
+    return _finish(report, None)
@@ -0,0 +1,309 @@
+import asyncio
+import email.utils
+import threading
+import time
+
+from config.settings import get_settings
+from metrics import metrics
+
+
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+def parse_retry_after(headers):
+    """
+    Reads the server's requested back-off from response headers.
+
+    Supports `retry-after-ms`, `x-ms-retry-after-ms` and `Retry-After` (seconds or HTTP date).
+
+    Args:
+        headers (Mapping): Response headers.
+
+    Returns:
+        float: Seconds to wait, or None if the server did not say.
+    """
+    if not headers:
+        return None
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def throttle_info(error):
+    """
+    Finds an HTTP status code and Retry-After in an exception or its causes.
+
+    Works for azure-core HttpResponseError and openai APIStatusError, including
+    when they are wrapped by instructor's retry exceptions.
+
+    Returns:
+        tuple: (status_code, retry_after_seconds); either can be None.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        status = getattr(error, "status_code", None)
+        response = getattr(error, "response", None)
+        if status is None and response is not None:
+            status = getattr(response, "status_code", None)
+        if status is not None:
+            headers = getattr(response, "headers", None)
+            return status, parse_retry_after(headers)
+        error = error.__cause__ or error.__context__
+    return None, None
+
+
+def estimate_prompt_tokens(messages, completion_tokens=256):
+    """
+    Cheap token estimate (~4 characters per token) used to budget LLM requests against TPM quotas.
+    """
+    characters = sum(len(message.get("content") or "") for message in messages)
+    return characters // 4 + completion_tokens
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket usable from any event loop.
+
+    Args:
+        rate (float): Tokens added per second; falsy means unlimited.
+        capacity (float): Burst size; defaults to one second worth of tokens.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    async def acquire(self, tokens=1):
+        if not self.rate:
+            return
+        # A single request larger than the bucket would never fit; let it through at full capacity.
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency limit driven by observed latency and throttling.
+
+    The limit grows by roughly one slot per round trip while latency stays close to
+    the best seen, backs off gently when latency climbs, and halves on throttling,
+    pausing all new requests until the server's Retry-After has passed.
+
+    Args:
+        initial (int): Starting limit.
+        minimum (int): Lowest allowed limit.
+        maximum (int): Highest allowed limit.
+        latency_tolerance (float): Latency above `tolerance * best latency` counts as congestion.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=64, latency_tolerance=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self._best_latency = None
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._blocked_until and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                wait = max(self._blocked_until - now, 0.05)
+            await asyncio.sleep(min(wait, 1.0))
+
+    def _decrease(self, factor, now):
+        # Only back off once per round trip, so a burst of errors from the same window counts once.
+        window = self._best_latency or 1.0
+        if now - self._last_decrease >= window:
+            self.limit = max(self.minimum, self.limit * factor)
+            self._last_decrease = now
+
+    def release(self, latency=None):
+        with self._lock:
+            self.in_flight -= 1
+            if latency is None:
+                return
+            now = time.monotonic()
+            if self._best_latency is None or latency < self._best_latency:
+                self._best_latency = latency
+            else:
+                # Let the baseline drift up slowly so a permanently slower service is not punished forever.
+                self._best_latency *= 1.01
+            if latency > self._best_latency * self.latency_tolerance:
+                self._decrease(0.9, now)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            self._decrease(0.5, now)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+    def pause(self, seconds):
+        """Holds back new requests for `seconds` without changing the limit."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class ServiceScheduler:
+    """
+    Admission control for one remote service: request and token buckets, an adaptive
+    concurrency limit, and retries that honor Retry-After on 429/503 responses.
+
+    When the service's client reports every response through `observe_response`, throttled
+    responses are counted there, and a throttling error reaching `run` only triggers the retry.
+
+    Args:
+        name (str): Service name, used in stats.
+        concurrency (int): Starting number of requests in flight.
+        requests_per_second (float): Request rate budget; falsy means unlimited.
+        tokens_per_second (float): Token rate budget for LLM calls; falsy means unlimited.
+        max_attempts (int): Attempts per call before a throttling error is raised.
+        max_concurrency (int): Highest limit the adaptive concurrency may probe; defaults to twice `concurrency`.
+    """
+
+    def __init__(self, name, concurrency, requests_per_second=None, tokens_per_second=None, max_attempts=6, max_concurrency=None):
+        self.name = name
+        self.requests = TokenBucket(requests_per_second)
+        self.tokens = TokenBucket(tokens_per_second, capacity=tokens_per_second * 10 if tokens_per_second else None)
+        self.concurrency = AdaptiveConcurrency(concurrency, maximum=max_concurrency or 2 * concurrency)
+        self.max_attempts = max_attempts
+        self.calls = 0
+        self.throttles = 0
+        self.observes_responses = False
+        self._lock = threading.Lock()
+
+    def _count_throttle(self, retry_after):
+        with self._lock:
+            self.throttles += 1
+        metrics.incr("throttles", service=self.name)
+        self.concurrency.throttled(retry_after)
+
+    def observe_response(self, pipeline_response):
+        """
+        azure-core `raw_response_hook`: feeds throttled responses, including the ones
+        the SDK retries on its own, into the concurrency limit.
+        """
+        self.observes_responses = True
+        http_response = pipeline_response.http_response
+        if http_response.status_code in THROTTLE_STATUS_CODES:
+            self._count_throttle(parse_retry_after(http_response.headers))
+
+    async def run(self, call, tokens=0):
+        """
+        Runs `await call()` under the scheduler.
+
+        Args:
+            call (callable): Zero-argument function returning a coroutine.
+            tokens (int): Estimated tokens consumed by the call.
+
+        Returns:
+            The result of the call.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            await self.requests.acquire()
+            if tokens:
+                await self.tokens.acquire(tokens)
+            await self.concurrency.acquire()
+            started = time.monotonic()
+            try:
+                result = await call()
+            except Exception as e:
+                self.concurrency.release()
+                status, retry_after = throttle_info(e)
+                if status not in THROTTLE_STATUS_CODES or attempt == self.max_attempts:
+                    raise
+                # Without a Retry-After, fall back to exponential back-off.
+                if self.observes_responses:
+                    # `observe_response` counted this response already.
+                    self.concurrency.pause(retry_after or min(60.0, 2 ** attempt))
+                else:
+                    self._count_throttle(retry_after or min(60.0, 2 ** attempt))
+                metrics.incr("retries", service=self.name, reason="throttled")
+                continue
+            self.concurrency.release(time.monotonic() - started)
+            with self._lock:
+                self.calls += 1
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "service": self.name,
+                "calls": self.calls,
+                "throttles": self.throttles,
+                "concurrency_limit": int(self.concurrency.limit),
+                "in_flight": self.concurrency.in_flight,
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(service):
+    """
+    Returns the process-wide scheduler for "document_intelligence" or "azure_openai".
+
+    The schedulers are shared by every batch so concurrent batches draw from the same quota.
+    """
+    with _schedulers_lock:
+        scheduler = _schedulers.get(service)
+        if scheduler is None:
+            settings = get_settings()
+            if service == "document_intelligence":
+                scheduler = ServiceScheduler(
+                    service,
+                    settings.max_concurrency,
+                    requests_per_second=settings.document_intelligence_rps,
+                    max_attempts=settings.scheduler_max_attempts,
+                )
+            elif service == "azure_openai":
+                scheduler = ServiceScheduler(
+                    service,
+                    settings.max_concurrency,
+                    requests_per_second=settings.llm_requests_per_minute / 60,
+                    tokens_per_second=settings.llm_tokens_per_minute / 60,
+                    max_attempts=settings.scheduler_max_attempts,
+                )
+            else:
+                raise ValueError(f"Unknown service: {service}")
+            _schedulers[service] = scheduler
+        return scheduler
@@ -0,0 +1,139 @@
+import io
+import re
+
+from config.settings import get_settings
+from preprocess import describe_preprocess
+
+
+TEXT_LAYER = "text-layer"
+OCR = "ocr"
+
+# Characters we expect in invoice text; anything else counts towards the garbage ratio.
+_EXPECTED_CHARS = re.compile(r"[\w\s.,:;!?'\"()\[\]{}<>/\\|@#$%&*+=\-_~^`°€£¥§]")
+_CID_GLYPH = re.compile(r"\(cid:\d+\)")
+
+
+def new_decision(route, reason=""):
+    """Returns an empty routing decision dict for `route`."""
+    return {"route": route, "reason": reason, "pages": 0, "chars_per_page": 0.0, "garbage_ratio": None, "text": None}
+
+
+def _pdf_reader():
+    # pypdf is optional and imported on first use; without it every document goes to OCR.
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    return PdfReader
+
+
+def extract_text_layer(document_bytes):
+    """
+    Extracts the embedded text of every page of a PDF.
+
+    Args:
+        document_bytes (bytes): The PDF.
+
+    Returns:
+        list: One string per page, or None if the text layer could not be read.
+    """
+    PdfReader = _pdf_reader()
+    if PdfReader is None:
+        return None
+    try:
+        reader = PdfReader(io.BytesIO(document_bytes))
+        return [page.extract_text() or "" for page in reader.pages]
+    except Exception as e:
+        print(f"Could not read the text layer: {e}")
+        return None
+
+
+def count_pages(document_bytes):
+    """Returns the number of pages of a PDF, or None if it cannot be read (or pypdf is missing)."""
+    PdfReader = _pdf_reader()
+    if PdfReader is None:
+        return None
+    try:
+        return len(PdfReader(io.BytesIO(document_bytes)).pages)
+    except Exception as e:
+        print(f"Could not count the pages: {e}")
+        return None
+
+
+def garbage_ratio(text):
+    """
+    Fraction of characters that are unlikely to be real invoice text
+    (replacement characters, control codes, unmapped `(cid:N)` glyphs, ...).
+    """
+    if not text:
+        return 1.0
+    cid_chars = sum(len(match) for match in _CID_GLYPH.findall(text))
+    text = _CID_GLYPH.sub("", text)
+    unexpected = sum(1 for char in text if not _EXPECTED_CHARS.match(char))
+    return (unexpected + cid_chars) / (len(text) + cid_chars)
+
+
+def route_document(document_bytes):
+    """
+    Decides whether a PDF can skip cloud OCR because it has a good embedded text layer.
+
+    A document goes to the local text path only if it has at most `analyze_shard_pages` pages,
+    every page has text, the average characters per page reach `text_layer_min_chars_per_page`,
+    and the garbage ratio stays below `text_layer_max_garbage_ratio`. Scanned images have no
+    (or a junk) text layer and are routed to full OCR, as are long files, which the fast path
+    would read as a single invoice.
+
+    Args:
+        document_bytes (bytes): The PDF.
+
+    Returns:
+        dict: route ("text-layer" or "ocr"), reason, pages, chars_per_page, garbage_ratio,
+              and text (the joined page text, only set for the text-layer route).
+    """
+    settings = get_settings()
+    decision = new_decision(OCR)
+    if not settings.text_layer_fast_path:
+        decision["reason"] = "fast path disabled"
+        return decision
+
+    pages = extract_text_layer(document_bytes)
+    if not pages:
+        decision["reason"] = "no readable text layer"
+        return decision
+
+    text = "\n".join(pages)
+    page_chars = [len(page.strip()) for page in pages]
+    decision["pages"] = len(pages)
+    decision["chars_per_page"] = sum(page_chars) / len(pages)
+    decision["garbage_ratio"] = garbage_ratio(text)
+
+    min_chars = settings.text_layer_min_chars_per_page
+    if settings.analyze_shard_pages and len(pages) > settings.analyze_shard_pages:
+        # Long files often hold several invoices; OCR splits them (and shards the analysis).
+        decision["reason"] = f"{len(pages)} pages is above {settings.analyze_shard_pages}, split by OCR"
+    elif min(page_chars) < min_chars / 4:
+        decision["reason"] = "some pages have no text (scanned)"
+    elif decision["chars_per_page"] < min_chars:
+        decision["reason"] = f"{decision['chars_per_page']:.0f} chars/page is below {min_chars}"
+    elif decision["garbage_ratio"] > settings.text_layer_max_garbage_ratio:
+        decision["reason"] = f"garbage ratio {decision['garbage_ratio']:.2f} is too high"
+    else:
+        decision["route"] = TEXT_LAYER
+        decision["reason"] = "good embedded text layer"
+        decision["text"] = text
+    return decision
+
+
+def describe_route(decision):
+    """One-line, human readable summary of a routing decision for reports."""
+    if decision is None:
+        return None
+    summary = f"{decision['route']}: {decision['reason']}"
+    if decision["pages"]:
+        summary += f" ({decision['pages']} pages, {decision['chars_per_page']:.0f} chars/page"
+        if decision["garbage_ratio"] is not None:
+            summary += f", garbage {decision['garbage_ratio']:.2f}"
+        summary += ")"
+    if decision.get("preprocess"):
+        summary += f"; {describe_preprocess(decision['preprocess'])}"
+    return summary
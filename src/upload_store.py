@@ -0,0 +1,212 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from config.settings import get_settings
+from metrics import metrics
+
+
+# Upload copies written by earlier versions of the app: "<uuid4>.pdf" directly in the temp directory.
+_LEGACY_UPLOAD = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.pdf$")
+
+# Partial writes older than this are left over from a crash and removed by `cleanup`.
+_STALE_TMP_SECONDS = 3600
+
+
+def _unused_for(entry, seconds, now):
+    try:
+        return now - entry.stat().st_mtime > seconds
+    except OSError:
+        return False
+
+
+class UploadStore:
+    """
+    Content-addressed store for uploaded files with a disk quota.
+
+    Each upload is written once, named after the sha256 of its bytes (the same key as
+    `journal.file_hash`), so uploading the same file again or a Streamlit rerun reuses the
+    stored copy and only touches it. The file modification time is used as the last-use
+    time: files unused for longer than `max_age_seconds` are removed on startup (see `cleanup`),
+    and the least recently used ones are evicted once the store grows beyond `max_bytes`.
+    Files held by a running job (see `hold`) are never removed.
+
+    Args:
+        directory (str): Directory where the uploads are stored.
+        max_bytes (int): Total size budget of the store.
+        max_age_seconds (float): Uploads not used for longer than this are removed.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, max_age_seconds=7 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.evictions = 0
+        self._size = None
+        self._held = Counter()
+        self._lock = threading.Lock()
+
+    def path_for(self, key, suffix=".pdf"):
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    def put(self, data, suffix=".pdf"):
+        """
+        Stores the bytes of an upload unless the same content is stored already.
+
+        Args:
+            data (bytes): The uploaded file.
+            suffix (str): File extension of the stored copy.
+
+        Returns:
+            str: Path to the stored upload.
+        """
+        path = self.path_for(hashlib.sha256(data).hexdigest(), suffix)
+        with metrics.span("save"):
+            try:
+                os.utime(path)
+                metrics.incr("uploads", outcome="deduplicated")
+                return path
+            except FileNotFoundError:
+                pass
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file first so a job never reads a partial upload.
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        metrics.incr("uploads", outcome="stored")
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+        return path
+
+    @contextmanager
+    def hold(self, paths):
+        """Keeps `paths` from being evicted while the block runs (e.g. while a job processes them)."""
+        paths = [os.path.abspath(path) for path in paths]
+        with self._lock:
+            self._held.update(paths)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held.subtract(paths)
+                self._held += Counter()
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # Called with the lock held: drop expired uploads, then the least recently
+        # used ones until we are back under 90% of the budget.
+        now = time.time()
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for mtime, size, path in entries:
+            expired = self.max_age_seconds and now - mtime > self.max_age_seconds
+            if not expired and total <= target:
+                break
+            if self._held[os.path.abspath(path)]:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+            metrics.incr("upload_evictions")
+        self._size = total
+
+    def cleanup(self, legacy_dir=None):
+        """
+        Removes partial writes left by a crash, expired uploads and, over the quota, the least
+        recently used ones. Called once when the store is first used in a process.
+
+        Args:
+            legacy_dir (str): Directory holding the uuid-named upload copies of earlier versions;
+                              those unused for longer than `max_age_seconds` are removed too.
+
+        Returns:
+            int: Number of files removed.
+        """
+        now = time.time()
+        removed = 0
+        candidates = []
+        if os.path.isdir(self.directory):
+            candidates += [
+                entry.path for entry in os.scandir(self.directory)
+                if entry.name.endswith(".tmp") and _unused_for(entry, _STALE_TMP_SECONDS, now)
+            ]
+        if legacy_dir and os.path.isdir(legacy_dir):
+            candidates += [
+                entry.path for entry in os.scandir(legacy_dir)
+                if _LEGACY_UPLOAD.match(entry.name) and _unused_for(entry, self.max_age_seconds, now)
+            ]
+        for path in candidates:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue
+        with self._lock:
+            evictions = self.evictions
+            self._evict()
+            removed += self.evictions - evictions
+        return removed
+
+    def stats(self):
+        """Returns the number of stored uploads, their size and the evictions so far."""
+        entries = self._entries()
+        with self._lock:
+            return {"entries": len(entries), "bytes": sum(size for _, size, _ in entries), "evictions": self.evictions}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_upload_store(legacy_dir=None):
+    """
+    Returns the process-wide upload store at `upload_store_dir`; the first call cleans it up.
+
+    Args:
+        legacy_dir (str): Directory with upload copies of earlier versions, see `UploadStore.cleanup`.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            settings = get_settings()
+            _store = UploadStore(
+                settings.upload_store_dir,
+                max_bytes=settings.upload_store_max_bytes,
+                max_age_seconds=settings.upload_store_max_age_days * 24 * 3600,
+            )
+            removed = _store.cleanup(legacy_dir=legacy_dir)
+            if removed:
+                print(f"Removed {removed} old uploads from {settings.upload_store_dir}.")
+        return _store
@@ -0,0 +1,369 @@
+"""
+Local classifier that answers InvoiceDetails for repeat vendors without calling the LLM.
+
+Usage (report on the memory collected so far):
+    python vendor_memory.py --holdout 0.2 --threshold 0.9
+"""
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+
+from compaction import RELEVANT_KEYWORDS
+from config.settings import get_settings
+from duplicates import normalize_vendor
+from metrics import metrics
+
+
+# Fields predicted as classes from the vendor and keyword features; job_location is matched separately.
+CLASS_FIELDS = ("expense_type", "approval")
+
+# Prefix of the features naming an earlier job location of the vendor that appears in the text.
+LOCATION_FEATURE = "job_location:"
+
+# Prefix of the features for words that show an invoice names a job of its own.
+JOB_MARKER_FEATURE = "job_marker:"
+JOB_MARKERS = ("job", "jobsite", "job site", "site", "project", "ship to", "deliver to")
+
+# Approval keywords that decide the approval of an invoice. Approved and Denied are only answered
+# when one of their markers appears in the text, and other labels only when none does.
+APPROVAL_MARKERS = {
+    "approved": ("approved", "approve", "ok to pay", "authorized"),
+    "denied": ("denied", "deny", "rejected", "hold"),
+}
+_UNDECIDED_BLOCKERS = {"approval", *(marker for markers in APPROVAL_MARKERS.values() for marker in markers)}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS examples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    vendor TEXT NOT NULL,
+    features TEXT NOT NULL,
+    expense_type TEXT,
+    approval TEXT,
+    job_location TEXT,
+    recorded_at REAL NOT NULL
+);
+"""
+
+def _patterns(keywords):
+    return {keyword: re.compile(r"\b" + re.escape(keyword) + r"\b") for keyword in keywords}
+
+
+_FEATURE_PATTERNS = {
+    **{field + ":": _patterns(RELEVANT_KEYWORDS[field]) for field in CLASS_FIELDS},
+    JOB_MARKER_FEATURE: _patterns(JOB_MARKERS),
+}
+
+
+def text_features(invoice_text):
+    """
+    Returns the sorted features of the keywords that appear in the invoice text:
+    "field:keyword" for the class fields and "job_marker:keyword" for the job markers.
+    """
+    text = (invoice_text or "").lower()
+    return sorted(
+        prefix + keyword
+        for prefix, patterns in _FEATURE_PATTERNS.items()
+        for keyword, pattern in patterns.items()
+        if pattern.search(text)
+    )
+
+
+def approval_evidence(label, features):
+    """True if the text backs an approval label, see `APPROVAL_MARKERS`."""
+    present = {feature.split(":", 1)[1] for feature in features if feature.startswith("approval:")}
+    label = (label or "").lower()
+    for kind, markers in APPROVAL_MARKERS.items():
+        if label.startswith(kind[:4]):
+            return any(marker in present for marker in markers)
+    return not present & _UNDECIDED_BLOCKERS
+
+
+def vendor_of(extracted_fields):
+    return normalize_vendor((extracted_fields.get("Vendor Name") or {}).get("value"))
+
+
+class VendorModel:
+    """
+    Naive Bayes over the vendor and the keyword features, one per class field, plus a memory of
+    each vendor's job locations.
+
+    Features are "field:keyword" strings (see `text_features`) plus "job_location:<location>"
+    for each earlier location of the vendor found in the text (see `location_features`).
+
+    For expense_type and approval the posterior of every label seen so far is computed from the
+    label prior, the (smoothed) share of the vendor's invoices with that label and whether each
+    of the field's keywords appears in the text. An unseen label takes part with zero counts, so
+    a vendor whose invoices all had the same label is never answered with certainty.
+
+    Only expense_type is stable per vendor; approval and job_location are facts about the invoice,
+    so they also need evidence in its text. approval is answered only when its markers back the
+    label (see `approval_evidence`). job_location is answered only when exactly one of the vendor's
+    earlier locations appears in the text, or as "" when the vendor's invoices have had no location
+    so far and the text has no job marker. The confidence of a prediction is the lowest of its
+    three fields.
+
+    Args:
+        min_examples (int): Invoices of a vendor needed before it is answered at all.
+    """
+
+    def __init__(self, min_examples=3):
+        self.min_examples = min_examples
+        self.examples = 0
+        self.vendors = Counter()
+        self.labels = {field: Counter() for field in CLASS_FIELDS}
+        self.vendor_labels = {field: {} for field in CLASS_FIELDS}
+        self.feature_labels = {field: {} for field in CLASS_FIELDS}
+        self.locations = {}
+
+    def learn(self, vendor, features, details):
+        self.examples += 1
+        self.vendors[vendor] += 1
+        for field in CLASS_FIELDS:
+            label = details.get(field) or ""
+            self.labels[field][label] += 1
+            self.vendor_labels[field].setdefault(vendor, Counter())[label] += 1
+            for feature in features:
+                if feature.startswith(field + ":"):
+                    self.feature_labels[field].setdefault(feature, Counter())[label] += 1
+        self.locations.setdefault(vendor, Counter())[(details.get("job_location") or "").strip()] += 1
+
+    def _classify(self, field, vendor, features):
+        labels = self.labels[field]
+        vendor_counts = self.vendor_labels[field].get(vendor, Counter())
+        present = {feature for feature in features if feature.startswith(field + ":")}
+        vendor_total = len(self.vendors) + 1
+        scores = {}
+        # None stands for a label not seen so far; it keeps the posterior of a lone label below 1.
+        for label, count in (*labels.items(), (None, 0)):
+            score = math.log((count + 1) / (self.examples + len(labels) + 1))
+            score += math.log((vendor_counts[label] + 1) / (count + vendor_total))
+            for feature, feature_counts in self.feature_labels[field].items():
+                share = (feature_counts[label] + 1) / (count + 2)
+                score += math.log(share if feature in present else 1 - share)
+            scores[label] = score
+        best = max(scores, key=scores.get)
+        if best is None:
+            return None, 0.0
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1 / total
+
+    def location_features(self, vendor, invoice_text):
+        """Returns a "job_location:<location>" feature for each known location of the vendor found in the text."""
+        text = (invoice_text or "").lower()
+        return sorted(
+            LOCATION_FEATURE + location
+            for location in self.locations.get(vendor, ())
+            if location and location.lower() in text
+        )
+
+    def _job_location(self, vendor, features):
+        locations = self.locations.get(vendor, Counter())
+        found = [
+            feature[len(LOCATION_FEATURE):] for feature in features
+            if feature.startswith(LOCATION_FEATURE) and locations[feature[len(LOCATION_FEATURE):]]
+        ]
+        if len(found) == 1:
+            return found[0], 1.0
+        if found or any(feature.startswith(JOB_MARKER_FEATURE) for feature in features):
+            # Several known locations, or the invoice names a job the vendor memory does not know.
+            return None, 0.0
+        # Nothing known appears in the text: answer "" only for vendors whose invoices never had a location.
+        return "", (locations[""] + 1) / (sum(locations.values()) + 2)
+
+    def predict(self, vendor, features):
+        """
+        Returns:
+            tuple: (details dict, confidence), or (None, 0.0) for a vendor with too few invoices.
+        """
+        if not vendor or self.vendors[vendor] < self.min_examples:
+            return None, 0.0
+        details = {}
+        confidences = []
+        for field in CLASS_FIELDS:
+            details[field], confidence = self._classify(field, vendor, features)
+            confidences.append(confidence)
+        details["job_location"], confidence = self._job_location(vendor, features)
+        confidences.append(confidence)
+        if any(value is None for value in details.values()) or not approval_evidence(details["approval"], features):
+            return None, 0.0
+        return details, min(confidences)
+
+
+class VendorMemory:
+    """
+    Persistent vendor memory: every InvoiceDetails answered by the LLM is stored as an
+    example in SQLite and learned by an in-memory `VendorModel`, rebuilt from the examples
+    on first use.
+
+    Args:
+        path (str): Path to the SQLite database file.
+        threshold (float): Minimum confidence to answer without the LLM; defaults to `vendor_memory_threshold`.
+        min_examples (int): Invoices of a vendor needed before it is answered; defaults to `vendor_memory_min_examples`.
+    """
+
+    def __init__(self, path, threshold=None, min_examples=None):
+        settings = get_settings()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.threshold = settings.vendor_memory_threshold if threshold is None else threshold
+        self.min_examples = settings.vendor_memory_min_examples if min_examples is None else min_examples
+        self._model = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+
+    def _examples(self):
+        rows = self._conn.execute("SELECT * FROM examples ORDER BY id").fetchall()
+        return [
+            (row["vendor"], json.loads(row["features"]),
+             {"expense_type": row["expense_type"], "approval": row["approval"], "job_location": row["job_location"]})
+            for row in rows
+        ]
+
+    def _loaded_model(self):
+        # Called with the lock held.
+        if self._model is None:
+            self._model = VendorModel(self.min_examples)
+            for example in self._examples():
+                self._model.learn(*example)
+        return self._model
+
+    def predict(self, invoice_text, extracted_fields):
+        """
+        Answers an invoice's details from memory.
+
+        Returns:
+            dict: InvoiceDetails dict, or None if the vendor is unknown or the confidence is below the threshold.
+        """
+        vendor = vendor_of(extracted_fields)
+        with self._lock:
+            model = self._loaded_model()
+            features = text_features(invoice_text) + model.location_features(vendor, invoice_text)
+            details, confidence = model.predict(vendor, features)
+        if details is None or confidence < self.threshold:
+            metrics.incr("vendor_memory", outcome="fallback")
+            return None
+        metrics.incr("vendor_memory", outcome="answered")
+        return details
+
+    def learn(self, invoice_text, extracted_fields, details):
+        """Stores an InvoiceDetails answer of the LLM as a new example."""
+        vendor = vendor_of(extracted_fields)
+        if not vendor or not details:
+            return
+        with self._lock, self._conn:
+            # Location matches are taken against what the model knew before this example, as in `predict`.
+            features = text_features(invoice_text) + self._loaded_model().location_features(vendor, invoice_text)
+            self._conn.execute(
+                "INSERT INTO examples (vendor, features, expense_type, approval, job_location, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (vendor, json.dumps(features), details.get("expense_type"), details.get("approval"),
+                 details.get("job_location"), time.time()),
+            )
+            self._model.learn(vendor, features, details)
+
+    def evaluate(self, holdout=0.2, threshold=None):
+        """
+        Replays the newest `holdout` share of the examples against a model trained on the older ones.
+
+        Every held-out example is answered from memory when confident enough (a saved LLM call)
+        and then learned, as in production. The agreement rate compares the answered ones with
+        the LLM's actual answer.
+
+        Returns:
+            dict: examples, train, test, threshold, answered, llm_call_reduction, agreement and per-field agreement.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            examples = self._examples()
+        split = int(len(examples) * (1 - holdout))
+        model = VendorModel(self.min_examples)
+        for example in examples[:split]:
+            model.learn(*example)
+
+        answered = agreed = 0
+        field_agreed = Counter()
+        for vendor, features, details in examples[split:]:
+            predicted, confidence = model.predict(vendor, features)
+            if predicted is not None and confidence >= threshold:
+                answered += 1
+                matches = {field: (predicted[field] or "") == (details[field] or "") for field in predicted}
+                field_agreed.update(field for field, match in matches.items() if match)
+                agreed += all(matches.values())
+            model.learn(vendor, features, details)
+
+        test = len(examples) - split
+        return {
+            "examples": len(examples),
+            "train": split,
+            "test": test,
+            "threshold": threshold,
+            "answered": answered,
+            "llm_call_reduction": round(answered / test, 4) if test else None,
+            "agreement": round(agreed / answered, 4) if answered else None,
+            "field_agreement": {
+                field: round(field_agreed[field] / answered, 4) if answered else None
+                for field in (*CLASS_FIELDS, "job_location")
+            },
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_memory = None
+_memory_lock = threading.Lock()
+
+
+def get_vendor_memory():
+    """Returns the process-wide vendor memory at `vendor_memory_path`, or None if it is disabled."""
+    global _memory
+    settings = get_settings()
+    if not settings.vendor_memory_enabled:
+        return None
+    with _memory_lock:
+        if _memory is None:
+            _memory = VendorMemory(settings.vendor_memory_path)
+        return _memory
+
+
+def predicted_answer(invoice_text, extracted_fields, use_cache=True):
+    """Answers from the vendor memory like `model.cached_answer`; None if disabled, bypassed or not confident."""
+    memory = get_vendor_memory() if use_cache else None
+    if memory is None:
+        return None
+    return memory.predict(invoice_text, extracted_fields)
+
+
+def remember_answer(invoice_text, extracted_fields, details):
+    """Teaches the vendor memory an InvoiceDetails answer of the LLM."""
+    memory = get_vendor_memory()
+    if memory is not None:
+        memory.learn(invoice_text, extracted_fields, details)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--holdout", type=float, default=0.2, help="Share of the newest examples held out.")
+    parser.add_argument("--threshold", type=float, default=None, help="Confidence threshold; defaults to the setting.")
+    args = parser.parse_args(argv)
+    memory = VendorMemory(get_settings().vendor_memory_path)
+    print(json.dumps(memory.evaluate(holdout=args.holdout, threshold=args.threshold), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from config.settings import get_settings
+from metrics import metrics
+
+
+# Libraries the first invoice needs; importing them takes seconds on a cold start.
+HEAVY_MODULES = ("clients", "pandas", "openpyxl", "pypdf", "tiktoken")
+
+_thread = None
+_lock = threading.Lock()
+
+
+def prewarm(config):
+    """
+    Imports the heavy libraries and opens the pooled Document Intelligence and Azure OpenAI clients.
+
+    The app imports these lazily so its first page renders quickly; pre-warming pays the
+    import cost in the background instead of on the first upload.
+
+    Args:
+        config (dict): Environment values with the Document Intelligence and Azure OpenAI settings.
+
+    Returns:
+        float: Seconds the pre-warm took.
+    """
+    started = time.perf_counter()
+    for name in HEAVY_MODULES:
+        try:
+            __import__(name)
+        except ImportError:  # optional dependencies (pypdf, tiktoken) may be missing
+            pass
+
+    from clients import get_document_client, get_llm_client
+
+    if config.get("DOCUMENT_INTELLIGENCE_ENDPOINT") and config.get("DOCUMENT_INTELLIGENCE_API_KEY"):
+        get_document_client(config["DOCUMENT_INTELLIGENCE_ENDPOINT"], config["DOCUMENT_INTELLIGENCE_API_KEY"])
+    if config.get("AZURE_URL") and config.get("AZURE_API_KEY"):
+        get_llm_client(config["AZURE_API_KEY"], config["AZURE_URL"], get_settings().azure_api_version)
+    elapsed = time.perf_counter() - started
+    metrics.observe("prewarm", elapsed)
+    return elapsed
+
+
+def start_prewarm(config, force=False):
+    """
+    Runs `prewarm` once per process on a background thread if `prewarm_clients` is set (or `force`).
+
+    Streamlit re-executes the app on every interaction but keeps imported modules, so
+    the thread held here is only started on the first run.
+
+    Returns:
+        threading.Thread: The pre-warm thread, or None if pre-warming is disabled.
+    """
+    global _thread
+    if not (force or get_settings().prewarm_clients):
+        return None
+    with _lock:
+        if _thread is None:
+            def run():
+                try:
+                    print(f"Pre-warmed clients in {prewarm(config):.2f}s")
+                except Exception as e:
+                    print(f"Pre-warm failed: {e}")
+
+            _thread = threading.Thread(target=run, name="prewarm", daemon=True)
+            _thread.start()
+        return _thread
@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_DIR)
+
+# Keep caches, journals and history written on import or by the code under test out of the working tree.
+_WORK_DIR = tempfile.mkdtemp(prefix="invoice-tool-tests-")
+os.environ.setdefault("INVOICE_CACHE_DIR", os.path.join(_WORK_DIR, "cache"))
+os.environ.setdefault("HISTORY_DIR", os.path.join(_WORK_DIR, "history"))
+os.environ.setdefault("JOURNAL_PATH", os.path.join(_WORK_DIR, "jobs.sqlite3"))
+os.environ.setdefault("DUPLICATE_INDEX_PATH", os.path.join(_WORK_DIR, "duplicates.sqlite3"))
+os.environ.setdefault("VENDOR_MEMORY_ENABLED", "false")
@@ -0,0 +1,93 @@
+import datetime
+import os
+import time
+
+from cache import DiskCache, MemoryLRU, TieredCache, content_hash, dumps, loads
+from cogservice import analyze_cache_key
+
+
+def test_content_hash_separates_parts():
+    assert content_hash(b"ab", "c") == content_hash("ab", b"c")
+    assert content_hash("ab", "c") != content_hash("a", "bc")
+    assert content_hash({"b": 1, "a": 2}) == content_hash({"a": 2, "b": 1})
+
+
+def test_analyze_cache_key_depends_only_on_the_bytes():
+    assert analyze_cache_key(b"%PDF-1.7 one") == analyze_cache_key(bytearray(b"%PDF-1.7 one"))
+    assert analyze_cache_key(b"%PDF-1.7 one") != analyze_cache_key(b"%PDF-1.7 two")
+
+
+def test_dates_survive_a_round_trip():
+    value = {"date": datetime.date(2024, 3, 1), "at": datetime.datetime(2024, 3, 1, 12, 30), "n": [1, "x"]}
+    assert loads(dumps(value)) == value
+
+
+def test_disk_cache_hits_misses_and_stats(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    assert cache.get("ab12") is None
+    cache.set("ab12", {"invoices": [[{"Vendor Name": {"value": "Acme"}}, "text", None]]})
+    assert cache.get("ab12") == {"invoices": [[{"Vendor Name": {"value": "Acme"}}, "text", None]]}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["writes"], stats["entries"]) == (1, 1, 1, 1)
+    assert stats["hit_rate"] == 0.5
+
+    # A new instance over the same directory (e.g. after a restart) sees the entry.
+    assert DiskCache(str(tmp_path)).get("ab12") is not None
+    cache.clear()
+    assert cache.get("ab12") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_disk_cache_expires_old_entries(tmp_path):
+    cache = DiskCache(str(tmp_path), max_age_seconds=60)
+    cache.set("ab12", "value")
+    path = os.path.join(str(tmp_path), "ab", "ab12.json")
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    assert cache.get("ab12") is None
+    assert not os.path.exists(path)
+
+
+def test_disk_cache_evicts_the_least_recently_used_entries(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=350)
+    for index, key in enumerate(("aa01", "bb02", "cc03")):
+        cache.set(key, "x" * 100)
+        past = time.time() - 100 + index
+        os.utime(os.path.join(str(tmp_path), key[:2], f"{key}.json"), (past, past))
+    assert cache.get("aa01") is not None  # touched, so now the most recently used
+    cache.set("dd04", "x" * 100)
+    assert cache.get("bb02") is None
+    assert cache.get("aa01") is not None
+    assert cache.stats()["bytes"] <= 350
+
+
+def test_disabled_disk_cache_stores_nothing(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache"), enabled=False)
+    cache.set("ab12", "value")
+    assert cache.get("ab12") is None
+    assert not os.path.exists(str(tmp_path / "cache"))
+
+
+def test_memory_lru_drops_the_least_recently_used_entry():
+    memory = MemoryLRU(max_entries=2)
+    memory.set("a", 1)
+    memory.set("b", 2)
+    assert memory.get("a") == 1
+    memory.set("c", 3)
+    assert (memory.get("a"), memory.get("b"), memory.get("c")) == (1, None, 3)
+    assert len(memory) == 2
+
+
+def test_tiered_cache_promotes_disk_hits_into_memory(tmp_path):
+    disk = DiskCache(str(tmp_path))
+    disk.set("ab12", {"expense_type": "Rental"})
+    cache = TieredCache(MemoryLRU(), disk)
+    assert cache.get("ab12") == {"expense_type": "Rental"}
+    assert cache.get("ab12") == {"expense_type": "Rental"}
+    stats = cache.stats()
+    assert (stats["hits"], stats["memory_hits"], stats["memory_entries"]) == (2, 1, 1)
+
+    cache.set("cd34", "answer")
+    assert DiskCache(str(tmp_path)).get("cd34") == "answer"
+    cache.clear()
+    assert cache.get("cd34") is None
@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+import batch_cogservice
+import cli
+from config.settings import get_settings
+from journal import JobJournal
+
+
+@pytest.fixture
+def invoices(tmp_path):
+    folder = tmp_path / "invoices"
+    (folder / "2024").mkdir(parents=True)
+    for name in ("a.pdf", "2024/b.PDF", "notes.txt"):
+        (folder / name).write_bytes(f"%PDF-1.7 {name}".encode())
+    return folder
+
+
+@pytest.fixture
+def azure_env(monkeypatch):
+    for name in ("DOCUMENT_INTELLIGENCE_ENDPOINT", "DOCUMENT_INTELLIGENCE_API_KEY", "AZURE_URL", "AZURE_API_KEY"):
+        monkeypatch.setenv(name, "test")
+
+
+def fake_rows(monkeypatch, rows, cancel=False):
+    def iter_batch_rows(paths, config, cancel_event=None, **kwargs):
+        for path, row in zip(paths, rows):
+            yield path, row
+            if cancel:
+                cancel_event.set()
+                return
+
+    monkeypatch.setattr(batch_cogservice, "iter_batch_rows", iter_batch_rows)
+
+
+def test_find_invoices_searches_folders_and_patterns(invoices):
+    expected = [str(invoices / "2024" / "b.PDF"), str(invoices / "a.pdf")]
+    assert cli.find_invoices([str(invoices)]) == expected
+    assert cli.find_invoices([str(invoices / "*.pdf"), str(invoices)]) == expected
+
+
+def test_default_job_id_is_stable_for_the_same_inputs(invoices):
+    job_id = cli.default_job_id([str(invoices)])
+    assert job_id.startswith("cli-")
+    assert cli.default_job_id([str(invoices / "2024"), str(invoices)]) != job_id
+    # Adding a file to the folder keeps the job.
+    (invoices / "c.pdf").write_bytes(b"%PDF-1.7 c")
+    assert cli.default_job_id([str(invoices)]) == job_id
+
+
+def test_dry_run_lists_the_invoices_without_creating_a_journal(invoices, tmp_path, monkeypatch, capsys):
+    journal = tmp_path / "dry.sqlite3"
+    monkeypatch.setattr(get_settings(), "journal_path", str(journal))
+    assert cli.main([str(invoices), "--dry-run"]) == 0
+    assert "2 invoices" in capsys.readouterr().err
+    assert not journal.exists()
+
+
+def test_dry_run_reports_progress_from_an_existing_journal(invoices, tmp_path, monkeypatch, capsys):
+    path = tmp_path / "jobs.sqlite3"
+    journal = JobJournal(str(path))
+    job_id, keys = journal.start_job([str(invoices / "a.pdf")], job_id=cli.default_job_id([str(invoices)]))
+    journal.mark_llm_done(job_id, keys[str(invoices / "a.pdf")], [{}])
+    journal.close()
+    files = sorted(os.listdir(tmp_path))
+
+    monkeypatch.setattr(get_settings(), "journal_path", str(path))
+    assert cli.main([str(invoices), "--dry-run"]) == 0
+    assert "1 already done, 1 to process" in capsys.readouterr().err
+    assert sorted(os.listdir(tmp_path)) == files
+
+
+def test_usage_errors_exit_with_2(invoices, tmp_path, azure_env):
+    assert cli.main([str(tmp_path / "empty")]) == 2
+    assert cli.main([str(invoices), "--output", str(tmp_path / "out.parquet")]) == 2
+
+
+def test_missing_settings_exit_with_2(invoices, tmp_path, monkeypatch):
+    monkeypatch.delenv("AZURE_API_KEY", raising=False)
+    assert cli.main([str(invoices), "--env-file", str(tmp_path / "missing.env")]) == 2
+
+
+def test_exit_code_reflects_failed_invoices(invoices, tmp_path, azure_env, monkeypatch):
+    output = tmp_path / "out.jsonl"
+    fake_rows(monkeypatch, [{"Invoice Number": "1"}, {"Invoice Number": "2"}])
+    assert cli.main([str(invoices), "-q", "--output", str(output)]) == 0
+    assert [json.loads(line)["Invoice Number"] for line in output.read_text().splitlines()] == ["1", "2"]
+    assert os.path.exists(tmp_path / "out.report.json")
+
+    fake_rows(monkeypatch, [{"Invoice Number": "1"}, {"Error": "Enrichment failed: timeout"}])
+    assert cli.main([str(invoices), "-q", "--output", str(output)]) == 1
+
+
+def test_cancelled_batch_exits_with_130(invoices, tmp_path, azure_env, monkeypatch, capsys):
+    fake_rows(monkeypatch, [{"Invoice Number": "1"}, {"Invoice Number": "2"}], cancel=True)
+    assert cli.main([str(invoices), "-q", "--output", str(tmp_path / "out.csv")]) == 130
+    assert "Interrupted after 1 of 2 invoices" in capsys.readouterr().err
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from clients import async_document_client, async_llm_client, get_document_client, get_llm_client, reset_clients
+
+ENDPOINT = "https://example.cognitiveservices.azure.com/"
+URL = "https://example.openai.azure.com/openai/deployments/gpt-4o-mini"
+
+# instructor warns about its own deprecated modes while wrapping a client.
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning:instructor")
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry():
+    reset_clients()
+    yield
+    reset_clients()
+
+
+def test_document_clients_are_shared_per_endpoint_and_key():
+    client = get_document_client(ENDPOINT, "key-1")
+    assert get_document_client(ENDPOINT, "key-1") is client
+    assert get_document_client(ENDPOINT, "key-2") is not client
+
+
+def test_llm_clients_are_shared_per_url_version_and_key():
+    client = get_llm_client("key-1", URL, "2024-06-01")
+    assert get_llm_client("key-1", URL, "2024-06-01") is client
+    assert get_llm_client("key-1", URL, "2024-10-21") is not client
+    assert get_llm_client("key-2", URL, "2024-06-01") is not client
+
+
+def test_reset_rebuilds_the_clients():
+    document_client = get_document_client(ENDPOINT, "key-1")
+    llm_client = get_llm_client("key-1", URL, "2024-06-01")
+    reset_clients()
+    assert get_document_client(ENDPOINT, "key-1") is not document_client
+    assert get_llm_client("key-1", URL, "2024-06-01") is not llm_client
+
+
+def test_async_clients_are_closed_with_their_batch():
+    async def scenario():
+        async with async_llm_client("key-1", URL, "2024-06-01", pool_size=4) as llm_client:
+            openai_client = llm_client.client
+            assert not openai_client.is_closed()
+        async with async_document_client(ENDPOINT, "key-1", pool_size=4) as document_client:
+            assert document_client is not None
+        return openai_client
+
+    assert asyncio.run(scenario()).is_closed()
@@ -0,0 +1,39 @@
+from cogservice import _continues, merge_shards
+
+
+def field(value):
+    return {"value": value, "confidence": 0.9}
+
+
+def test_continues_only_across_the_shard_boundary():
+    previous = ({"Invoice Number": field("A-1")}, "first half", 1, 4)
+    assert _continues(previous, ({}, "second half", 5, 6), 4)
+    assert _continues(previous, ({"Invoice Number": field("A-1")}, "second half", 5, 6), 4)
+    assert not _continues(previous, ({"Invoice Number": field("B-2")}, "next invoice", 5, 6), 4)
+    assert not _continues(previous, ({}, "second half", 6, 7), 4)
+    assert not _continues(({}, "", 1, 3), ({}, "", 5, 6), 4)
+
+
+def test_merge_shards_joins_an_invoice_split_by_a_boundary():
+    first = ({"Invoice Number": field("A-1"), "Vendor Name": field("Acme"), "Total Value": field("1 USD")}, "page 1-4", 1, 4)
+    second = ({"Invoice Number": field(""), "Total Value": field("100 USD")}, "page 5", 5, 5)
+    parts, content = merge_shards([((5, 8), [second]), ((1, 4), [first])])
+    assert len(parts) == 1
+    fields, text, pages = parts[0]
+    assert fields["Invoice Number"]["value"] == "A-1"
+    assert fields["Vendor Name"]["value"] == "Acme"
+    assert fields["Total Value"]["value"] == "100 USD"
+    assert text == "page 1-4\npage 5"
+    assert pages is None
+    assert content == text
+
+
+def test_merge_shards_keeps_separate_invoices_and_attaches_pages_without_fields():
+    first = ({"Invoice Number": field("A-1")}, "invoice a", 1, 2)
+    terms = ({}, "terms", 3, 3)
+    second = ({"Invoice Number": field("B-2")}, "invoice b", 5, 6)
+    parts, _ = merge_shards([((1, 4), [first, terms]), ((5, 8), [second])])
+    assert [(fields["Invoice Number"]["value"], text, pages) for fields, text, pages in parts] == [
+        ("A-1", "invoice a\nterms", "1-3"),
+        ("B-2", "invoice b", "5-6"),
+    ]
@@ -0,0 +1,68 @@
+import functools
+import sys
+
+import pytest
+
+import compaction
+from compaction import count_tokens, format_extracted_fields
+
+# A model no other test counts for, so its tokenizer is looked up (and found missing) here.
+MODEL = "test-estimate"
+compact_invoice_text = functools.partial(compaction.compact_invoice_text, model=MODEL)
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # Without tiktoken tokens are estimated, so the tests do not depend on its encoding files.
+    monkeypatch.setitem(sys.modules, "tiktoken", None)
+
+
+def test_tokens_are_estimated_without_tiktoken():
+    assert count_tokens("", MODEL) == 0
+    assert count_tokens("x" * 40, MODEL) == 11
+
+
+def invoice(line_items=200):
+    header = ["ACME Rentals", "Invoice No 1001", "Date 2024-03-01"]
+    rows = [f"Widget {index} 2 3.00 6.00" for index in range(line_items)]
+    footer = ["Job site: 12 Maple St", "Approved by J. Smith", "Total due 1200.00"]
+    return "\n".join(header + rows + footer)
+
+
+def test_small_text_is_left_alone():
+    text = "ACME Rentals\nInvoice No 1001\nTotal 10.00"
+    compacted, report = compact_invoice_text(text, 1000)
+    assert compacted == text
+    assert not report["compacted"]
+
+
+def test_compaction_fits_the_budget_and_keeps_relevant_lines():
+    compacted, report = compact_invoice_text(invoice(), 100)
+    assert report["compacted"]
+    assert report["tokens_after"] <= 100 < report["tokens_before"]
+    for line in ("ACME Rentals", "Job site: 12 Maple St", "Approved by J. Smith"):
+        assert line in compacted
+    assert "Widget 199" not in compacted
+
+
+def test_repeated_boilerplate_is_kept_once():
+    text = "\n".join(["ACME Rentals", "Page 1 of 3", "Rental of excavator", "Page 2 of 3", "Page 3 of 3"] * 50)
+    compacted, _ = compact_invoice_text(text, 200)
+    assert compacted.count("Page") == 1
+
+
+def test_header_compaction_keeps_the_header_fields():
+    compacted, _ = compact_invoice_text(invoice(), 100, for_header=True)
+    for line in ("Invoice No 1001", "Date 2024-03-01", "Total due 1200.00"):
+        assert line in compacted
+
+
+def test_extracted_fields_are_formatted_without_empty_values():
+    fields = {
+        "Vendor Name": {"value": "Acme", "confidence": 0.9},
+        "Invoice Number": {"value": "", "confidence": 0.1},
+        "Total Value": {"value": None, "confidence": None},
+        "Date": {"value": "2024-03-01", "confidence": 0.8},
+    }
+    assert format_extracted_fields(fields) == "Vendor Name: Acme\nDate: 2024-03-01"
+    assert format_extracted_fields(None) == ""
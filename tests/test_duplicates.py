@@ -0,0 +1,73 @@
+import pytest
+
+from duplicates import EXACT, LIKELY, DuplicateIndex, describe_duplicate, invoice_key, normalize_invoice_number
+
+
+def fields(vendor="Acme Rentals, Inc.", number="INV-00123", total="1,234.50 USD", date="2024-03-01"):
+    values = {"Vendor Name": vendor, "Invoice Number": number, "Total Value": total, "Date": date}
+    return {name: {"value": value, "confidence": 0.9} for name, value in values.items() if value is not None}
+
+
+@pytest.mark.parametrize("a, b", [
+    ("INV-00123", "inv 123"),
+    ("INV123", "INV-123"),
+    ("2024-001", "2024-1"),
+])
+def test_normalize_invoice_number_matches_formatting_variants(a, b):
+    assert normalize_invoice_number(a) == normalize_invoice_number(b)
+
+
+def test_normalize_invoice_number_keeps_a_lone_zero():
+    assert normalize_invoice_number("0") == "0"
+    assert normalize_invoice_number(None) == ""
+
+
+def test_invoice_key_ignores_ocr_formatting():
+    assert invoice_key(fields()) == invoice_key(
+        fields(vendor="ACME RENTALS", number="inv 123", total="$1234.5", date="03/01/2024")
+    )
+
+
+def test_invoice_key_tells_different_invoices_apart():
+    assert invoice_key(fields()) != invoice_key(fields(number="INV-124"))
+    assert invoice_key(fields()) != invoice_key(fields(total="1,234.51 USD"))
+
+
+def test_invoice_key_needs_vendor_number_and_total_or_date():
+    assert invoice_key(fields(vendor=None)) is None
+    assert invoice_key(fields(number="--")) is None
+    assert invoice_key(fields(total=None, date=None)) is None
+    assert invoice_key(fields(total=None)) is not None
+
+
+def test_index_answers_exact_and_likely_duplicates(tmp_path):
+    index = DuplicateIndex(str(tmp_path / "duplicates.sqlite3"))
+    parts = [(fields(), "invoice text", None)]
+    index.add("hash-a", "a.pdf", parts, [{"expense_type": "Rental"}])
+
+    exact = index.find_file("hash-a")
+    assert exact["invoice_path"] == "a.pdf"
+    assert exact["parts"] == [(fields(), "invoice text", None)]
+    assert exact["details"] == [{"expense_type": "Rental"}]
+    assert index.find_file("hash-b") is None
+
+    # A re-scan of the same invoice: different bytes, same invoice key.
+    likely = index.find_invoice(invoice_key(fields(vendor="ACME RENTALS", total="$1234.5")))
+    assert (likely["content_hash"], likely["details"]) == ("hash-a", {"expense_type": "Rental"})
+    assert index.find_invoice(None) is None
+
+
+def test_index_keeps_the_first_original_and_skips_unfinished_files(tmp_path):
+    index = DuplicateIndex(str(tmp_path / "duplicates.sqlite3"))
+    index.add("hash-a", "a.pdf", [(fields(), "", None)], [{"expense_type": "Rental"}])
+    index.add("hash-b", "copy.pdf", [(fields(), "", None)], [{"expense_type": "Material"}])
+    index.add("hash-c", "c.pdf", [(fields(number="INV-9"), "", None)], [None])
+    assert index.find_invoice(invoice_key(fields()))["invoice_path"] == "a.pdf"
+    assert index.find_file("hash-c") is None
+    assert index.summary() == {"files": 2, "invoices": 1}
+    index.close()
+
+
+def test_describe_duplicate():
+    assert describe_duplicate(EXACT, "/uploads/a.pdf") == "Exact duplicate of a.pdf"
+    assert describe_duplicate(LIKELY, "/uploads/a.pdf", "3-4") == "Likely duplicate of a.pdf p.3-4 (LLM skipped)"
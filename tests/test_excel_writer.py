@@ -0,0 +1,46 @@
+import datetime
+import gc
+import os
+
+import pytest
+from openpyxl import load_workbook
+
+from excel_writer import OTHER_COLUMN, StreamingInvoiceWriter
+
+
+def test_rows_are_written_with_unknown_keys_in_the_other_column(tmp_path):
+    path = str(tmp_path / "invoices.xlsx")
+    with StreamingInvoiceWriter(path, ["Invoice Number", "Date", "Invoice Path"]) as writer:
+        writer.append({"Invoice Number": "A-1", "Date": datetime.date(2024, 7, 1), "Invoice Path": "a.pdf"})
+        writer.append({"Invoice Number": "B-2", "Route": "ocr", "Pages": "3-4"})
+    assert writer.rows_written == 2
+
+    rows = list(load_workbook(path).active.iter_rows(values_only=True))
+    assert rows[0] == ("Invoice Number", "Date", "Invoice Path", OTHER_COLUMN)
+    assert rows[1] == ("A-1", datetime.datetime(2024, 7, 1), "a.pdf", None)
+    assert rows[2] == ("B-2", None, None, "Route: ocr; Pages: 3-4")
+    assert not os.path.exists(str(tmp_path / "invoices.partial.csv"))
+
+
+def test_checkpoint_holds_completed_rows_while_writing(tmp_path):
+    writer = StreamingInvoiceWriter(str(tmp_path / "invoices.xlsx"), ["Invoice Number"])
+    writer.append({"Invoice Number": "A-1"})
+    with open(tmp_path / "invoices.partial.csv", encoding="utf-8") as f:
+        assert f.read().splitlines() == [f"Invoice Number,{OTHER_COLUMN}", "A-1,"]
+    writer.close()
+
+
+# openpyxl leaves its row generator open when a save fails.
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_failed_save_does_not_mask_the_original_error(tmp_path, capsys):
+    path = str(tmp_path / "invoices.xlsx")
+    with pytest.raises(ValueError, match="batch failed"):
+        with StreamingInvoiceWriter(path, ["Invoice Number"]) as writer:
+            writer.append({"Invoice Number": "A-1"})
+            os.makedirs(path)  # the workbook cannot be saved over a directory
+            raise ValueError("batch failed")
+    del writer
+    gc.collect()
+    assert "Error saving" in capsys.readouterr().out
+    with open(tmp_path / "invoices.partial.csv", encoding="utf-8") as f:
+        assert f.read().splitlines()[1] == "A-1,"
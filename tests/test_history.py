@@ -0,0 +1,57 @@
+import datetime
+import decimal
+import os
+
+import pytest
+
+from config.settings import get_settings
+from history import parse_amount, query_history, record_history
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1234.5 USD", (decimal.Decimal("1234.50"), "USD")),
+    ("$1,234.50", (decimal.Decimal("1234.50"), None)),
+    ("1.234,50 EUR", (decimal.Decimal("1234.50"), "EUR")),
+    ("1,234", (decimal.Decimal("1234.00"), None)),
+    ("12,50", (decimal.Decimal("12.50"), None)),
+    ("-20.00 CAD", (decimal.Decimal("-20.00"), "CAD")),
+    (99.999, (decimal.Decimal("100.00"), None)),
+    ("USD", (None, "USD")),
+    (None, (None, None)),
+])
+def test_parse_amount(value, expected):
+    assert parse_amount(value) == expected
+
+
+def test_parse_amount_rejects_amounts_beyond_the_stored_precision():
+    assert parse_amount("1" * 20) == (None, None)
+
+
+def _invoice(number, day):
+    fields = {
+        "Invoice Number": {"value": number, "confidence": 0.9},
+        "Date": {"value": datetime.date(2024, 7, day), "confidence": 0.9},
+        "Total Value": {"value": "10.00 USD", "confidence": 0.9},
+    }
+    return f"{number}.pdf", (fields, ""), {"expense_type": "Rental"}, None, "hash-" + number
+
+
+def _parts(history_dir):
+    return sorted(name for name in os.listdir(os.path.join(history_dir, "invoice_month=2024-07")) if not name.startswith("_"))
+
+
+def test_single_invoice_exports_are_compacted_per_month(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_settings(), "history_compact_min_files", 3)
+    history_dir = str(tmp_path / "history")
+    for day in (1, 2):
+        assert record_history([_invoice(f"A-{day}", day)], history_dir=history_dir) == 1
+    assert len(_parts(history_dir)) == 2
+
+    record_history([_invoice("A-3", 3)], history_dir=history_dir)
+    assert len(_parts(history_dir)) == 1
+    table = query_history(["invoice_number"], history_dir=history_dir, expense_type="Rental")
+    assert sorted(table.column("invoice_number").to_pylist()) == ["A-1", "A-2", "A-3"]
+
+    record_history([_invoice("A-4", 4)], history_dir=history_dir)
+    assert len(_parts(history_dir)) == 2
+    assert query_history(history_dir=history_dir).num_rows == 4
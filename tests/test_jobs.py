@@ -0,0 +1,80 @@
+import threading
+import time
+
+from jobs import CANCELLED, DONE, FAILED, QUEUED, RUNNING, Job, JobRunner, job_key
+
+
+def wait_until_finished(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not job.finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.finished
+
+
+def test_job_key_ignores_upload_order_but_not_kind_or_content():
+    assert job_key("batch", [b"a", b"b"]) == job_key("batch", [b"b", b"a"])
+    assert job_key("batch", [b"a"]) != job_key("single", [b"a"])
+    assert job_key("batch", [b"a"]) != job_key("batch", [b"a", b"b"])
+
+
+def test_rows_mark_their_files_done_or_failed():
+    job = Job("j", "batch", {"/tmp/a.pdf": "a.pdf", "/tmp/b.pdf": "b.pdf", "/tmp/c.pdf": "c.pdf"})
+    job.set_invoice_status("/tmp/a.pdf", RUNNING)
+    job.add_row("/tmp/a.pdf", {"Invoice Number": "1"})
+    job.add_row("/tmp/b.pdf", {"Invoice Number": "2", "Error": "Enrichment failed"})
+    # A later good invoice of the same file does not clear the failure.
+    job.add_row("/tmp/b.pdf", {"Invoice Number": "3"})
+
+    snapshot = job.snapshot()
+    assert [invoice["status"] for invoice in snapshot["invoices"]] == [DONE, FAILED, QUEUED]
+    assert (snapshot["total"], snapshot["completed"]) == (3, 2)
+    assert [row["Invoice"] for row in snapshot["rows"]] == ["a.pdf", "b.pdf", "b.pdf"]
+
+
+def test_runner_runs_a_job_once_per_key():
+    runner = JobRunner()
+    calls = []
+    job = runner.submit(Job("j", "single", {"a.pdf": "a.pdf"}), lambda job: calls.append(job) or "out.xlsx")
+    assert runner.submit(Job("j", "single", {"a.pdf": "a.pdf"}), lambda job: calls.append(job)) is job
+    wait_until_finished(job)
+    assert (job.status, job.result, len(calls)) == (DONE, "out.xlsx", 1)
+    assert runner.get("j") is job
+
+    runner.forget("j")
+    assert runner.get("j") is None
+
+
+def test_runner_records_failures_and_cancellation():
+    runner = JobRunner()
+
+    def fail(job):
+        raise RuntimeError("No fields could be extracted from the invoice.")
+
+    failed = runner.submit(Job("f", "single", {}), fail)
+    wait_until_finished(failed)
+    assert failed.status == FAILED
+    assert failed.snapshot()["error"] == "No fields could be extracted from the invoice."
+
+    started = threading.Event()
+
+    def wait_for_cancel(job):
+        started.set()
+        job.cancel_event.wait(5)
+        return "partial.xlsx"
+
+    cancelled = runner.submit(Job("c", "batch", {}), wait_for_cancel)
+    started.wait(5)
+    runner.cancel("c")
+    wait_until_finished(cancelled)
+    assert (cancelled.status, cancelled.result) == (CANCELLED, "partial.xlsx")
+
+
+def test_runner_keeps_only_the_latest_finished_jobs():
+    runner = JobRunner(max_finished=1)
+    first = runner.submit(Job("1", "single", {}), lambda job: None)
+    wait_until_finished(first)
+    second = runner.submit(Job("2", "single", {}), lambda job: None)
+    wait_until_finished(second)
+    runner.submit(Job("3", "single", {}), lambda job: None)
+    assert runner.get("1") is None
+    assert runner.get("2") is second
@@ -0,0 +1,78 @@
+import os
+import sqlite3
+
+import pytest
+
+from journal import FAILED, LLM_DONE, OCR_DONE, QUEUED, JobJournal
+
+
+def write(path, content):
+    path.write_text(content)
+    return str(path)
+
+
+def test_a_rerun_resumes_the_job_with_its_payloads(tmp_path):
+    a = write(tmp_path / "a.pdf", "invoice a")
+    b = write(tmp_path / "b.pdf", "invoice b")
+    c = write(tmp_path / "c.pdf", "invoice c")
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    job_id, keys = journal.start_job([a, b, c])
+    journal.mark_ocr_done(job_id, keys[a], [({"Vendor Name": {"value": "Acme"}}, "text a", None)])
+    journal.mark_llm_done(job_id, keys[a], [{"expense_type": "Rental"}])
+    journal.mark_ocr_done(job_id, keys[b], [({}, "text b", "1-2")])
+    journal.mark_failed(job_id, keys[c], "ocr", "timeout")
+    journal.close()
+
+    # The same files saved again under new names resume the same job.
+    renamed = [write(tmp_path / f"copy_{name}.pdf", f"invoice {name}") for name in "abc"]
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    resumed_id, resumed_keys = journal.start_job(renamed)
+    assert resumed_id == job_id
+    assert sorted(resumed_keys.values()) == sorted(keys.values())
+    assert journal.summary(job_id) == {LLM_DONE: 1, OCR_DONE: 1, FAILED: 1}
+
+    items = {item["item_key"]: item for item in journal.items(job_id)}
+    assert items[keys[a]]["details"] == [{"expense_type": "Rental"}]
+    assert items[keys[b]]["parts"] == [({}, "text b", "1-2")]
+    assert items[keys[c]]["failed_stage"] == "ocr"
+    assert items[keys[c]]["attempts"] == 1
+    assert [item["item_key"] for item in journal.items(job_id, states=[OCR_DONE, FAILED])] == [keys[b], keys[c]]
+
+
+def test_identical_files_share_an_item(tmp_path):
+    a = write(tmp_path / "a.pdf", "same")
+    b = write(tmp_path / "b.pdf", "same")
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    job_id, keys = journal.start_job([a, b])
+    assert keys[a] == keys[b]
+    assert journal.summary(job_id) == {QUEUED: 1}
+
+
+def test_files_added_to_a_named_job_keep_the_progress_of_the_others(tmp_path):
+    a = write(tmp_path / "a.pdf", "invoice a")
+    b = write(tmp_path / "b.pdf", "invoice b")
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    job_id, keys = journal.start_job([a], job_id="nightly")
+    journal.mark_llm_done(job_id, keys[a], [{"expense_type": "Rental"}])
+
+    # Known keys are trusted as is, so the files are not hashed again.
+    _, keys = journal.start_job([a, b], job_id="nightly", known_keys={a: keys[a], b: "key-b"})
+    assert keys[b] == "key-b"
+    assert journal.summary("nightly") == {LLM_DONE: 1, QUEUED: 1}
+
+
+def test_read_only_journal_reads_progress_without_writing(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    a = write(tmp_path / "a.pdf", "invoice a")
+    journal = JobJournal(str(path))
+    job_id, keys = journal.start_job([a])
+    journal.mark_llm_done(job_id, keys[a], [{}])
+    journal.close()
+    before = sorted(os.listdir(tmp_path))
+
+    reader = JobJournal(str(path), read_only=True)
+    assert [item["state"] for item in reader.items(job_id)] == [LLM_DONE]
+    with pytest.raises(sqlite3.OperationalError):
+        reader.mark_failed(job_id, keys[a], "llm", "error")
+    reader.close()
+    assert sorted(os.listdir(tmp_path)) == before
@@ -0,0 +1,71 @@
+import json
+import types
+
+import pytest
+
+from metrics import Metrics
+
+
+def test_spans_time_stages_and_count_errors():
+    metrics = Metrics()
+    with metrics.span("llm"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.span("llm"):
+            raise ValueError("timeout")
+    metrics.observe("ocr_poll", 2.0)
+    stages = metrics.run_report()["stages"]
+    assert list(stages) == ["ocr_poll", "llm"]  # pipeline order
+    assert (stages["llm"]["count"], stages["llm"]["errors"]) == (2, 1)
+    assert stages["ocr_poll"]["p50"] == 2.0
+
+
+def test_counters_are_kept_per_label():
+    metrics = Metrics()
+    metrics.incr("cache_hits", cache="llm")
+    metrics.incr("cache_hits", 2, cache="llm")
+    metrics.incr("cache_hits", cache="analyze")
+    assert metrics.counter("cache_hits", cache="llm") == 3
+    assert metrics.counter("cache_misses", cache="llm") == 0
+    assert metrics.run_report()["counters"] == {'cache_hits{cache="analyze"}': 1, 'cache_hits{cache="llm"}': 3}
+
+
+def test_report_since_a_snapshot_holds_only_the_deltas(tmp_path):
+    metrics = Metrics()
+    metrics.incr("routes", route="ocr")
+    metrics.observe("llm", 1.0)
+    since = metrics.snapshot()
+    metrics.incr("routes", route="ocr")
+    metrics.incr("routes", route="text_layer")
+    metrics.observe("llm", 3.0)
+
+    path = metrics.write_report(str(tmp_path / "run" / "report.json"), since=since, invoices=2)
+    with open(path, encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["invoices"] == 2
+    assert report["counters"] == {'routes{route="ocr"}': 1, 'routes{route="text_layer"}': 1}
+    assert (report["stages"]["llm"]["count"], report["stages"]["llm"]["p50"]) == (1, 3.0)
+
+
+def test_llm_usage_is_counted_per_response_model():
+    metrics = Metrics()
+    usage = types.SimpleNamespace(prompt_tokens=120, completion_tokens=30)
+    completion = types.SimpleNamespace(_raw_response=types.SimpleNamespace(usage=usage))
+    metrics.record_llm_usage(completion, response_model=Metrics)
+    metrics.record_llm_usage(types.SimpleNamespace(), response_model=Metrics)
+    assert metrics.counter("llm_calls", response_model="Metrics") == 2
+    assert metrics.counter("llm_prompt_tokens", response_model="Metrics") == 120
+    assert metrics.counter("llm_completion_tokens", response_model="Metrics") == 30
+
+
+def test_prometheus_text():
+    metrics = Metrics()
+    metrics.observe("llm", 0.5)
+    metrics.incr("throttles", service="azure_openai")
+    metrics.set_gauge("queue_depth", 3, queue="llm")
+    text = metrics.prometheus_text()
+    assert 'invoice_tool_stage_seconds{stage="llm",quantile="0.5"} 0.500000' in text
+    assert 'invoice_tool_stage_seconds_count{stage="llm"} 1' in text
+    assert "# TYPE invoice_tool_throttles_total counter" in text
+    assert 'invoice_tool_throttles_total{service="azure_openai"} 1' in text
+    assert 'invoice_tool_queue_depth{queue="llm"} 3' in text
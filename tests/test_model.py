@@ -0,0 +1,102 @@
+import asyncio
+import re
+
+import pytest
+
+import model
+from model import (
+    InvoiceDetails,
+    PackedInvoiceDetails,
+    PackedInvoiceDetailsList,
+    aextract_invoice_details_packed,
+    details_cache_key,
+    extract_invoice_details,
+    pack_invoices,
+)
+
+
+@pytest.fixture
+def llm_calls(monkeypatch):
+    calls = []
+
+    class FakeLLM:
+        def __init__(self, provider, config=None):
+            pass
+
+        def create_completion(self, response_model, messages):
+            calls.append(messages)
+            return InvoiceDetails(expense_type="Rental", approval="Approved", job_location="Job 7")
+
+    monkeypatch.setattr(model, "LLMFactory", FakeLLM)
+    return calls
+
+
+def fields(number="INV-1"):
+    return {"Invoice Number": {"value": number, "confidence": 0.9}}
+
+
+def test_details_cache_key_ignores_whitespace_but_not_content():
+    assert details_cache_key("Acme  Rentals\n Job 7", fields()) == details_cache_key("Acme Rentals Job 7", fields())
+    assert details_cache_key("Acme Rentals", fields()) != details_cache_key("Acme Rentals", fields("INV-2"))
+    assert details_cache_key("Acme Rentals", fields()) != details_cache_key("Acme Rentals", fields(), temperature=0.7)
+
+
+def test_enrichment_is_answered_from_the_cache(llm_calls):
+    text = "Acme Rentals excavator rental, job 7 (cache test)"
+    first = extract_invoice_details(text, fields(), config={})
+    assert first == {"expense_type": "Rental", "approval": "Approved", "job_location": "Job 7"}
+    assert extract_invoice_details(text + "  ", fields(), config={}) == first
+    assert len(llm_calls) == 1
+
+    extract_invoice_details(text, fields(), config={}, use_cache=False)
+    assert len(llm_calls) == 2
+
+
+def test_pack_invoices_bounds_packs_by_count_and_tokens():
+    invoices = [(f"k{index}", "line item " * 20, fields()) for index in range(5)]
+    assert [[key for key, _, _ in pack] for pack in pack_invoices(invoices, max_invoices=2, token_budget=10_000)] == [
+        ["k0", "k1"], ["k2", "k3"], ["k4"],
+    ]
+    assert [len(pack) for pack in pack_invoices(invoices, max_invoices=10, token_budget=100)] == [1] * 5
+
+
+def test_packed_answers_are_keyed_apart_from_single_ones():
+    assert details_cache_key("Acme", fields()) != details_cache_key("Acme", fields(), packed=True)
+
+
+@pytest.fixture
+def packed_llm(monkeypatch):
+    """Fake LLM whose packed answers leave out the invoice whose text mentions "skip"."""
+    calls = {"factories": 0, "packed": 0, "single": 0}
+
+    class FakeLLM:
+        def __init__(self, provider, config=None, async_client=None):
+            calls["factories"] += 1
+
+        async def acreate_completion(self, response_model, messages):
+            if response_model is InvoiceDetails:
+                calls["single"] += 1
+                return InvoiceDetails(expense_type="Other", approval="Not Specified")
+            calls["packed"] += 1
+            prompt = messages[-1]["content"]
+            blocks = re.findall(r"## Invoice (INV\d+)\n### Raw Invoice Text:\n(.*)", prompt)
+            return PackedInvoiceDetailsList(invoices=[
+                PackedInvoiceDetails(invoice_id=invoice_id, expense_type="Rental", approval="Approved")
+                for invoice_id, text in blocks if "skip" not in text
+            ])
+
+    monkeypatch.setattr(model, "LLMFactory", FakeLLM)
+    return calls
+
+
+def test_packed_enrichment_falls_back_to_single_calls_for_missing_answers(packed_llm):
+    invoices = [("a", "packed test rental a", fields("P-1")), ("b", "packed test skip b", fields("P-2"))]
+    results = asyncio.run(aextract_invoice_details_packed(invoices, config={}))
+    assert results["a"]["expense_type"] == "Rental"
+    assert results["b"]["expense_type"] == "Other"
+    assert (packed_llm["packed"], packed_llm["single"]) == (1, 1)
+
+    # Both answers are cached now, so a rerun builds no LLM client at all.
+    factories = packed_llm["factories"]
+    assert asyncio.run(aextract_invoice_details_packed(invoices, config={})) == results
+    assert packed_llm["factories"] == factories
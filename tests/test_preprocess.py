@@ -0,0 +1,75 @@
+import io
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+from pypdf import PdfReader
+
+from preprocess import BILEVEL, describe_preprocess, mean_confidence, preprocess_options, preprocess_pdf, remap_pages
+
+
+def scan(dpi=300, blank=False):
+    """An RGB "scan" of a letter page at `dpi`, with noisy lines of text unless `blank`."""
+    rng = random.Random(dpi)
+    image = Image.new("RGB", (int(8.5 * dpi), int(11 * dpi)), "white")
+    if not blank:
+        draw = ImageDraw.Draw(image)
+        for top in range(dpi, int(10 * dpi), dpi // 4):
+            for left in range(dpi, int(7.5 * dpi), dpi // 10):
+                shade = rng.randint(0, 90)
+                draw.rectangle([left, top, left + dpi // 14, top + dpi // 10], fill=(shade, shade, shade + 20))
+    return image
+
+
+def pdf(*pages, dpi=300):
+    buffer = io.BytesIO()
+    pages[0].save(buffer, "PDF", resolution=dpi, save_all=True, append_images=list(pages[1:]))
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def options():
+    return {**preprocess_options(), "target_dpi": 150, "blank_ink_ratio": 0.005}
+
+
+def test_scans_are_shrunk_and_blank_pages_dropped(options):
+    document = pdf(scan(), scan(blank=True), scan())
+    report = preprocess_pdf(document, options)
+    assert (report["pages"], report["image_pages"], report["images"]) == (3, 3, 2)
+    assert (report["blank_pages"], report["kept_pages"]) == ([2], [1, 3])
+    assert report["bytes_after"] < report["bytes_before"]
+    assert len(PdfReader(io.BytesIO(report["bytes"])).pages) == 2
+    assert "1 blank page(s) dropped" in describe_preprocess(report)
+
+
+def test_bilevel_mode_converts_scans_to_black_and_white(options):
+    report = preprocess_pdf(pdf(scan()), {**options, "mode": BILEVEL})
+    page = PdfReader(io.BytesIO(report["bytes"])).pages[0]
+    assert [image.image.mode for image in page.images] == ["1"]
+
+
+def test_documents_that_cannot_shrink_are_left_alone(options):
+    # A page already at the target resolution in grayscale, and a file of blank pages only.
+    small = pdf(scan(dpi=150).convert("L"), dpi=150)
+    report = preprocess_pdf(small, options)
+    assert report["bytes"] is None
+    assert describe_preprocess(report) == "not preprocessed"
+
+    report = preprocess_pdf(pdf(scan(blank=True), scan(blank=True)), options)
+    assert report["bytes"] is None
+    assert (report["blank_pages"], report["kept_pages"]) == ([], [1, 2])
+
+
+def test_remap_pages_maps_back_to_the_original_pages():
+    parts = [({}, "a", "1"), ({}, "b", "2-3"), ({}, "c", None)]
+    assert remap_pages(parts, [1, 3, 4]) == [({}, "a", "1"), ({}, "b", "3-4"), ({}, "c", None)]
+    assert remap_pages(parts, [1, 2, 3]) is parts
+
+
+def test_mean_confidence_leaves_out_missing_fields():
+    parts = [
+        ({"Vendor Name": {"value": "Acme", "confidence": 0.9}, "Total Value": {"value": None, "confidence": None}}, "", None),
+        ({"Vendor Name": {"value": "Acme", "confidence": 0.5}}, "", "2"),
+    ]
+    assert mean_confidence(parts, ["Vendor Name", "Total Value", "Date"]) == pytest.approx(0.7)
+    assert mean_confidence([({}, "", None)], ["Vendor Name"]) == 0.0
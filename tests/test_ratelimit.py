@@ -0,0 +1,168 @@
+import asyncio
+import time
+
+import pytest
+
+from ratelimit import AdaptiveConcurrency, ServiceScheduler, parse_retry_after
+
+
+# Latency of the fast responses below; a back-off counts once per round trip of this length.
+ROUND_TRIP = 0.05
+
+
+def next_round_trip():
+    time.sleep(2 * ROUND_TRIP)
+
+
+def complete(limiter, latency):
+    asyncio.run(limiter.acquire())
+    limiter.release(latency=latency)
+
+
+def test_limit_grows_while_latency_stays_low():
+    limiter = AdaptiveConcurrency(4, maximum=8)
+    for _ in range(40):
+        complete(limiter, ROUND_TRIP)
+    assert limiter.limit == 8
+
+
+def test_limit_backs_off_on_slow_responses_and_halves_on_throttling():
+    limiter = AdaptiveConcurrency(8, maximum=8)
+    complete(limiter, ROUND_TRIP)
+    complete(limiter, 1.0)
+    assert limiter.limit == pytest.approx(7.2)
+    next_round_trip()
+    limiter.throttled()
+    assert limiter.limit == pytest.approx(3.6)
+
+
+def test_a_burst_of_throttles_in_one_round_trip_backs_off_once():
+    limiter = AdaptiveConcurrency(8, maximum=8)
+    complete(limiter, ROUND_TRIP)
+    for _ in range(5):
+        limiter.throttled()
+    assert limiter.limit == 4
+
+
+def test_limit_stays_within_bounds():
+    limiter = AdaptiveConcurrency(100, minimum=2, maximum=10)
+    assert limiter.limit == 10
+    complete(limiter, ROUND_TRIP)
+    for _ in range(5):
+        next_round_trip()
+        limiter.throttled()
+    assert limiter.limit == 2
+
+
+def test_acquire_waits_for_a_free_slot():
+    async def scenario():
+        limiter = AdaptiveConcurrency(1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        limiter.release()
+        await asyncio.wait_for(waiter, 1)
+        assert limiter.in_flight == 1
+
+    asyncio.run(scenario())
+
+
+async def time_acquire(limiter):
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    await limiter.acquire()
+    return loop.time() - started
+
+
+def test_retry_after_blocks_new_requests():
+    limiter = AdaptiveConcurrency(4)
+    limiter.throttled(retry_after=0.2)
+    assert asyncio.run(time_acquire(limiter)) >= 0.15
+
+
+def test_pause_blocks_new_requests_without_lowering_the_limit():
+    limiter = AdaptiveConcurrency(4)
+    limiter.pause(0.2)
+    assert asyncio.run(time_acquire(limiter)) >= 0.15
+    assert limiter.limit == 4
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"x-ms-retry-after-ms": "250"}, 0.25),
+    ({"retry-after": "3"}, 3.0),
+    ({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0.0),
+    ({"retry-after": "soon"}, None),
+    ({}, None),
+])
+def test_parse_retry_after(headers, expected):
+    assert parse_retry_after(headers) == expected
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class Throttled(Exception):
+    def __init__(self):
+        super().__init__("429 Too Many Requests")
+        self.response = Response(429, {"retry-after-ms": "10"})
+
+
+def flaky_call(failures):
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) <= failures:
+            raise Throttled()
+        return "ok"
+
+    return call, attempts
+
+
+def test_throttled_calls_are_retried_and_counted():
+    scheduler = ServiceScheduler("llm", 4)
+    call, attempts = flaky_call(failures=2)
+    assert asyncio.run(scheduler.run(call)) == "ok"
+    assert len(attempts) == 3
+    stats = scheduler.stats()
+    assert (stats["calls"], stats["throttles"], stats["in_flight"]) == (1, 2, 0)
+
+
+def test_throttles_seen_by_the_response_hook_are_counted_once():
+    scheduler = ServiceScheduler("ocr", 4)
+    call, attempts = flaky_call(failures=1)
+
+    async def observed_call():
+        try:
+            return await call()
+        except Throttled as e:
+            # What azure-core's raw_response_hook reports before the SDK raises.
+            scheduler.observe_response(type("PipelineResponse", (), {"http_response": e.response})())
+            raise
+
+    assert asyncio.run(scheduler.run(observed_call)) == "ok"
+    assert scheduler.stats()["throttles"] == 1
+
+
+def test_other_errors_are_not_retried():
+    scheduler = ServiceScheduler("llm", 4)
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.run(call))
+    assert len(attempts) == 1
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_concurrency_may_probe_above_the_starting_limit():
+    assert ServiceScheduler("ocr", 4).concurrency.maximum == 8
+    assert ServiceScheduler("ocr", 4, max_concurrency=32).concurrency.maximum == 32
@@ -0,0 +1,67 @@
+import io
+import os
+import time
+
+from cogservice import read_document
+from upload_store import UploadStore
+
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_the_same_upload_is_stored_once(tmp_path):
+    store = UploadStore(str(tmp_path / "uploads"))
+    path = store.put(b"%PDF-1.7 a")
+    assert store.put(b"%PDF-1.7 a") == path
+    assert store.put(b"%PDF-1.7 b") != path
+    with open(path, "rb") as f:
+        assert f.read() == b"%PDF-1.7 a"
+    assert store.stats()["entries"] == 2
+
+
+def test_least_recently_used_uploads_are_evicted_unless_held(tmp_path):
+    store = UploadStore(str(tmp_path / "uploads"), max_bytes=250)
+    first = store.put(b"a" * 100)
+    second = store.put(b"b" * 100)
+    age(first, 60)
+    age(second, 30)
+    with store.hold([first]):
+        store.put(b"c" * 100)
+    assert os.path.exists(first)
+    assert not os.path.exists(second)
+    assert store.stats()["evictions"] == 1
+
+
+def test_cleanup_removes_expired_uploads_partial_writes_and_legacy_copies(tmp_path):
+    store = UploadStore(str(tmp_path / "uploads"), max_age_seconds=3600)
+    fresh = store.put(b"fresh")
+    expired = store.put(b"expired")
+    age(expired, 7200)
+    partial = tmp_path / "uploads" / "abc.pdf.0123.tmp"
+    partial.write_bytes(b"partial")
+    age(partial, 7200)
+    legacy_dir = tmp_path / "temp_uploads"
+    legacy_dir.mkdir()
+    legacy = legacy_dir / "0f8fad5b-d9cb-469f-a165-70867728950e.pdf"
+    legacy.write_bytes(b"legacy")
+    age(legacy, 7200)
+    kept = legacy_dir / "batch_extracted_invoices.xlsx"
+    kept.write_bytes(b"workbook")
+    age(kept, 7200)
+
+    assert store.cleanup(legacy_dir=str(legacy_dir)) == 3
+    assert os.path.exists(fresh) and kept.exists()
+    assert not os.path.exists(expired) and not partial.exists() and not legacy.exists()
+
+
+def test_read_document_uses_the_upload_in_memory(tmp_path):
+    assert read_document("unused.pdf", b"%PDF bytes") == b"%PDF bytes"
+    assert read_document("unused.pdf", io.BytesIO(b"%PDF buffer")) == b"%PDF buffer"
+    path = tmp_path / "a.pdf"
+    path.write_bytes(b"%PDF file")
+    with open(path, "rb") as f:
+        f.read(3)
+        assert read_document(str(path), f) == b"%PDF file"
+    assert read_document(str(path)) == b"%PDF file"
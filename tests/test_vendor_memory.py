@@ -0,0 +1,57 @@
+import pytest
+
+from vendor_memory import VendorMemory, approval_evidence, text_features
+
+RENTAL = {"expense_type": "Rental", "approval": "Approved", "job_location": "Maple St"}
+MATERIAL = {"expense_type": "Material", "approval": "Not Specified", "job_location": ""}
+
+
+def vendor(name):
+    return {"Vendor Name": {"value": name, "confidence": 0.9}}
+
+
+@pytest.fixture
+def memory(tmp_path):
+    memory = VendorMemory(str(tmp_path / "vendor_memory.sqlite3"), threshold=0.85, min_examples=3)
+    for index in range(8):
+        memory.learn(f"Excavator rental {index}. Approved by J. Smith. Job site: Maple St", vendor("Acme Rentals, Inc."), RENTAL)
+        memory.learn(f"Lumber supply {index}", vendor("Bob Lumber"), MATERIAL)
+    yield memory
+    memory.close()
+
+
+def test_text_features_and_approval_evidence():
+    features = text_features("Excavator RENTAL, approved. Ship to: job 12")
+    assert {"expense_type:rental", "approval:approved", "job_marker:job", "job_marker:ship to"} <= set(features)
+    assert approval_evidence("Approved", features)
+    assert not approval_evidence("Denied", features)
+    assert not approval_evidence("Not Specified", features)
+    assert approval_evidence("Not Specified", text_features("Lumber supply"))
+
+
+def test_repeat_vendors_are_answered_from_memory(memory):
+    assert memory.predict("Excavator rental 99. Approved. Job site: Maple St", vendor("ACME RENTALS")) == RENTAL
+    assert memory.predict("Lumber supply 42", vendor("Bob Lumber")) == MATERIAL
+
+
+def test_invoice_facts_need_evidence_in_the_text(memory):
+    # No approval marker for an Approved answer, an unknown job, and an approval marker for Not Specified.
+    assert memory.predict("Excavator rental 99. Job site: Maple St", vendor("Acme Rentals")) is None
+    assert memory.predict("Excavator rental 99. Approved. Job site: Oak Ave", vendor("Acme Rentals")) is None
+    assert memory.predict("Lumber supply 42, approved", vendor("Bob Lumber")) is None
+
+
+def test_new_vendors_and_low_confidence_go_to_the_llm(memory):
+    assert memory.predict("Excavator rental", vendor("New Co")) is None
+    strict = VendorMemory(memory.path, threshold=0.99, min_examples=3)
+    assert strict.predict("Excavator rental 99. Approved. Job site: Maple St", vendor("Acme Rentals")) is None
+    strict.close()
+
+
+def test_memory_survives_a_restart_and_reports_its_accuracy(memory):
+    reopened = VendorMemory(memory.path, threshold=0.85, min_examples=3)
+    assert reopened.predict("Lumber supply 42", vendor("Bob Lumber")) == MATERIAL
+    report = reopened.evaluate(holdout=0.25, threshold=0.5)
+    assert (report["examples"], report["train"], report["test"]) == (16, 12, 4)
+    assert report["agreement"] == 1.0
+    reopened.close()